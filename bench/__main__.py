@@ -1,6 +1,8 @@
+import random
 import textwrap
 from argparse import ArgumentParser
 from contextlib import contextmanager
+from os import cpu_count
 from os.path import dirname
 from sys import exit, stderr
 from timeit import Timer
@@ -13,9 +15,29 @@ test_data = [
     (
         "CraftServer_1710.java",  # CraftBukkit main server file 1.7.10
         "CraftServer_188.java",  # CraftBukkit main server file 1.8.8
-    )
+    ),
+    (
+        "large_file.txt",  # Generated file with 100,000 lines
+        "large_file_edited.txt",  # The same file with a single line edited
+    ),
 ]
 
+
+def large_file_lines(size=100000):
+    return ["{:06} {}".format(index, "-" * (index % 80)) for index in range(size)]
+
+
+def large_file_edited_lines():
+    result = large_file_lines()
+    result[len(result) // 2] = "edited"
+    return result
+
+
+generated_data = {
+    "large_file.txt": large_file_lines,
+    "large_file_edited.txt": large_file_edited_lines,
+}
+
 bench_methods = {
     "parse_diff": (
         """\
@@ -60,6 +82,10 @@ bench_methods = {
         """,
     ),
 }
+# Benchmarked separately, since it compares thread counts instead of the test data
+HASH_THREADS_TARGET = "hash_threads"
+# Benchmarked separately, since it diffs a chain of revisions instead of the test data
+REVISION_CHAIN_TARGET = "revision_chain"
 __cached_test_data_lines = {}
 
 
@@ -68,17 +94,108 @@ def test_data_lines(name, data_dir="data"):
     try:
         return cache[name]
     except KeyError:
-        result = []
-        with open("{}/{}".format(data_dir, name), "rt") as f:
-            for line in f:
-                result.append(line.rstrip("\r\n"))
+        try:
+            result = generated_data[name]()
+        except KeyError:
+            result = []
+            with open("{}/{}".format(data_dir, name), "rt") as f:
+                for line in f:
+                    result.append(line.rstrip("\r\n"))
         cache[name] = result
         return result
 
 
+def bench_hash_threads(padded_target, iterations, repeat, size=1000000):
+    """Benchmark how hashing a million lines in the native engine scales with the number of threads"""
+    try:
+        from diffutils._native.myers import native_diff
+    except ImportError:
+        print(
+            "Unable to run {} without the native engine".format(padded_target),
+            file=stderr,
+        )
+        exit(1)
+    original_lines = large_file_lines(size)
+    revised_lines = list(original_lines)
+    revised_lines[size // 2] = "edited"
+    max_threads = cpu_count() or 1
+    thread_counts, threads = [], 1
+    while threads < max_threads:
+        thread_counts.append(threads)
+        threads *= 2
+    thread_counts.append(max_threads)
+    baseline = None
+    for threads in thread_counts:
+        timer = Timer(
+            stmt=lambda: native_diff(
+                original_lines, revised_lines, hash_threads=threads
+            )
+        )
+        result = min(timer.repeat(repeat=repeat, number=iterations)) * 1000
+        if baseline is None:
+            baseline = result
+        print(
+            "{}  {:.3f} ms -- {} lines with {} threads ({:.2f}x)".format(
+                padded_target, result, size, threads, baseline / result
+            )
+        )
+
+
+def revision_chain(size=20000, revisions=20, seed=1):
+    """Successive revisions of a document, where each one edits about 1% of the lines of the last"""
+    rng = random.Random(seed)
+    current = large_file_lines(size)
+    result = [current]
+    for revision in range(revisions):
+        current = list(current)
+        for _ in range(size // 100):
+            index = rng.randrange(len(current))
+            current[index] = "{:06} revision {}".format(index, revision)
+        result.append(current)
+    return result
+
+
+def bench_revision_chain(padded_target, iterations, repeat):
+    """Benchmark diffing each revision against the last, with and without a line hash cache"""
+    from diffutils.cache import LineHashCache
+
+    chain = revision_chain()
+    names = ["plain"]
+    try:
+        from diffutils._native import myers  # noqa: F401
+
+        names.append("native")
+    except ImportError:
+        pass
+    for name in names:
+        for cached in (False, True):
+
+            def diff_chain():
+                engine = DiffEngine.create(
+                    name=name, hash_cache=LineHashCache() if cached else None
+                )
+                for original_lines, revised_lines in zip(chain, chain[1:]):
+                    engine.diff(original_lines, revised_lines)
+
+            timer = Timer(stmt=diff_chain)
+            result = min(timer.repeat(repeat=repeat, number=iterations)) * 1000
+            print(
+                "{}  {:.3f} ms -- {} revisions of {} lines with {}{}".format(
+                    padded_target,
+                    result,
+                    len(chain),
+                    len(chain[0]),
+                    name,
+                    " and a line hash cache" if cached else "",
+                )
+            )
+
+
 def main():
     parser = ArgumentParser(description="Benchmarks DiffUtils")
-    available_targets = frozenset(bench_methods.keys())
+    available_targets = frozenset(
+        (*bench_methods.keys(), HASH_THREADS_TARGET, REVISION_CHAIN_TARGET)
+    )
     parser.add_argument(
         "targets",
         nargs="+",
@@ -89,10 +206,15 @@ def main():
         "--iterations",
         "-i",
         default=10,
+        type=int,
         help="The number of benchmark iterations to perform on each",
     )
     parser.add_argument(
-        "--repeat", "-r", default=3, help="The number of times to repeat the benchmark"
+        "--repeat",
+        "-r",
+        default=3,
+        type=int,
+        help="The number of times to repeat the benchmark",
     )
     parser.add_argument(
         "--data-dir",
@@ -116,6 +238,12 @@ def main():
     max_target_length = max(len(target) for target in targets)
     for target in sorted(targets):
         padded_target = target.ljust(max_target_length)
+        if target == HASH_THREADS_TARGET:
+            bench_hash_threads(padded_target, iterations, repeat)
+            continue
+        elif target == REVISION_CHAIN_TARGET:
+            bench_revision_chain(padded_target, iterations, repeat)
+            continue
         for (original_name, revised_name) in test_data:
             original_lines = test_data_lines(original_name, data_dir=data_dir)
             revised_lines = test_data_lines(revised_name, data_dir=data_dir)
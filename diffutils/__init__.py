@@ -17,4 +17,16 @@ from __future__ import print_function
 import sys
 
 # Public API Functions
-from .api import diff, generate_unified_diff, parse_unified_diff, patch, undo_patch
+from .api import (
+    diff,
+    diff_files,
+    diff_many,
+    generate_unified_diff,
+    iter_unified_diff,
+    parse_unified_diff,
+    patch,
+    rediff,
+    undo_patch,
+)
+from .cache import DiffCache, LineHashCache
+from .patchset import PatchSet, PatchSetEntry
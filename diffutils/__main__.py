@@ -1,14 +1,28 @@
 # NOTE: Must be first import to check version
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
+from typing import Optional
 
 import argh
 from argh import CommandError, arg
 
 import diffutils
-from diffutils.api import PatchFailedException, parse_unified_diff
+from diffutils.api import (
+    PatchFailedException,
+    PatchFormatError,
+    diff_files,
+    map_lines,
+    parse_unified_diff,
+)
+from diffutils.cache import CachedDiffEngine, DiffCache
 from diffutils.engine import DiffEngine
 from diffutils.output import generate_unified_diff
+from diffutils.patchset import PatchSet, PatchSetEntry
 
 
 def do_diff(
@@ -19,15 +33,7 @@ def do_diff(
     context_size=5,
     force=False,
 ):
-    original_lines = []
-    revised_lines = []
-    with open(original, "rt") as f:
-        for line in f:
-            original_lines.append(line.rstrip("\r\n"))
-    with open(revised, "rt") as f:
-        for line in f:
-            revised_lines.append(line.rstrip("\r\n"))
-    result = engine.diff(original_lines, revised_lines)
+    result = diff_files(original, revised, engine=engine)
     if not original.is_absolute():
         original_name = str(original)
     else:
@@ -39,16 +45,18 @@ def do_diff(
     try:
         result_lines = []
         empty = True
-        for line in generate_unified_diff(
-            original_name,
-            revised_name,
-            original_lines,
-            result,
-            context_size=context_size,
-        ):
-            if empty and line.strip():
-                empty = False
-            result_lines.append(line)
+        # NOTE: Only the context lines are decoded
+        with map_lines(original) as original_lines:
+            for line in generate_unified_diff(
+                original_name,
+                revised_name,
+                original_lines,
+                result,
+                context_size=context_size,
+            ):
+                if empty and line.strip():
+                    empty = False
+                result_lines.append(line)
         if empty:
             return False
         with open(output, "wt" if force else "xt") as f:
@@ -60,30 +68,292 @@ def do_diff(
         raise CommandError("Output file already exists: {}".format(output))
 
 
+def diff_job(engine: DiffEngine, context_size: int, force: bool, job):
+    """Diff a single file of a directory tree, returning its relative path and whether there were any changes"""
+    relative_path, original_file, revised_file, output_file = job
+    changed = do_diff(
+        engine,
+        original_file,
+        revised_file,
+        output_file,
+        context_size=context_size,
+        force=force,
+    )
+    return relative_path, changed
+
+
+def walk_diff_jobs(
+    original: Path,
+    revised: Path,
+    output: Path,
+    ignore_missing=False,
+    unrestricted=False,
+):
+    """Walk the revised tree, yielding each file that needs to be diffed in a deterministic order"""
+    for revised_root, dirs, files in os.walk(str(revised)):
+        # NOTE: os.walk doesn't guarantee any order, but the jobs should always run in the same one
+        dirs.sort()
+        for revised_file_name in sorted(files):
+            if not unrestricted and revised_file_name.startswith("."):
+                continue
+            revised_file = Path(revised_root, revised_file_name)
+            relative_path = revised_file.relative_to(revised)
+            original_file = Path(original, relative_path)
+            if not original_file.exists():
+                if ignore_missing:
+                    continue
+                else:
+                    raise CommandError(
+                        "Revised file {} doesn't have matching original {}!".format(
+                            revised_file, original_file
+                        )
+                    )
+            output_file = Path(
+                output, relative_path.parent, relative_path.name + ".patch"
+            )
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            yield relative_path, original_file, revised_file, output_file
+        if not unrestricted:
+            hidden_dirs = [d for d in dirs if d.startswith(".")]
+            for d in hidden_dirs:
+                dirs.remove(d)
+
+
+def patch_job(
+    patches: Path,
+    original: Path,
+    output: Path,
+    force: bool,
+    max_offset: Optional[int],
+    patch_file: Path,
+):
+    """
+    Apply a single patch of a directory tree,
+    returning the patch file, the error message if it failed, and the deltas that moved.
+
+    Failures are returned instead of raised, so they can all be reported at the end.
+    That includes files that can't be read or aren't valid UTF-8, which would otherwise stop the other patches.
+    """
+    try:
+        if patch_file.suffix != ".patch":
+            raise CommandError(
+                "Patch file doesn't end with '.patch': {}".format(patch_file.name)
+            )
+        relative_path = Path(patch_file.parent.relative_to(patches), patch_file.stem)
+        original_file = Path(original, relative_path)
+        output_file = Path(output, relative_path)
+        if not original_file.exists():
+            raise CommandError(
+                "Couldn't find  original {} for patch {}!".format(
+                    original_file, patch_file
+                )
+            )
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        moved = do_patch(
+            patch_file, original_file, output_file, force=force, max_offset=max_offset
+        )
+    except (CommandError, PatchFormatError, UnicodeDecodeError, OSError) as e:
+        return patch_file, str(e), []
+    return patch_file, None, moved
+
+
+def patch_set_job(
+    original: Path,
+    output: Path,
+    force: bool,
+    strip: int,
+    max_offset: Optional[int],
+    entry: PatchSetEntry,
+):
+    """
+    Apply the patch for a single file in a patch set,
+    returning its name, the error message if it failed, and the deltas that moved.
+
+    Created files have an empty original, and deleted files don't write any output.
+    """
+    try:
+        try:
+            relative_path = Path(entry.relative_path(strip))
+        except ValueError as e:
+            raise CommandError(str(e)) from None
+        original_file = resolve_inside(original, relative_path, entry)
+        output_file = resolve_inside(output, relative_path, entry)
+        if not entry.is_created and not original_file.exists():
+            raise CommandError(
+                "Couldn't find original {} for {}!".format(original_file, entry.name)
+            )
+        patch = entry.parse()
+        moved = []
+        try:
+            with ExitStack() as stack:
+                if entry.is_created:
+                    original_lines = []
+                else:
+                    original_lines = stack.enter_context(open(original_file, "rt"))
+                if max_offset is not None:
+                    original_lines = [line.rstrip("\r\n") for line in original_lines]
+                    patch, moved = relocate_patch(
+                        patch, original_lines, max_offset, entry.name
+                    )
+                if entry.is_deleted:
+                    # NOTE: There's no output, but the patch still has to apply
+                    patch.apply_stream(
+                        original_lines, stack.enter_context(open(os.devnull, "wt"))
+                    )
+                else:
+                    output_file.parent.mkdir(parents=True, exist_ok=True)
+                    write_patched(patch, original_lines, output_file, force=force)
+        except PatchFailedException as e:
+            raise CommandError(str(e)) from None
+    except (CommandError, PatchFormatError, UnicodeDecodeError, OSError) as e:
+        return entry.name, str(e), []
+    return entry.name, None, moved
+
+
+def resolve_inside(root: Path, relative_path: Path, entry: PatchSetEntry) -> Path:
+    """Join the path of the entry onto the root, rejecting it if it resolves outside the root (like through a symlink)"""
+    path = Path(root, relative_path)
+    try:
+        path.resolve().relative_to(root.resolve())
+    except ValueError:
+        raise PatchFormatError(
+            "File name {!r} is outside {}".format(entry.name, root),
+            entry.line_number,
+            entry.name,
+        ) from None
+    return path
+
+
+def report_failures(results):
+    """
+    Wait for all the patches to be applied, then report every one that failed.
+
+    The deltas that moved are printed here instead of by the workers, so they're in the order of the patches.
+    """
+    failures = []
+    num_patches = 0
+    for name, error, moved in results:
+        num_patches += 1
+        for message in moved:
+            print(message)
+        if error is not None:
+            failures.append("  {}: {}".format(name, error))
+    if failures:
+        raise CommandError(
+            "Failed to apply {} of {} patches:\n{}".format(
+                len(failures), num_patches, "\n".join(failures)
+            )
+        )
+
+
+def walk_patch_jobs(patches: Path):
+    """Walk the patch tree, yielding each patch file in a deterministic order"""
+    for patch_root, dirs, files in os.walk(str(patches)):
+        dirs.sort()
+        for patch_file_name in sorted(files):
+            yield Path(patch_root, patch_file_name)
+
+
+# The number of jobs sent to a worker process at once, which amortizes the cost of communicating with it
+_JOB_CHUNK_SIZE = 16
+
+
+def run_jobs(func, jobs, num_workers: int):
+    """
+    Run the function on each of the jobs, yielding the results in the same order as the jobs.
+
+    If there's more than one worker, the jobs are run in a process pool.
+    Zero workers means one for each CPU.
+    """
+    if num_workers < 0:
+        raise CommandError("Invalid number of jobs: {}".format(num_workers))
+    elif num_workers == 1:
+        yield from map(func, jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers or None) as executor:
+            yield from executor.map(func, jobs, chunksize=_JOB_CHUNK_SIZE)
+
+
 def do_patch(
-    patch_file: Path, original: Path, output: Path, context_size=5, force=False
+    patch_file: Path,
+    original: Path,
+    output: Path,
+    context_size=5,
+    force=False,
+    max_offset=None,
 ):
-    original_lines = []
-    patch_lines = []
+    """Apply the patch to the original file, returning a message for each delta that moved"""
     with open(patch_file, "rt") as f:
-        for line in f:
-            patch_lines.append(line.rstrip("\r\n"))
-    patch = parse_unified_diff(patch_lines)
-    patch_lines = None  # Free
-    with open(original, "rt") as f:
-        for line in f:
-            original_lines.append(line.rstrip("\r\n"))
+        # NOTE: Stream the patch, instead of reading all the lines at once
+        patch = parse_unified_diff(f)
     try:
-        result_lines = patch.apply_to(original_lines)
+        with open(original, "rt") as f:
+            if max_offset is None:
+                # NOTE: Stream the original too, so only a single hunk is ever in memory
+                write_patched(patch, f, output, force=force)
+                return []
+            else:
+                # NOTE: Finding the deltas that moved needs the whole original
+                original_lines = [line.rstrip("\r\n") for line in f]
+                patch, moved = relocate_patch(
+                    patch, original_lines, max_offset, original
+                )
+                write_patched(patch, original_lines, output, force=force)
+                return moved
     except PatchFailedException as e:
         raise CommandError(str(e)) from None
+
+
+def relocate_patch(patch, original_lines, max_offset: int, name):
+    """
+    Move the deltas of the patch to where they are in the original lines,
+    returning the relocated patch and a message for each delta that moved.
+    """
+    patch, offsets = patch.relocate(original_lines, max_offset=max_offset)
+    moved = []
+    for number, (delta, offset) in enumerate(zip(patch.deltas, offsets), 1):
+        if offset:
+            moved.append(
+                "{}: delta #{} applied at line {} (offset {} lines)".format(
+                    name, number, delta.original.position + 1, offset
+                )
+            )
+    return patch, moved
+
+
+def write_patched(patch, original_lines, output: Path, force=False):
+    """
+    Stream the result of applying the patch to the original lines into the output file.
+
+    If the patch fails, any output file we created is removed.
+    An existing output is only replaced once the whole patch has applied,
+    which also makes it safe to patch a file in place.
+    """
+    if output.exists():
+        if not force:
+            raise CommandError("Output file already exists: {}".format(output))
+        fd, temp_path = tempfile.mkstemp(
+            dir=str(output.parent), prefix="." + output.name + ".", suffix=".tmp"
+        )
+        try:
+            shutil.copymode(str(output), temp_path)
+            with open(fd, "wt") as f:
+                patch.apply_stream(original_lines, f)
+            os.replace(temp_path, str(output))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return
     try:
-        with open(output, "wt" if force else "xt") as f:
-            for line in result_lines:
-                f.write(line)
-                f.write("\n")
+        f = open(output, "xt")
     except FileExistsError:
         raise CommandError("Output file already exists: {}".format(output))
+    try:
+        with f:
+            patch.apply_stream(original_lines, f)
+    except BaseException:
+        os.unlink(str(output))
+        raise
 
 
 @arg("original", type=Path, help="The original file/directory")
@@ -94,7 +364,20 @@ def do_patch(
     "-i",
     help="Ignore revised files that are missing from the original dir",
 )
-@arg("--implementation", "--impl", help="Specify the diff implementation to use")
+@arg(
+    "--implementation",
+    "--impl",
+    help="Specify the diff implementation to use, like 'native-myers' or 'patience'",
+)
+@arg(
+    "--intern-lines",
+    help="Compare integer ids of the lines instead of their hashes",
+)
+@arg(
+    "--max-cost",
+    type=int,
+    help="Give up on finding the minimum diff after this many differences",
+)
 @arg(
     "--context",
     "-c",
@@ -102,15 +385,30 @@ def do_patch(
 )
 @arg("--unrestricted", "-u", help="Search hidden files and directories")
 @arg("--force", "-f", help="Forcibly override existing patches")
+@arg(
+    "--jobs",
+    "-j",
+    type=int,
+    help="Diff this many files in parallel, or one per CPU if zero",
+)
+@arg(
+    "--cache-dir",
+    type=Path,
+    help="Cache the diffs in this directory, reusing them when the same files are diffed again",
+)
 def diff(
     original: Path,
     revised: Path,
     output: Path,
     ignore_missing=False,
     implementation=None,
+    intern_lines=False,
+    max_cost=None,
     context=5,
     unrestricted=False,
     force=False,
+    jobs=1,
+    cache_dir=None,
 ):
     """Compute the difference between the original and revised text"""
     if not original.exists():
@@ -118,11 +416,16 @@ def diff(
     if not revised.exists():
         raise CommandError("Revised file doesn't exist: {}".format(revised))
     try:
-        engine = DiffEngine.create(name=implementation)
+        engine = DiffEngine.create(
+            name=implementation, intern_lines=intern_lines, max_cost=max_cost
+        )
     except ImportError as e:
         raise CommandError(
             "Unable to import {} implementation!".format(implementation)
         ) from e
+    if cache_dir is not None:
+        # NOTE: Each worker process gets its own cache in memory, but they share the directory
+        engine = CachedDiffEngine(engine, DiffCache(directory=cache_dir))
     if original.is_dir():
         if not revised.is_dir():
             raise CommandError(
@@ -130,39 +433,18 @@ def diff(
                     original, revised
                 )
             )
-        for revised_root, dirs, files in os.walk(str(revised)):
-            for revised_file_name in files:
-                if not unrestricted and revised_file_name.startswith("."):
-                    continue
-                revised_file = Path(revised_root, revised_file_name)
-                relative_path = revised_file.relative_to(revised)
-                original_file = Path(original, relative_path)
-                if not original_file.exists():
-                    if ignore_missing:
-                        continue
-                    else:
-                        raise CommandError(
-                            "Revised file {} doesn't have matching original {}!".format(
-                                revised_file, original_file
-                            )
-                        )
-                output_file = Path(
-                    output, relative_path.parent, relative_path.name + ".patch"
-                )
-                output_file.parent.mkdir(parents=True, exist_ok=True)
-                if do_diff(
-                    engine,
-                    original_file,
-                    revised_file,
-                    output_file,
-                    context_size=context,
-                    force=force,
-                ):
-                    print("Computed diff: {}".format(relative_path))
-            if not unrestricted:
-                hidden_dirs = [d for d in dirs if d.startswith(".")]
-                for d in hidden_dirs:
-                    dirs.remove(d)
+        diff_jobs = walk_diff_jobs(
+            original,
+            revised,
+            output,
+            ignore_missing=ignore_missing,
+            unrestricted=unrestricted,
+        )
+        for relative_path, changed in run_jobs(
+            partial(diff_job, engine, context, force), diff_jobs, jobs
+        ):
+            if changed:
+                print("Computed diff: {}".format(relative_path))
     else:
         if not revised.is_file():
             raise CommandError(
@@ -177,12 +459,39 @@ def diff(
 @arg("original", type=Path, help="The original file/directory")
 @arg("output", type=Path, help="Where to output the revised files")
 @arg("--force", "-f", help="Forcibly override existing files")
-def patch(patches: Path, original: Path, output: Path, force=False):
+@arg(
+    "--jobs",
+    "-j",
+    type=int,
+    help="Apply this many patches in parallel, or one per CPU if zero",
+)
+@arg(
+    "--strip",
+    "-p",
+    type=int,
+    help="Strip this many leading components from the file names in a multi-file patch",
+)
+@arg(
+    "--max-offset",
+    type=int,
+    help="Let each delta apply up to this many lines away from where the patch says, reporting the ones that moved",
+)
+def patch(
+    patches: Path,
+    original: Path,
+    output: Path,
+    force=False,
+    jobs=1,
+    strip=1,
+    max_offset=None,
+):
     """Applies the specified patches to the original files, producing the revised text"""
     if not patches.exists():
         raise CommandError("Patch file doesn't exist: {}".format(patches))
     if not original.exists():
         raise CommandError("Original file doesn't exist: {}".format(original))
+    if max_offset is not None and max_offset < 0:
+        raise CommandError("Invalid max offset: {}".format(max_offset))
     if patches.is_dir():
         if not original.is_dir():
             raise CommandError(
@@ -190,28 +499,23 @@ def patch(patches: Path, original: Path, output: Path, force=False):
                     patches, original
                 )
             )
-        for patch_root, dirs, files in os.walk(str(patches)):
-            for patch_file_name in files:
-                patch_file = Path(patch_root, patch_file_name)
-                if patch_file.suffix != ".patch":
-                    raise CommandError(
-                        "Patch file doesn't end with '.patch': {}".format(
-                            patch_file_name
-                        )
-                    )
-                relative_path = Path(
-                    patch_file.parent.relative_to(patches), patch_file.stem
-                )
-                original_file = Path(original, relative_path)
-                output_file = Path(output, relative_path)
-                if not original_file.exists():
-                    raise CommandError(
-                        "Couldn't find  original {} for patch {}!".format(
-                            original_file, patch_file
-                        )
-                    )
-                output_file.parent.mkdir(parents=True, exist_ok=True)
-                do_patch(patch_file, original_file, output_file, force=force)
+        report_failures(
+            run_jobs(
+                partial(patch_job, patches, original, output, force, max_offset),
+                walk_patch_jobs(patches),
+                jobs,
+            )
+        )
+    elif original.is_dir():
+        # A single patch for multiple files, like the output of 'git diff'
+        patch_set = PatchSet.index(patches)
+        report_failures(
+            run_jobs(
+                partial(patch_set_job, original, output, force, strip, max_offset),
+                patch_set.entries,
+                jobs,
+            )
+        )
     else:
         if not original.is_file():
             raise CommandError(
@@ -219,7 +523,10 @@ def patch(patches: Path, original: Path, output: Path, force=False):
                     patches, original
                 )
             )
-        do_patch(patches, original, output, force=force)
+        for message in do_patch(
+            patches, original, output, force=force, max_offset=max_offset
+        ):
+            print(message)
 
 
 @arg("patch_file", type=Path, help="The patch file to fix")
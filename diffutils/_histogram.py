@@ -0,0 +1,203 @@
+# Copyright 2015 Techcable
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An implementation of the histogram differencing algorithm used by git's `--histogram` option.
+
+This extends the patience algorithm by building a histogram of how often each line occurs in the original,
+and then splitting at the longest common region containing the rarest line.
+Unlike patience, lines don't have to be unique, so it can still make progress on repetitive input.
+"""
+
+from typing import Dict, List, Optional, Sequence, T, Tuple
+
+from ._myers import MyersEngine, intern_lines
+from ._patience import add_myers_deltas, add_section_delta, trim_section
+from .core import Patch
+from .engine import DiffEngine
+
+# Lines occurring more often than this are too common to split on,
+# which bounds the work we do for each line of the revised section.
+MAX_CHAIN_LENGTH = 64
+
+
+class HistogramEngine(DiffEngine):
+    def __init__(self, max_chain_length=MAX_CHAIN_LENGTH, max_cost=None):
+        self.max_chain_length = max_chain_length
+        self.max_cost = max_cost
+
+    @property
+    def name(self):
+        return "plain_histogram"
+
+    def compute_diff(self, original, revised):
+        if type(original) is not list:
+            raise TypeError("Original must be a list: {!r}".format(original))
+        if type(revised) is not list:
+            raise TypeError("Revised must be a list: {!r}".format(revised))
+        ids = intern_lines(original, revised)
+        if ids is None:
+            # We can't count the lines without hashing them, so just fallback to myers
+            return MyersEngine(
+                hash_optimization=False, max_cost=self.max_cost
+            ).compute_diff(original, revised)
+        return build_histogram_revision(
+            ids[0],
+            ids[1],
+            original,
+            revised,
+            max_chain_length=self.max_chain_length,
+            max_cost=self.max_cost,
+        )
+
+    def __repr__(self):
+        return "PlainHistogramEngine"
+
+
+def build_histogram_revision(
+    original_ids: Sequence[int],
+    revised_ids: Sequence[int],
+    original: List[T],
+    revised: List[T],
+    max_chain_length: int = MAX_CHAIN_LENGTH,
+    max_cost: Optional[int] = None,
+) -> Patch:
+    """
+    Computes the histogram diff between the original and revised sequences.
+
+    Any sections where every common line is more frequent than the max_chain_length fall back to Myers algorithm,
+    which gives up on finding the minimum after max_cost differences.
+
+    :param original_ids: The interned ids of the original sequence.
+    :param revised_ids: The interned ids of the revised sequence.
+    :param original: The original sequence.
+    :param revised: The revised sequence.
+    :param max_chain_length: The maximum number of occurrences of a line we'll split on.
+    :param max_cost: The maximum number of differences Myers algorithm searches for, or None for no limit.
+    :return: A Patch describing the differences.
+    """
+    patch = Patch()
+    # Use an explicit stack instead of recursion, with the leftmost section on top
+    sections = [(0, len(original_ids), 0, len(revised_ids))]
+    while sections:
+        i_start, i_end, j_start, j_end = trim_section(
+            original_ids, revised_ids, *sections.pop()
+        )
+        if i_start == i_end or j_start == j_end:
+            add_section_delta(patch, original, revised, i_start, i_end, j_start, j_end)
+            continue
+        has_common, split = find_split(
+            original_ids,
+            revised_ids,
+            i_start,
+            i_end,
+            j_start,
+            j_end,
+            max_chain_length,
+        )
+        if split is None:
+            if has_common:
+                add_myers_deltas(
+                    patch,
+                    original_ids,
+                    revised_ids,
+                    original,
+                    revised,
+                    i_start,
+                    i_end,
+                    j_start,
+                    j_end,
+                    max_cost=max_cost,
+                )
+            else:
+                # There's nothing in common, so the entire section was replaced
+                add_section_delta(
+                    patch, original, revised, i_start, i_end, j_start, j_end
+                )
+            continue
+        i_split_start, i_split_end, j_split_start, j_split_end = split
+        sections.append((i_split_end, i_end, j_split_end, j_end))
+        sections.append((i_start, i_split_start, j_start, j_split_start))
+    return patch
+
+
+def find_split(
+    original_ids: Sequence[int],
+    revised_ids: Sequence[int],
+    i_start: int,
+    i_end: int,
+    j_start: int,
+    j_end: int,
+    max_chain_length: int = MAX_CHAIN_LENGTH,
+) -> Tuple[bool, Optional[Tuple[int, int, int, int]]]:
+    """
+    Find the longest common region containing the line with the fewest occurrences in the original section.
+
+    :return: whether the sections have any lines in common, and the common region to split at (if any)
+    """
+    # The histogram of the original section, mapping each line to the positions it occurs at
+    occurrences = {}  # type: Dict[int, List[int]]
+    for i in range(i_start, i_end):
+        occurrences.setdefault(original_ids[i], []).append(i)
+    has_common = False
+    best = None  # type: Optional[Tuple[int, int, int, int]]
+    best_count = max_chain_length + 1
+    best_length = 0
+    j = j_start
+    while j < j_end:
+        positions = occurrences.get(revised_ids[j])
+        next_j = j + 1
+        if positions is not None:
+            has_common = True
+            if len(positions) <= min(best_count, max_chain_length):
+                for i in positions:
+                    # Extend the match in both directions, keeping track of the rarest line in it
+                    count = len(positions)
+                    region_i_start, region_j_start = i, j
+                    while (
+                        region_i_start > i_start
+                        and region_j_start > j_start
+                        and original_ids[region_i_start - 1]
+                        == revised_ids[region_j_start - 1]
+                    ):
+                        region_i_start -= 1
+                        region_j_start -= 1
+                        count = min(
+                            count, len(occurrences[original_ids[region_i_start]])
+                        )
+                    region_i_end, region_j_end = i + 1, j + 1
+                    while (
+                        region_i_end < i_end
+                        and region_j_end < j_end
+                        and original_ids[region_i_end] == revised_ids[region_j_end]
+                    ):
+                        count = min(count, len(occurrences[original_ids[region_i_end]]))
+                        region_i_end += 1
+                        region_j_end += 1
+                    # There's no need to look at the lines we just matched again
+                    next_j = max(next_j, region_j_end)
+                    if (
+                        region_i_end - region_i_start > best_length
+                        or count < best_count
+                    ):
+                        best = (
+                            region_i_start,
+                            region_i_end,
+                            region_j_start,
+                            region_j_end,
+                        )
+                        best_count = count
+                        best_length = region_i_end - region_i_start
+        j = next_j
+    return has_common, best
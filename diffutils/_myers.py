@@ -19,69 +19,152 @@ A clean-room implementation of <a href="http://www.cs.arizona.edu/people/gene/">
 See the paper at http://www.cs.arizona.edu/people/gene/PAPERS/diff.ps
 """
 import hashlib
-from typing import List, Optional, T
+from array import array
+from typing import List, Optional, T, Tuple
 
-from .core import Chunk, Delta, Patch
+from .core import Chunk, Delta, Patch, chunk_lines
 from .engine import DiffEngine
 
 
 class MyersEngine(DiffEngine):
-    def __init__(self, hash_optimization=True):
+    def __init__(
+        self,
+        hash_optimization=True,
+        intern_lines=False,
+        max_cost=None,
+        hash_cache=None,
+        line_views=False,
+    ):
         self.hash_optimization = hash_optimization
+        self.intern_lines = intern_lines
+        self.max_cost = max_cost
+        self.hash_cache = hash_cache
+        self.line_views = line_views
 
     @property
     def name(self):
         return "plain_myers"
 
-    def diff(self, original, revised):
+    def compute_diff(self, original, revised):
         if type(original) is not list:
             raise TypeError("Original must be a list: {!r}".format(original))
         if type(revised) is not list:
             raise TypeError("Revised must be a list: {!r}".format(revised))
+        if self.intern_lines:
+            # Comparing integer ids is even cheaper than comparing hashes, and they can never collide
+            ids = intern_lines(original, revised)
+            if ids is not None:
+                return self.build_patch(ids[0], ids[1], original, revised)
         original_hashes = None  # type: list[bytes]
         revised_hashes = None  # type: list[bytes]
         if self.hash_optimization:
             # Since build_path actually doesn't need the elements themselves, we can take their sha256sum to speed up comparison
             # This can improve performance noticably, since hashes usually differ in the first few bytes and there are only 32 bytes at most
-            original_hashes = []
-            for element in original:
-                if type(element) is not str:
-                    original_hashes, revised_hashes = None, None
-                    break
-                h = hashlib.sha256()
-                h.update(element.encode("utf-8"))
-                original_hashes.append(h.digest())
+            original_hashes = self.hash_lines(original)
         if original_hashes is not None:
-            revised_hashes = []
-            for element in revised:
-                if type(element) is not str:
-                    original_hashes, revised_hashes = None, None
-                    break
-                h = hashlib.sha256()
-                h.update(element.encode("utf-8"))
-                revised_hashes.append(h.digest())
-        if original_hashes is not None:
-            path = build_path(original_hashes, revised_hashes)
+            revised_hashes = self.hash_lines(revised)
+        if revised_hashes is not None:
+            return self.build_patch(original_hashes, revised_hashes, original, revised)
         else:
-            path = build_path(original, revised)
-        return build_revision(path, original, revised)
+            return self.build_patch(original, revised, original, revised)
+
+    def hash_lines(self, lines):
+        """Hash the lines, reusing any hashes in the cache"""
+        if self.hash_cache is not None:
+            return self.hash_cache.hash_lines(lines)
+        return hash_lines(lines)
+
+    def build_patch(self, original_keys, revised_keys, original, revised) -> Patch:
+        """
+        Compute the patch between the original and revised sequences,
+        comparing the corresponding keys instead of the elements themselves.
+        """
+        path = build_path(original_keys, revised_keys, max_cost=self.max_cost)
+        return build_revision(path, original, revised, line_views=self.line_views)
 
     def __repr__(self):
-        if self.hash_optimization:
+        if self.intern_lines:
+            return "PlainMyersEngine(intern_lines=True)"
+        elif self.hash_optimization:
             return "PlainMyersEngine"
         else:
             return "PlainMyersEngine(hash_optimization=False)"
 
 
-def build_path(original: List[T], revised: List[T]) -> "DiffNode":
+class LinearMyersEngine(MyersEngine):
+    """
+    Uses the linear space variant of Myers algorithm,
+    which finds the 'middle snake' of the diffpath and then recursively diffs the two halves.
+
+    This is slower than the regular engine, but only needs O(N+M) memory instead of O((N+M)D).
+    """
+
+    @property
+    def name(self):
+        return "plain_linear_myers"
+
+    def build_patch(self, original_keys, revised_keys, original, revised) -> Patch:
+        return build_linear_revision(
+            original_keys,
+            revised_keys,
+            original,
+            revised,
+            max_cost=self.max_cost,
+            line_views=self.line_views,
+        )
+
+    def __repr__(self):
+        if self.intern_lines:
+            return "PlainLinearMyersEngine(intern_lines=True)"
+        elif self.hash_optimization:
+            return "PlainLinearMyersEngine"
+        else:
+            return "PlainLinearMyersEngine(hash_optimization=False)"
+
+
+def hash_lines(lines: List[T]) -> Optional[List[bytes]]:
+    """Take the sha256sum of each line, or return None if any of the lines aren't strings"""
+    result = []
+    for element in lines:
+        if type(element) is not str:
+            return None
+        h = hashlib.sha256()
+        h.update(element.encode("utf-8"))
+        result.append(h.digest())
+    return result
+
+
+def intern_lines(original: List[T], revised: List[T]) -> Optional[Tuple[array, array]]:
+    """
+    Map every distinct line to a dense integer id, or return None if any of the lines aren't hashable.
+
+    The ids are shared by both sides, so identical lines always get identical ids.
+    """
+    ids = {}  # type: dict
+    try:
+        original_ids = array("i", [ids.setdefault(line, len(ids)) for line in original])
+        revised_ids = array("i", [ids.setdefault(line, len(ids)) for line in revised])
+    except TypeError:
+        return None
+    return original_ids, revised_ids
+
+
+def build_path(
+    original: List[T], revised: List[T], max_cost: Optional[int] = None
+) -> "DiffNode":
     """
     Computes the minimum diffpath that expresses the differences between the original and revised sequences,
     according to Gene Myers differencing algorithm.
 
     According to the author of the algorithm, a diffpath will always be found, so a RuntimeError shouldn't be thrown.
 
+    If the diffpath would need more than max_cost differences, the search is too expensive.
+    Instead, we take the furthest reaching path we've found and replace everything after it,
+    which is still a valid diffpath but no longer the minimum.
+
     :param original: The original sequence.
     :param revised: The revised sequence.
+    :param max_cost: The maximum number of differences to search for, or None to always find the minimum.
     :return: A minimum {@link DiffNode Path} across the differences graph.
     :exception RuntimeError: if a diff path could not be found.
     """
@@ -95,6 +178,8 @@ def build_path(original: List[T], revised: List[T]) -> "DiffNode":
 
     diagonal[middle + 1] = create_snake(0, -1, None)
     for d in range(max_size):
+        if max_cost is not None and d > max_cost:
+            return finish_path(diagonal, middle, d - 1, original_size, revised_size)
         for k in range(-d, d + 1, 2):
             kmiddle = middle + k
             kplus = kmiddle + 1
@@ -135,13 +220,38 @@ def build_path(original: List[T], revised: List[T]) -> "DiffNode":
     raise RuntimeError("couldn't find a diff path")
 
 
-def build_revision(path: "DiffNode", original: List[T], revised: List[T]) -> Patch:
+def finish_path(
+    diagonal: List[Optional["DiffNode"]],
+    middle: int,
+    d: int,
+    original_size: int,
+    revised_size: int,
+) -> "DiffNode":
+    """
+    Finish the diffpath from the furthest reaching D-path,
+    using a single delta for all the remaining elements.
+    """
+    best = None  # type: Optional[DiffNode]
+    for k in range(-d, d + 1, 2):
+        node = diagonal[middle + k]
+        if node is None or node.i > original_size or node.j > revised_size:
+            continue
+        if best is None or node.i + node.j > best.i + best.j:
+            best = node
+    assert best is not None, "No D-path is inside the graph"
+    return create_diff_node(original_size, revised_size, best)
+
+
+def build_revision(
+    path: "DiffNode", original: List[T], revised: List[T], line_views=False
+) -> Patch:
     """
     Constructs a {@link Patch} from a difference path.
 
     :param path: The path.
     :param original: The original sequence.
     :param revised: The revised sequence.
+    :param line_views: Put views of the sequences in the chunks, instead of copying their lines.
     :exception ValueError: If there is an invalid diffpath
     :return: A Patch corresponding to the path.
     """
@@ -158,8 +268,8 @@ def build_revision(path: "DiffNode", original: List[T], revised: List[T]) -> Pat
         ianchor = path.i
         janchor = path.j
 
-        original_chunk = Chunk(ianchor, original[ianchor:i])
-        revised_chunk = Chunk(janchor, revised[janchor:j])
+        original_chunk = Chunk(ianchor, chunk_lines(original, ianchor, i, line_views))
+        revised_chunk = Chunk(janchor, chunk_lines(revised, janchor, j, line_views))
         delta = Delta.create(original_chunk, revised_chunk)
 
         patch.add_delta(delta)
@@ -168,6 +278,241 @@ def build_revision(path: "DiffNode", original: List[T], revised: List[T]) -> Pat
     return patch
 
 
+def build_linear_revision(
+    original_keys: List[T],
+    revised_keys: List[T],
+    original: List[T],
+    revised: List[T],
+    max_cost: Optional[int] = None,
+    line_views=False,
+) -> Patch:
+    """
+    Computes a minimum diff between the original and revised sequences using linear space.
+
+    Instead of remembering every D-path, we search for the 'middle snake' from both ends at once,
+    then recursively diff the sections before and after the split point.
+    The resulting patch has the same shape as the one from build_revision.
+
+    :param original_keys: The keys to compare for the original sequence.
+    :param revised_keys: The keys to compare for the revised sequence.
+    :param original: The original sequence.
+    :param revised: The revised sequence.
+    :param max_cost: The maximum number of differences to search for when finding each middle snake.
+    :param line_views: Put views of the sequences in the chunks, instead of copying their lines.
+    :return: A Patch describing the differences.
+    """
+    patch = Patch()
+    max_d = (len(original_keys) + len(revised_keys) + 1) // 2 + 1
+    # NOTE: These are shared by every step, which is what keeps us in linear space
+    forward = [-1] * (2 * max_d)
+    backward = [-1] * (2 * max_d)
+    # The pending delta, which may need to be merged with the following one
+    pending = None  # type: Optional[List[int]]
+    # Use an explicit stack instead of recursion, with the left half on top
+    sections = [(0, len(original_keys), 0, len(revised_keys))]
+    while sections:
+        i_start, i_end, j_start, j_end = sections.pop()
+        # Skip the common prefix and suffix
+        while (
+            i_start < i_end
+            and j_start < j_end
+            and original_keys[i_start] == revised_keys[j_start]
+        ):
+            i_start += 1
+            j_start += 1
+        while (
+            i_start < i_end
+            and j_start < j_end
+            and original_keys[i_end - 1] == revised_keys[j_end - 1]
+        ):
+            i_end -= 1
+            j_end -= 1
+        if i_start == i_end or j_start == j_end:
+            if i_start == i_end and j_start == j_end:
+                continue
+            if pending is not None and pending[1] == i_start and pending[3] == j_start:
+                # Adjacent to the previous delta, so they form a single delta
+                pending[1] = i_end
+                pending[3] = j_end
+            else:
+                if pending is not None:
+                    add_linear_delta(patch, pending, original, revised, line_views)
+                pending = [i_start, i_end, j_start, j_end]
+            continue
+        i_split, j_split = find_middle_snake(
+            original_keys,
+            revised_keys,
+            i_start,
+            i_end,
+            j_start,
+            j_end,
+            forward,
+            backward,
+            max_cost=max_cost,
+        )
+        sections.append((i_split, i_end, j_split, j_end))
+        sections.append((i_start, i_split, j_start, j_split))
+    if pending is not None:
+        add_linear_delta(patch, pending, original, revised, line_views)
+    return patch
+
+
+def add_linear_delta(
+    patch: Patch, section: List[int], original, revised, line_views=False
+):
+    i_start, i_end, j_start, j_end = section
+    original_chunk = Chunk(i_start, chunk_lines(original, i_start, i_end, line_views))
+    revised_chunk = Chunk(j_start, chunk_lines(revised, j_start, j_end, line_views))
+    patch.add_delta(Delta.create(original_chunk, revised_chunk))
+
+
+def find_middle_snake(
+    original: List[T],
+    revised: List[T],
+    i_start: int,
+    i_end: int,
+    j_start: int,
+    j_end: int,
+    forward: List[int],
+    backward: List[int],
+    max_cost: Optional[int] = None,
+) -> Tuple[int, int]:
+    """
+    Find the point where the furthest reaching forward and reverse D-paths overlap,
+    which is guaranteed to be on a minimum diffpath.
+
+    The sections must be non-empty, and must not share a common prefix or suffix,
+    which guarantees the split point is strictly inside the section.
+
+    If there are more than max_cost differences, we give up on finding the overlap,
+    and split at the end of whichever path got the furthest instead.
+
+    :return: the split point in the original and revised sequences
+    """
+    original_size = i_end - i_start
+    revised_size = j_end - j_start
+    max_d = (original_size + revised_size + 1) // 2
+    offset = max_d + 1
+    size = 2 * offset
+    # NOTE: Only the diagonals the paths can reach are reset, widening the window at each step,
+    # so a section with few differences doesn't pay for resetting the whole arrays
+    forward[offset - 1] = forward[offset] = -1
+    backward[offset - 1] = backward[offset] = -1
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    delta = original_size - revised_size
+    # If the total number of differences is odd, the forward path will be the first to overlap
+    front = (delta % 2) != 0
+    # When a path runs off the edge of the graph, there is no need to consider those diagonals anymore
+    kforward_start, kforward_end, kbackward_start, kbackward_end = 0, 0, 0, 0
+    for d in range(max_d + 1):
+        if d:
+            forward[offset - d - 1] = backward[offset - d - 1] = -1
+            if d < max_d:
+                forward[offset + d + 1] = backward[offset + d + 1] = -1
+        if max_cost is not None and d > max_cost and d > 1:
+            # NOTE: After two steps at least one of the paths made progress, so the split is inside the section
+            split = heuristic_split(
+                forward, backward, offset, d - 1, original_size, revised_size
+            )
+            if split is not None:
+                return i_start + split[0], j_start + split[1]
+        for k in range(-d + kforward_start, d + 1 - kforward_end, 2):
+            kmiddle = offset + k
+            if k == -d or (k != d and forward[kmiddle - 1] < forward[kmiddle + 1]):
+                i = forward[kmiddle + 1]
+            else:
+                i = forward[kmiddle - 1] + 1
+            j = i - k
+            while (
+                i < original_size
+                and j < revised_size
+                and original[i_start + i] == revised[j_start + j]
+            ):
+                i += 1
+                j += 1
+            forward[kmiddle] = i
+            if i > original_size:
+                kforward_end += 2
+            elif j > revised_size:
+                kforward_start += 2
+            elif front:
+                kother = offset + delta - k
+                # NOTE: Diagonals outside the window weren't reset, so they may be left over from another section
+                if (
+                    -d - 1 <= delta - k <= d + 1
+                    and kother < size
+                    and backward[kother] != -1
+                ):
+                    if i >= original_size - backward[kother]:
+                        return i_start + i, j_start + j
+        for k in range(-d + kbackward_start, d + 1 - kbackward_end, 2):
+            kmiddle = offset + k
+            if k == -d or (k != d and backward[kmiddle - 1] < backward[kmiddle + 1]):
+                i = backward[kmiddle + 1]
+            else:
+                i = backward[kmiddle - 1] + 1
+            j = i - k
+            while (
+                i < original_size
+                and j < revised_size
+                and original[i_end - i - 1] == revised[j_end - j - 1]
+            ):
+                i += 1
+                j += 1
+            backward[kmiddle] = i
+            if i > original_size:
+                kbackward_end += 2
+            elif j > revised_size:
+                kbackward_start += 2
+            elif not front:
+                kother = offset + delta - k
+                if (
+                    -d - 1 <= delta - k <= d + 1
+                    and kother < size
+                    and forward[kother] != -1
+                ):
+                    iforward = forward[kother]
+                    jforward = offset + iforward - kother
+                    if iforward >= original_size - i:
+                        return i_start + iforward, j_start + jforward
+    # According to Myers, this cannot happen
+    raise RuntimeError("couldn't find the middle snake")
+
+
+def heuristic_split(
+    forward: List[int],
+    backward: List[int],
+    offset: int,
+    d: int,
+    original_size: int,
+    revised_size: int,
+) -> Optional[Tuple[int, int]]:
+    """
+    Find the end of the furthest reaching forward or reverse D-path,
+    which is a valid (but not necessarily minimal) point to split the section at.
+
+    :return: the split point relative to the start of the section, or None if it would be at either end
+    """
+    best = None  # type: Optional[Tuple[int, int]]
+    best_progress = 0
+    for k in range(-d, d + 1, 2):
+        for i, reverse in ((forward[offset + k], False), (backward[offset + k], True)):
+            j = i - k
+            progress = i + j
+            if (
+                0 <= i <= original_size
+                and 0 <= j <= revised_size
+                and best_progress < progress < original_size + revised_size
+            ):
+                if reverse:
+                    best = original_size - i, revised_size - j
+                else:
+                    best = i, j
+                best_progress = progress
+    return best
+
+
 class DiffNode:
     """
     A diffnode in a diffpath.
@@ -225,6 +570,10 @@ def create_diff_node(i, j, prev):
     node.prev = prev
     if i < 0 or j < 0:
         node.lastSnake = None
+    elif prev is None:
+        # NOTE: The first node after the bootstrap snake has nothing before it,
+        # so it must anchor itself or we'd lose any delta at the start of the sequences
+        node.lastSnake = node
     else:
         node.lastSnake = prev.lastSnake
     return node
@@ -233,6 +582,10 @@ def create_diff_node(i, j, prev):
 def create_snake(i, j, prev):
     snake = DiffNode(i, j)
     snake.prev = prev
-    snake.lastSnake = snake
+    if i < 0 or j < 0:
+        # Bootstrap snakes aren't part of the path
+        snake.lastSnake = None
+    else:
+        snake.lastSnake = snake
     snake.snake = True
     return snake
@@ -1,3 +1,6 @@
+from libc.stdint cimport uint64_t
+
+
 cdef extern from "hashing/hasher.h":
     ctypedef enum HashAlgorithm:
         SHA_256
@@ -20,3 +23,4 @@ cdef extern from "hashing/hasher.h":
 
     int destroy_hasher(ShaHasher *hasher) nogil;
 
+    uint64_t fast_hash64(const char *data, size_t count) nogil;
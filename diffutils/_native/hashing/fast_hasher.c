@@ -0,0 +1,67 @@
+#include <string.h>
+#include "hasher.h"
+
+/*
+ * A fast non-cryptographic 64-bit hash, using the primes and mixing steps of XXH64.
+ *
+ * Lines are usually short, so we use a single lane instead of XXH64's four,
+ * which gives the same result as XXH64 for inputs shorter than 32 bytes.
+ */
+
+#define PRIME64_1 0x9E3779B185EBCA87ULL
+#define PRIME64_2 0xC2B2AE3D27D4EB4FULL
+#define PRIME64_3 0x165667B19E3779F9ULL
+#define PRIME64_4 0x85EBCA77C2B2AE63ULL
+#define PRIME64_5 0x27D4EB2F165667C5ULL
+
+static inline uint64_t rotl64(uint64_t value, int amount) {
+    return (value << amount) | (value >> (64 - amount));
+}
+
+static inline uint64_t read64(const char *data) {
+    uint64_t result;
+    // NOTE: memcpy avoids unaligned access, and compiles to a single load
+    memcpy(&result, data, sizeof(result));
+    return result;
+}
+
+static inline uint32_t read32(const char *data) {
+    uint32_t result;
+    memcpy(&result, data, sizeof(result));
+    return result;
+}
+
+static inline uint64_t round64(uint64_t acc, uint64_t input) {
+    acc += input * PRIME64_2;
+    acc = rotl64(acc, 31);
+    return acc * PRIME64_1;
+}
+
+uint64_t fast_hash64(const char *data, size_t count) {
+    uint64_t hash = PRIME64_5 + (uint64_t) count;
+    while (count >= 8) {
+        hash ^= round64(0, read64(data));
+        hash = rotl64(hash, 27) * PRIME64_1 + PRIME64_4;
+        data += 8;
+        count -= 8;
+    }
+    if (count >= 4) {
+        hash ^= (uint64_t) read32(data) * PRIME64_1;
+        hash = rotl64(hash, 23) * PRIME64_2 + PRIME64_3;
+        data += 4;
+        count -= 4;
+    }
+    while (count > 0) {
+        hash ^= (uint64_t) (unsigned char) *data * PRIME64_5;
+        hash = rotl64(hash, 11) * PRIME64_1;
+        data++;
+        count--;
+    }
+    // Avalanche, so every input bit affects every output bit
+    hash ^= hash >> 33;
+    hash *= PRIME64_2;
+    hash ^= hash >> 29;
+    hash *= PRIME64_3;
+    hash ^= hash >> 32;
+    return hash;
+}
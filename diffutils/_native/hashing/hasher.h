@@ -1,3 +1,4 @@
+#include <stdint.h>
 #include <stdlib.h>
 
 typedef enum HasherState {
@@ -62,3 +63,10 @@ int update_hasher(ShaHasher *hasher, const char *data, size_t count);
 int finish_hasher(ShaHasher *hasher, char *out, int *size);
 
 int destroy_hasher(ShaHasher *hasher);
+
+/**
+ * Quickly compute a non-cryptographic 64-bit hash of the data.
+ *
+ * Unlike the ShaHasher, collisions are possible, so equal hashes must be verified against the data itself.
+ */
+uint64_t fast_hash64(const char *data, size_t count);
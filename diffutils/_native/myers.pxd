@@ -0,0 +1,53 @@
+from cpython cimport array
+
+
+cdef struct NativeString:
+    size_t size
+    char *data
+    # The bytes per character, which is only more than 1 for strs with the fast hash
+    int width
+
+cdef class BufferLines:
+    cdef Py_buffer view
+    cdef bint has_view
+    cdef bint decode
+    cdef bint has_offsets
+    cdef NativeString *lines
+    cdef readonly Py_ssize_t size
+
+    cdef split_lines(self)
+    cdef use_offsets(self, offsets)
+    cdef NativeString *check_lines(self) except NULL
+    cdef list line_bytes(self)
+    cdef line(self, Py_ssize_t index)
+
+cdef struct Section:
+    int i_start
+    int i_end
+    int j_start
+    int j_end
+
+cdef struct SectionList:
+    size_t size
+    size_t capacity
+    Section *data
+
+cdef enum:
+    LINEAR_DIFF_OUT_OF_MEMORY = 1
+    LINEAR_DIFF_NO_MIDDLE_SNAKE = 2
+
+cdef Section *push_section(SectionList *sections, int i_start, int i_end, int j_start, int j_end) nogil
+
+cdef int add_delta_section(SectionList *deltas, int i_start, int i_end, int j_start, int j_end) nogil
+
+cdef build_section_patch(SectionList *deltas, original, revised, bint line_views)
+
+cdef build_compact_patch(SectionList *deltas, original, revised)
+
+cdef check_linear_diff(int error)
+
+cdef int linear_diff_ids(int *original_ids, int *revised_ids, Section section, SectionList *deltas, int *forward, int *backward, int max_cost) nogil
+
+cdef list interning_keys(lines)
+
+cdef array.array intern_lines(list lines, dict ids)
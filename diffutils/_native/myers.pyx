@@ -1,9 +1,27 @@
-from ..core import Chunk, Delta, Patch
+import warnings
+from os import cpu_count
+
+from ..core import LINE_VIEW_MIN_SIZE, Chunk, CompactPatch, Delta, LineView, Patch
 from ..engine import DiffEngine
 
 from cpython cimport array
+from cpython.buffer cimport PyBUF_SIMPLE, PyBuffer_Release, PyObject_GetBuffer
+from cpython.bytes cimport (
+    PyBytes_AS_STRING,
+    PyBytes_FromStringAndSize,
+    PyBytes_GET_SIZE,
+)
+from cpython.unicode cimport PyUnicode_DecodeUTF8, PyUnicode_GET_LENGTH
+from cython.parallel cimport prange
+from libc.stdint cimport uint64_t
 from libc.stdlib cimport abort, calloc, free, malloc, realloc
-from libc.string cimport memcmp, memmove
+from libc.string cimport memchr, memcmp, memmove, memset
+
+
+cdef extern from "Python.h":
+    const char *PyUnicode_AsUTF8AndSize(object unicode, Py_ssize_t *size) except NULL
+    unsigned int PyUnicode_KIND(object unicode)
+    void *PyUnicode_DATA(object unicode)
 
 IF USE_HASHLIB:
     import hashlib
@@ -13,199 +31,1092 @@ ELSE:
 
 # Hopefully 6KB is enough to start off with
 DEF CHUNK_SIZE = 256
+# The fewest lines worth hashing on another thread
+DEF MIN_LINES_PER_THREAD = 16384
 
-cdef struct NativeString:
-    size_t size
-    char *data
+cdef enum:
+    BUILD_PATH_OUT_OF_MEMORY = 1
+    BUILD_PATH_NOT_FOUND = 2
 
-cpdef native_diff(original, revised):
-    cdef DiffNode *path
-    if type(original) is not list:
-        raise TypeError(f"Original must be a list, not a {type(original)}")
-    if type(revised) is not list:
-        raise TypeError(f"Revised must be a list, not a {type(revised)}")
-    cdef NodeAllocator allocator = NodeAllocator() # NOTE: Python frees this automatically
-    cdef int i
-    cdef size_t original_size = len(original)
-    cdef size_t revised_size = len(revised)
-    # Take the sha256sum of the lines to speed up diffing, since string comparison is one of the main costs
-    # When not USE_HASHLIB, we can actually release the GIL when we hash, further improving performance.
-    cdef char[32] *original_hashes = <char[32]*> malloc(original_size * sizeof(char[32]))
-    if not original_hashes:
-        raise MemoryError()
-    cdef char[32] *revised_hashes =  <char[32]*> malloc(revised_size * sizeof(char[32]))
-    if not revised_hashes:
-        raise MemoryError()
-    IF not USE_HASHLIB:
-        # NOTE: Use calloc so we crash on uninitialized memory
-        cdef NativeString *original_lines = <NativeString*> calloc(original_size, sizeof(NativeString))
-        cdef NativeString *revised_lines = <NativeString*> calloc(revised_size, sizeof(NativeString))
-        cdef ShaHasher *hasher = NULL
-        cdef int err_code
-    cdef bytes element_bytes
-    cdef NativeString *nstring
-    cdef char *string_data
-    cdef char *raw_element_bytes
-    cdef size_t string_size
+ctypedef struct LineHash:
+    char data[32]
+
+ctypedef struct FastLineKey:
+    uint64_t hash
+    # The line itself, since different lines can have the same fast hash
+    NativeString line
+
+# The keys we compare instead of the lines themselves
+ctypedef fused LineKey:
+    LineHash
+    FastLineKey
+    int
+
+cdef inline bint keys_equal(LineKey *first, LineKey *second) nogil:
+    if LineKey is int:
+        return first[0] == second[0]
+    elif LineKey is FastLineKey:
+        # NOTE: Different hashes are by far the most common case, so that's a single comparison
+        return (
+            first.hash == second.hash
+            and first.line.size == second.line.size
+            and first.line.width == second.line.width
+            and memcmp(first.line.data, second.line.data, first.line.size) == 0
+        )
+    else:
+        return memcmp(first.data, second.data, 32) == 0
+
+cdef array.array INT_ARRAY_TEMPLATE = array.array('i')
+
+# Whether large inputs can be hashed on multiple threads, which needs the extension to be built with OpenMP
+OPENMP = bool(USE_OPENMP)
+# Whether lines are compared by a fast 64-bit hash (the default HASH_IMPL), instead of their sha256sum
+FAST_HASH = bool(USE_FAST_HASH)
+
+cpdef native_diff(original, revised, bint linear=False, bint intern_lines=False, max_cost=None, hash_threads=None, hash_cache=None, bint compact=False, bint line_views=False):
+    """
+    Diff the original and revised lines natively.
+
+    The lines can either be lists of str or bytes, or a pair of BufferLines.
+    Unless we're interning, each line is hashed in place without copying it.
+    Large inputs are hashed on hash_threads native threads, which defaults to the number of CPUs.
+    That needs the extension to be built with OpenMP, so otherwise asking for more than one thread warns.
+    If the lines are hashed with sha256, the hashes of lists of lines are reused from the hash_cache (a LineHashCache).
+    If compact is true, the result is a CompactPatch referencing the lists, unless they're BufferLines,
+    which can't be accessed once they're released.
+    If line_views is true, the chunks of a regular patch are LineViews of the lists instead of copies.
+    """
+    cdef bint buffers = type(original) is BufferLines and type(revised) is BufferLines
+    if not buffers:
+        if type(original) is not list:
+            raise TypeError(f"Original must be a list or BufferLines, not a {type(original)}")
+        if type(revised) is not list:
+            raise TypeError(f"Revised must be a list or BufferLines, not a {type(revised)}")
+    # NOTE: Natively, a negative cost means there's no limit
+    cdef int cost_limit = -1 if max_cost is None else max_cost
+    if cost_limit < 0 and max_cost is not None:
+        raise ValueError(f"Invalid max_cost: {max_cost}")
+    if hash_threads is not None and hash_threads < 1:
+        raise ValueError(f"Invalid hash_threads: {hash_threads}")
+    if not USE_OPENMP and hash_threads is not None and hash_threads > 1:
+        warnings.warn(f"Can't hash on {hash_threads} threads, since diffutils was built without OpenMP", RuntimeWarning)
+    if intern_lines:
+        patch = interned_diff(original, revised, linear, cost_limit)
+    else:
+        patch = hashed_diff(original, revised, linear, cost_limit, hash_threads, hash_cache)
+    # NOTE: The diff always builds a compact patch, since that's the cheapest way to collect the deltas
+    if compact and not buffers:
+        return patch
+    return expand_patch(patch, line_views)
+
+cdef hashed_diff(original, revised, bint linear, int max_cost, hash_threads, hash_cache):
+    """
+    Diff the lines by hashing each one, since string comparison is one of the main costs.
+
+    By default this uses a fast 64-bit hash, verifying the lines themselves whenever the hashes match.
+    If the extension was built with a different HASH_IMPL, we take the sha256sum of the lines instead.
+    """
+    cdef Py_ssize_t original_size = len(original)
+    cdef Py_ssize_t revised_size = len(revised)
+    # NOTE: These only point to the data of each line, which is owned by the lines themselves
+    cdef NativeString *original_lines = NULL
+    cdef NativeString *revised_lines = NULL
+    cdef NativeString *original_strings
+    cdef NativeString *revised_strings
+    cdef int kind = 0
+    cdef int num_threads = hash_thread_count(hash_threads, original_size + revised_size)
     try:
-        for (index, element) in enumerate(original):
-            assert index < original_size
-            if type(element) is not str:
-                raise TypeError(f"Element at original index {index} must be a str, not a {type(element)}")
-            element_bytes = element.encode('utf-8')
-            IF USE_HASHLIB:
-                hashlib_sha256sum(element_bytes, len(element_bytes), original_hashes[index])
-            ELSE:
-                string_size = len(element_bytes)
-                string_data = <char*> malloc(string_size + 1)
-                raw_element_bytes = element_bytes
-                memmove(string_data, raw_element_bytes, string_size)
-                string_data[string_size] = '\0'
-                nstring = &original_lines[index]
-                nstring.size = string_size
-                nstring.data = string_data
-        for (index, element) in enumerate(revised):
-            assert index < revised_size
-            if type(element) is not str:
-                raise TypeError(f"Element at revised index {index} must be a str, not a {type(element)}")
-            element_bytes = element.encode('utf-8')
-            IF USE_HASHLIB:
-                hashlib_sha256sum(element_bytes, len(element_bytes), revised_hashes[index])
-            ELSE:
-                string_size = len(element_bytes)
-                string_data = <char*> malloc(string_size + 1)
-                raw_element_bytes = element_bytes
-                memmove(string_data, raw_element_bytes, string_size)
-                string_data[string_size] = '\0'
-                nstring = &revised_lines[index]
-                nstring.size = string_size
-                nstring.data = string_data
-        IF not USE_HASHLIB:
-            hasher = create_hasher(SHA_256)
-            # We can release the GIL while hashing the lines, since we use OpenSSL for hashing
-            failure = False
+        if type(original) is BufferLines:
+            original_strings = (<BufferLines> original).check_lines()
+            revised_strings = (<BufferLines> revised).check_lines()
+        else:
+            original_lines = original_strings = list_native_strings(original, "original", &kind)
+            revised_lines = revised_strings = list_native_strings(revised, "revised", &kind)
+        IF USE_FAST_HASH:
+            return fast_hashed_diff(original_strings, original_size, revised_strings, revised_size, original, revised, linear, max_cost, num_threads)
+        ELSE:
+            return sha256_diff(original_strings, original_size, revised_strings, revised_size, original, revised, linear, max_cost, num_threads, hash_cache)
+    finally:
+        free(original_lines)
+        free(revised_lines)
+
+IF USE_FAST_HASH:
+    cdef fast_hashed_diff(NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t revised_size, original, revised, bint linear, int max_cost, int num_threads):
+        # NOTE: Both sides share a single array, so they can be hashed at the same time
+        cdef FastLineKey *keys = <FastLineKey*> malloc(max(original_size + revised_size, 1) * sizeof(FastLineKey))
+        try:
+            if not keys:
+                raise MemoryError()
             with nogil:
-                for i in range(<int> original_size):
-                    nstring = &original_lines[i]
-                    err_code = native_sha256sum(hasher, nstring.data, nstring.size, original_hashes[i])
-                    if not err_code:
-                        failure = True
-                        break
-                if not failure:
-                    for i in range(<int> revised_size):
-                        nstring = &revised_lines[i]
-                        err_code = native_sha256sum(hasher, nstring.data, nstring.size, revised_hashes[i])
-                        if not err_code:
-                            failure = True
-                            break
-            if failure:
+                fast_hash_native_strings(original_strings, original_size, revised_strings, revised_size, keys, num_threads)
+            return diff_keys(keys, original_size, keys + original_size, revised_size, original, revised, linear, max_cost)
+        finally:
+            free(keys)
+
+    cdef void fast_hash_native_strings(NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t revised_size, FastLineKey *keys, int num_threads) nogil:
+        """Hash the original lines followed by the revised lines, splitting them evenly between the threads"""
+        cdef Py_ssize_t i
+        cdef NativeString *line
+        for i in prange(original_size + revised_size, num_threads=num_threads, schedule="static"):
+            line = combined_line(original_strings, original_size, revised_strings, i)
+            keys[i].hash = fast_hash64(line.data, line.size)
+            keys[i].line = line[0]
+ELSE:
+    cdef sha256_diff(NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t revised_size, original, revised, bint linear, int max_cost, int num_threads, hash_cache):
+        cdef char[32] *hashes = <char[32]*> malloc(max(original_size + revised_size, 1) * sizeof(char[32]))
+        try:
+            if not hashes:
+                raise MemoryError()
+            if hash_cache is not None and type(original) is list:
+                cached_hash_native_strings(original_strings, original_size, revised_strings, revised_size, original + revised, hashes, num_threads, hash_cache)
+            else:
+                hash_native_strings(original_strings, original_size, revised_strings, revised_size, hashes, num_threads)
+            return diff_keys(<LineHash*> hashes, original_size, <LineHash*> (hashes + original_size), revised_size, original, revised, linear, max_cost)
+        finally:
+            free(hashes)
+
+    cdef int cached_hash_native_strings(NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t revised_size, list lines, char[32] *hashes, int num_threads, hash_cache) except 0:
+        """Copy the hashes of the lines that are in the cache, only hashing the missing lines (and adding them to the cache)"""
+        cdef list cached = hash_cache.lookup(lines)
+        cdef Py_ssize_t count = len(lines)
+        cdef Py_ssize_t missing_count = 0
+        cdef Py_ssize_t index
+        # NOTE: The missing lines are hashed together, so they can still be split between the threads
+        cdef NativeString *missing_strings = <NativeString*> malloc(max(count, 1) * sizeof(NativeString))
+        cdef Py_ssize_t *missing_indices = <Py_ssize_t*> malloc(max(count, 1) * sizeof(Py_ssize_t))
+        cdef char[32] *missing_hashes = <char[32]*> malloc(max(count, 1) * sizeof(char[32]))
+        try:
+            if not missing_strings or not missing_indices or not missing_hashes:
+                raise MemoryError()
+            for index in range(count):
+                digest = cached[index]
+                if digest is None:
+                    missing_strings[missing_count] = combined_line(original_strings, original_size, revised_strings, index)[0]
+                    missing_indices[missing_count] = index
+                    missing_count += 1
+                else:
+                    memmove(hashes[index], PyBytes_AS_STRING(digest), 32)
+            if missing_count == 0:
+                return 1
+            hash_native_strings(missing_strings, missing_count, NULL, 0, missing_hashes, max(1, min(num_threads, missing_count // MIN_LINES_PER_THREAD)))
+            for index in range(missing_count):
+                memmove(hashes[missing_indices[index]], missing_hashes[index], 32)
+            hash_cache.add(
+                [lines[missing_indices[index]] for index in range(missing_count)],
+                [PyBytes_FromStringAndSize(missing_hashes[index], 32) for index in range(missing_count)],
+            )
+            return 1
+        finally:
+            free(missing_strings)
+            free(missing_indices)
+            free(missing_hashes)
+
+cdef inline NativeString *combined_line(NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t index) nogil:
+    """The line at the specified index of the original lines followed by the revised lines"""
+    if index < original_size:
+        return &original_strings[index]
+    return &revised_strings[index - original_size]
+
+cdef int hash_thread_count(hash_threads, Py_ssize_t count) except 0:
+    """
+    The number of threads to hash the specified number of lines with.
+
+    Starting threads isn't free, so each thread is given at least MIN_LINES_PER_THREAD lines,
+    which keeps smaller inputs on the current thread.
+    """
+    cdef Py_ssize_t requested = (cpu_count() or 1) if hash_threads is None else hash_threads
+    return <int> max(1, min(requested, count // MIN_LINES_PER_THREAD))
+
+# The kinds of lines that list_native_strings accepts
+cdef enum:
+    NO_LINES = 0
+    STR_LINES = 1
+    BYTES_LINES = 2
+
+cdef NativeString *list_native_strings(list lines, side, int *kind) except NULL:
+    """
+    Point to the raw data of each line, without copying it.
+
+    Bytes are used as they are. With the fast hash, strings use their own representation,
+    which has 1, 2 or 4 bytes per character (kept in the width, since each kind can have the same bytes).
+    Python always uses the narrowest kind that fits, so equal strings have the same width and data.
+    Otherwise strings use their UTF-8 representation, so the sha256sums match the plain engines.
+    Python caches that in the string for as long as it's alive, which is the string itself if it's ASCII,
+    but doubles the memory used by other strings.
+    Since 'a' and b'a' have the same data, every line must be the same kind as the first one,
+    which is kept in kind so both sides of a diff can be checked.
+    The result must be freed, and is only valid while the lines are alive.
+    """
+    cdef Py_ssize_t size = len(lines)
+    cdef NativeString *result = <NativeString*> malloc(max(size, 1) * sizeof(NativeString))
+    if not result:
+        raise MemoryError()
+    cdef Py_ssize_t index, line_size
+    cdef const char *data
+    cdef int line_kind, width
+    try:
+        for index in range(size):
+            element = lines[index]
+            width = 1
+            if type(element) is unicode:
+                IF USE_FAST_HASH:
+                    width = PyUnicode_KIND(element)
+                    data = <const char*> PyUnicode_DATA(element)
+                    line_size = PyUnicode_GET_LENGTH(element) * width
+                ELSE:
+                    data = PyUnicode_AsUTF8AndSize(element, &line_size)
+                line_kind = STR_LINES
+            elif type(element) is bytes:
+                data = PyBytes_AS_STRING(element)
+                line_size = PyBytes_GET_SIZE(element)
+                line_kind = BYTES_LINES
+            else:
+                raise TypeError(f"Element at {side} index {index} must be a str or bytes, not a {type(element)}")
+            if kind[0] == NO_LINES:
+                kind[0] = line_kind
+            elif kind[0] != line_kind:
+                raise TypeError(f"Lines must all be str or all be bytes, but the element at {side} index {index} is a {type(element)}")
+            result[index].data = <char*> data
+            result[index].size = line_size
+            result[index].width = width
+    except:
+        free(result)
+        raise
+    return result
+
+IF not USE_FAST_HASH:
+    cdef int hash_native_strings(NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t revised_size, char[32] *hashes, int num_threads) except 0:
+        """
+        Take the sha256sum of the original lines followed by the revised lines, releasing the GIL if we can.
+
+        Each thread hashes a contiguous block of the lines, with its own hasher.
+        """
+        cdef Py_ssize_t count = original_size + revised_size
+        cdef Py_ssize_t i
+        cdef NativeString *line
+        IF USE_HASHLIB:
+            for i in range(count):
+                line = combined_line(original_strings, original_size, revised_strings, i)
+                hashlib_sha256sum(line.data, line.size, hashes[i])
+        ELSE:
+            cdef Py_ssize_t block_size = (count + num_threads - 1) // num_threads
+            cdef Py_ssize_t block, start, end
+            cdef int failures = 0
+            for block in prange(num_threads, num_threads=num_threads, schedule="static", nogil=True):
+                start = block * block_size
+                end = min(start + block_size, count)
+                failures += hash_block(original_strings, original_size, revised_strings, start, end, hashes)
+            if failures:
                 raise RuntimeError(hasher_error_msg(hasher_error_code))
-        path = build_path(allocator, original_hashes, original_size, revised_hashes, revised_size)
-        if not path:
-            raise MemoryError()
-        return build_revision(path, original, revised)
-    finally:
-        free(original_hashes)
-        free(revised_hashes)
-        IF not USE_HASHLIB:
-            free(original_lines)
-            free(revised_lines)
-            if hasher:
-                destroy_hasher(hasher)
-
-cdef DiffNode* build_path(NodeAllocator allocator, char[32] *original_hashes, int original_size, char[32] *revised_hashes, int revised_size):
+        return 1
+
+IF not USE_HASHLIB and not USE_FAST_HASH:
+    cdef int hash_block(NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t start, Py_ssize_t end, char[32] *hashes) nogil:
+        """Hash the lines from start to end with a new hasher, returning the number of failures"""
+        cdef ShaHasher *hasher = create_hasher(SHA_256)
+        if hasher == NULL:
+            return 1
+        cdef int failures = 0 if hash_range(hasher, original_strings, original_size, revised_strings, start, end, hashes) else 1
+        destroy_hasher(hasher)
+        return failures
+
+    cdef bint hash_range(ShaHasher *hasher, NativeString *original_strings, Py_ssize_t original_size, NativeString *revised_strings, Py_ssize_t start, Py_ssize_t end, char[32] *hashes) nogil:
+        """Hash the lines from start to end, returning if it was successful"""
+        cdef Py_ssize_t i
+        cdef NativeString *line
+        for i in range(start, end):
+            line = combined_line(original_strings, original_size, revised_strings, i)
+            if not native_sha256sum(hasher, line.data, line.size, hashes[i]):
+                return False
+        return True
+
+cdef interned_diff(original, revised, bint linear, int max_cost):
+    """
+    Diff the lines by mapping each distinct line to a dense integer id,
+    which makes comparison a single integer compare without any possibility of collisions.
+
+    Unlike hashing, this works with any hashable elements.
+    """
+    # NOTE: The ids must be shared by both sides, so identical lines get identical ids
+    cdef dict ids = {}
+    cdef array.array original_ids = intern_lines(interning_keys(original), ids)
+    cdef array.array revised_ids = intern_lines(interning_keys(revised), ids)
+    return diff_keys(original_ids.data.as_ints, len(original), revised_ids.data.as_ints, len(revised), original, revised, linear, max_cost)
+
+cdef list interning_keys(lines):
+    """The objects to intern for each line, which are the raw bytes for lines in a buffer"""
+    if type(lines) is BufferLines:
+        return (<BufferLines> lines).line_bytes()
+    return lines
+
+cdef array.array intern_lines(list lines, dict ids):
+    """Give each line the id of its first occurrence in the table, adding it if it's missing"""
+    cdef array.array result = array.clone(INT_ARRAY_TEMPLATE, len(lines), zero=False)
+    cdef int *data = result.data.as_ints
+    cdef Py_ssize_t index
+    for index in range(len(lines)):
+        line = lines[index]
+        key = ids.get(line)
+        if key is None:
+            key = len(ids)
+            ids[line] = key
+        data[index] = key
+    return result
+
+cdef diff_keys(LineKey *original_keys, int original_size, LineKey *revised_keys, int revised_size, original, revised, bint linear, int max_cost):
+    """
+    Diff the lines by comparing the corresponding keys.
+
+    If max_cost isn't negative, we give up on finding the minimum diff after that many differences.
+    """
+    cdef DiffNode *path
+    cdef NodeAllocator allocator
+    if linear:
+        # Use the linear space variant, which never needs the allocator
+        return build_linear_revision(original_keys, original_size, revised_keys, revised_size, original, revised, max_cost)
+    allocator = NodeAllocator() # NOTE: Python frees this automatically
+    path = build_path(allocator, original_keys, original_size, revised_keys, revised_size, max_cost)
+    if not path:
+        raise MemoryError()
+    return build_revision(path, original, revised)
+
+cdef DiffNode* build_path(NodeAllocator allocator, LineKey *original_keys, int original_size, LineKey *revised_keys, int revised_size, int max_cost):
     assert original_size >= 0 and revised_size >= 0
-    cdef int max_size = original_size + revised_size + 1
-    cdef int size = 1 + 2 * max_size
-    cdef int middle = size // 2
-    assert max_size >= 0 and size >= 0 and middle >= 0
     # NOTE: Must use calloc to initialize to null
     # Also, we need to make sure this is an array of POINTERS, since that's what the allocator hands out
-    cdef DiffNode **diagonal = <DiffNode**> calloc(size, sizeof(DiffNode*))
+    cdef DiffNode **diagonal = <DiffNode**> calloc(diagonal_size(original_size, revised_size), sizeof(DiffNode*))
     if not diagonal:
         return NULL
+    cdef DiffNode *path = NULL
+    cdef int error
+    try:
+        with nogil:
+            error = search_path(allocator, diagonal, original_keys, original_size, revised_keys, revised_size, max_cost, &path)
+        if error == BUILD_PATH_NOT_FOUND:
+            # According to Myers, this cannot happen
+            raise RuntimeError("couldn't find a diff path")
+        return path
+    finally:
+        free(diagonal)
+
+cdef inline int diagonal_size(int original_size, int revised_size) nogil:
+    """The number of diagonals build_path needs, which is every k from -max_size to max_size"""
+    return 1 + 2 * (original_size + revised_size + 1)
+
+cdef int search_path(NodeAllocator allocator, DiffNode **diagonal, LineKey *original_keys, int original_size, LineKey *revised_keys, int revised_size, int max_cost, DiffNode **path) nogil:
+    """
+    Search for the shortest path through the edit graph, using the zeroed diagonal array.
+
+    Returns zero on success, or the reason we couldn't find the path.
+    """
+    cdef int max_size = original_size + revised_size + 1
+    cdef int middle = diagonal_size(original_size, revised_size) // 2
     cdef int k, d, kmiddle, kplus, kminus, i, j
     cdef DiffNode *prev
     cdef DiffNode *node
+    node = allocator.create_snake(0, -1, NULL)
+    if node == NULL:
+        return BUILD_PATH_OUT_OF_MEMORY
+    diagonal[middle + 1] = node
+
+    for d in range(max_size):
+        if 0 <= max_cost < d:
+            # Too expensive, so finish with one big delta from the furthest reaching D-path
+            path[0] = finish_path(allocator, diagonal, middle, d - 1, original_size, revised_size)
+            return BUILD_PATH_OUT_OF_MEMORY if path[0] == NULL else 0
+        for k in range(-d, d + 1, 2):
+            kmiddle = middle + k
+            kplus = kmiddle + 1
+            kminus = kmiddle - 1
+            prev = NULL
+
+            # For some reason this works, but not the other ways
+            if (k == -d) or (k != d and diagonal[kminus].i < diagonal[kplus].i):
+                i = diagonal[kplus].i
+                prev = diagonal[kplus]
+            else:
+                i = diagonal[kminus].i + 1
+                prev = diagonal[kminus]
+
+            diagonal[kminus] = NULL
+
+            j = i - k
+
+            node = allocator.create_node(i, j, prev)
+            if node == NULL:
+                return BUILD_PATH_OUT_OF_MEMORY
+
+            # orig and rev are zero-based
+            # but the algorithm is one-based
+            # that's why there's no +1 when indexing the sequences
+            while i < original_size and j < revised_size and keys_equal(&original_keys[i], &revised_keys[j]):
+                i += 1
+                j += 1
+            if i > node.i:
+                node = allocator.create_snake(i, j, node)
+                if node == NULL:
+                    return BUILD_PATH_OUT_OF_MEMORY
+
+            diagonal[kmiddle] = node
+
+            if i >= original_size and j >= revised_size:
+                path[0] = diagonal[kmiddle]
+                return 0
+
+            k += 2
+
+        diagonal[middle + d - 1] = NULL
+    return BUILD_PATH_NOT_FOUND
+
+cdef DiffNode *finish_path(NodeAllocator allocator, DiffNode **diagonal, int middle, int d, int original_size, int revised_size) nogil:
+    """Finish the diffpath from the furthest reaching D-path, using a single delta for all the remaining elements"""
+    cdef DiffNode *best = NULL
+    cdef DiffNode *node
+    cdef int k
+    for k in range(-d, d + 1, 2):
+        node = diagonal[middle + k]
+        if node == NULL or node.i > original_size or node.j > revised_size:
+            continue
+        if best == NULL or node.i + node.j > best.i + best.j:
+            best = node
+    if best == NULL:
+        return NULL
+    return allocator.create_node(original_size, revised_size, best)
+
+cdef build_revision(DiffNode *path, original, revised):
+    """Build a compact patch from the deltas along the path"""
+    cdef SectionList deltas
+    deltas.size, deltas.capacity, deltas.data = 0, 0, NULL
+    if path.snake:
+        path = path.prev
+    cdef int i, j
+    cdef size_t index
+    cdef Section swapped
+    try:
+        while path != NULL and path.prev != NULL and path.prev.j >= 0:
+            if path.snake:
+                raise ValueError("Found snake when looking for diff")
+            i = path.i
+            j = path.j
+            path = path.prev
+            if push_section(&deltas, path.i, i, path.j, j) == NULL:
+                raise MemoryError()
+            if path.snake:
+                path = path.prev
+        # NOTE: The path goes backwards, so the deltas need to be reversed
+        for index in range(deltas.size // 2):
+            swapped = deltas.data[index]
+            deltas.data[index] = deltas.data[deltas.size - 1 - index]
+            deltas.data[deltas.size - 1 - index] = swapped
+        return build_compact_patch(&deltas, original, revised)
+    finally:
+        free(deltas.data)
+
+cdef Section *push_section(SectionList *sections, int i_start, int i_end, int j_start, int j_end) nogil:
+    """Push a new section onto the list, returning NULL if we're out of memory"""
+    cdef size_t new_capacity
+    cdef Section *new_data
+    if sections.size >= sections.capacity:
+        new_capacity = sections.capacity * 2 if sections.capacity else 16
+        new_data = <Section*> realloc(sections.data, new_capacity * sizeof(Section))
+        if not new_data:
+            return NULL
+        sections.data = new_data
+        sections.capacity = new_capacity
+    cdef Section *section = &sections.data[sections.size]
+    sections.size += 1
+    section.i_start = i_start
+    section.i_end = i_end
+    section.j_start = j_start
+    section.j_end = j_end
+    return section
+
+cdef int add_delta_section(SectionList *deltas, int i_start, int i_end, int j_start, int j_end) nogil:
+    """Add a delta, merging it with the previous one if they're adjacent. Returns zero if we're out of memory"""
+    cdef Section *pending = &deltas.data[deltas.size - 1] if deltas.size > 0 else NULL
+    if pending != NULL and pending.i_end == i_start and pending.j_end == j_start:
+        pending.i_end = i_end
+        pending.j_end = j_end
+        return 1
+    return push_section(deltas, i_start, i_end, j_start, j_end) != NULL
+
+cdef int line_view_min_size = LINE_VIEW_MIN_SIZE
+
+cdef chunk_lines(lines, int start, int stop, bint line_views):
+    """The lines[start:stop] of a chunk, which are copied unless line_views is true and there are enough of them"""
+    # NOTE: BufferLines can't be accessed after they're released, so they're always copied
+    if not line_views or stop - start < line_view_min_size or type(lines) is not list:
+        return lines[start:stop]
+    return LineView(lines, start, stop)
+
+cdef build_section_patch(SectionList *deltas, original, revised, bint line_views):
+    """Build a patch from the sections of the original and revised lines that differ"""
+    patch = Patch()
+    cdef Section current
+    cdef size_t index
+    for index in range(deltas.size):
+        current = deltas.data[index]
+        original_chunk = Chunk(current.i_start, chunk_lines(original, current.i_start, current.i_end, line_views))
+        revised_chunk = Chunk(current.j_start, chunk_lines(revised, current.j_start, current.j_end, line_views))
+        patch.add_delta(Delta.create(original_chunk, revised_chunk))
+    return patch
+
+cdef build_compact_patch(SectionList *deltas, original, revised):
+    """Build a compact patch from the sections of the original and revised lines that differ, without building any deltas"""
+    cdef array.array original_positions = array.clone(INT_ARRAY_TEMPLATE, deltas.size, zero=False)
+    cdef array.array original_lengths = array.clone(INT_ARRAY_TEMPLATE, deltas.size, zero=False)
+    cdef array.array revised_positions = array.clone(INT_ARRAY_TEMPLATE, deltas.size, zero=False)
+    cdef array.array revised_lengths = array.clone(INT_ARRAY_TEMPLATE, deltas.size, zero=False)
+    cdef Section current
+    cdef size_t index
+    for index in range(deltas.size):
+        current = deltas.data[index]
+        original_positions.data.as_ints[index] = current.i_start
+        original_lengths.data.as_ints[index] = current.i_end - current.i_start
+        revised_positions.data.as_ints[index] = current.j_start
+        revised_lengths.data.as_ints[index] = current.j_end - current.j_start
+    return CompactPatch(original, revised, original_positions, original_lengths, revised_positions, revised_lengths)
+
+cdef expand_patch(patch, bint line_views):
+    """Build a regular patch from a compact patch that was just diffed"""
+    cdef array.array original_positions = patch.original_positions
+    cdef array.array original_lengths = patch.original_lengths
+    cdef array.array revised_positions = patch.revised_positions
+    cdef array.array revised_lengths = patch.revised_lengths
+    original, revised = patch.original, patch.revised
+    result = Patch()
+    cdef int original_position, revised_position
+    cdef Py_ssize_t index
+    for index in range(len(original_positions)):
+        original_position = original_positions.data.as_ints[index]
+        revised_position = revised_positions.data.as_ints[index]
+        original_chunk = Chunk(original_position, chunk_lines(original, original_position, original_position + original_lengths.data.as_ints[index], line_views))
+        revised_chunk = Chunk(revised_position, chunk_lines(revised, revised_position, revised_position + revised_lengths.data.as_ints[index], line_views))
+        result.add_delta(Delta.create(original_chunk, revised_chunk))
+    return result
+
+cdef build_linear_revision(LineKey *original_keys, int original_size, LineKey *revised_keys, int revised_size, original, revised, int max_cost):
+    """
+    Compute a minimum diff using the linear space variant of Myers algorithm.
+
+    Instead of remembering every D-path, we search for the 'middle snake' from both ends at once,
+    then diff the sections before and after the split point.
+    """
+    assert original_size >= 0 and revised_size >= 0
+    cdef int max_d = (original_size + revised_size + 1) // 2 + 1
+    # NOTE: These are shared by every step, which is what keeps us in linear space
+    cdef int *forward = <int*> malloc(2 * max_d * sizeof(int))
+    cdef int *backward = <int*> malloc(2 * max_d * sizeof(int))
+    cdef SectionList deltas
+    deltas.size, deltas.capacity, deltas.data = 0, 0, NULL
+    cdef Section whole
+    whole.i_start, whole.i_end, whole.j_start, whole.j_end = 0, original_size, 0, revised_size
+    cdef int error
     try:
+        if not forward or not backward:
+            raise MemoryError()
         with nogil:
-            node = allocator.create_snake(0, -1, NULL)
-            if node == NULL:
-                return NULL
-            diagonal[middle + 1] = node
-        
-            for d in range(max_size):
-                for k in range(-d, d + 1, 2):
-                    kmiddle = middle + k
-                    kplus = kmiddle + 1
-                    kminus = kmiddle - 1
-                    prev = NULL
-
-                    # For some reason this works, but not the other ways
-                    if (k == -d) or (k != d and diagonal[kminus].i < diagonal[kplus].i):
-                        i = diagonal[kplus].i
-                        prev = diagonal[kplus]
-                    else:
-                        i = diagonal[kminus].i + 1
-                        prev = diagonal[kminus]
-
-                    diagonal[kminus] = NULL
-
-                    j = i - k
-
-                    node = allocator.create_node(i, j, prev)
-                    if node == NULL:
-                        return NULL
-
-                    # orig and rev are zero-based
-                    # but the algorithm is one-based
-                    # that's why there's no +1 when indexing the sequences
-                    while i < original_size and j < revised_size and (memcmp(original_hashes[i], revised_hashes[j], 32) == 0):
-                        i += 1
-                        j += 1
-                    if i > node.i:
-                        node = allocator.create_snake(i, j, node)
-                        if node == NULL:
-                            return NULL
-
-                    diagonal[kmiddle] = node
-
-                    if i >= original_size and j >= revised_size:
-                        return diagonal[kmiddle]
-
-                    k += 2
-
-                diagonal[middle + d - 1] = NULL
+            error = linear_diff(original_keys, revised_keys, whole, &deltas, forward, backward, max_cost)
+        check_linear_diff(error)
+        return build_compact_patch(&deltas, original, revised)
+    finally:
+        free(forward)
+        free(backward)
+        free(deltas.data)
 
+cdef check_linear_diff(int error):
+    if error == LINEAR_DIFF_OUT_OF_MEMORY:
+        raise MemoryError()
+    elif error == LINEAR_DIFF_NO_MIDDLE_SNAKE:
         # According to Myers, this cannot happen
-        raise RuntimeError("couldn't find a diff path")
+        raise RuntimeError("couldn't find the middle snake")
+
+IF USE_FAST_HASH:
+    ctypedef FastLineKey BatchKey
+ELSE:
+    ctypedef LineHash BatchKey
+
+cdef enum:
+    BATCH_HASH_FAILED = 3
+
+cdef struct BatchJob:
+    NativeString *original_strings
+    NativeString *revised_strings
+    int original_size
+    int revised_size
+    # The keys of the original lines followed by the revised lines
+    BatchKey *keys
+    SectionList deltas
+
+cpdef list native_diff_batch(list pairs, bint linear=False, max_cost=None):
+    """
+    Diff each (original, revised) pair of lists, returning their patches in the same order.
+
+    Only collecting the lines and building the patches need the GIL.
+    All the pairs are hashed and diffed in a single native loop, which reuses the same buffers
+    (and node allocator) for every pair, so other threads can diff their own batches in parallel.
+    """
+    cdef int cost_limit = -1 if max_cost is None else max_cost
+    if cost_limit < 0 and max_cost is not None:
+        raise ValueError(f"Invalid max_cost: {max_cost}")
+    cdef Py_ssize_t count = len(pairs)
+    cdef Py_ssize_t index, total_lines = 0
+    cdef BatchJob *jobs = <BatchJob*> calloc(max(count, 1), sizeof(BatchJob))
+    cdef BatchJob *job
+    cdef BatchKey *keys = NULL
+    cdef NodeAllocator allocator = None if linear else NodeAllocator()
+    cdef int error, kind
+    cdef list result
+    if not jobs:
+        raise MemoryError()
+    try:
+        for index in range(count):
+            original, revised = pairs[index]
+            if type(original) is not list:
+                raise TypeError(f"Original at index {index} must be a list, not a {type(original)}")
+            if type(revised) is not list:
+                raise TypeError(f"Revised at index {index} must be a list, not a {type(revised)}")
+            job = &jobs[index]
+            job.original_size = len(original)
+            job.revised_size = len(revised)
+            kind = NO_LINES
+            job.original_strings = list_native_strings(original, "original", &kind)
+            job.revised_strings = list_native_strings(revised, "revised", &kind)
+            total_lines += job.original_size + job.revised_size
+        # NOTE: Every pair's keys come from a single allocation
+        keys = <BatchKey*> malloc(max(total_lines, 1) * sizeof(BatchKey))
+        if not keys:
+            raise MemoryError()
+        total_lines = 0
+        for index in range(count):
+            job = &jobs[index]
+            job.keys = keys + total_lines
+            total_lines += job.original_size + job.revised_size
+            IF USE_HASHLIB:
+                # NOTE: hashlib needs the GIL, so we can't hash in the native loop
+                hash_native_strings(job.original_strings, job.original_size, job.revised_strings, job.revised_size, <char[32]*> job.keys, 1)
+        with nogil:
+            error = diff_batch_jobs(jobs, count, linear, cost_limit, allocator)
+        check_batch_error(error, linear)
+        result = []
+        for index in range(count):
+            original, revised = pairs[index]
+            result.append(build_section_patch(&jobs[index].deltas, original, revised, False))
+        return result
     finally:
-        free(diagonal)
+        for index in range(count):
+            free(jobs[index].original_strings)
+            free(jobs[index].revised_strings)
+            free(jobs[index].deltas.data)
+        free(jobs)
+        free(keys)
 
+cdef int diff_batch_jobs(BatchJob *jobs, Py_ssize_t count, bint linear, int max_cost, NodeAllocator allocator) nogil:
+    """Hash and diff each job, stopping at the first error"""
+    # NOTE: These only grow, so a batch of similar pairs allocates them once
+    cdef int *forward = NULL
+    cdef int *backward = NULL
+    cdef DiffNode **diagonal = NULL
+    cdef size_t capacity = 0
+    cdef size_t needed
+    cdef void *new_data
+    cdef BatchJob *job
+    cdef DiffNode *path
+    cdef Section whole
+    cdef Py_ssize_t index
+    cdef int error = 0
+    IF USE_FAST_HASH:
+        cdef Py_ssize_t i
+        cdef NativeString *line
+    ELIF not USE_HASHLIB:
+        cdef ShaHasher *hasher = create_hasher(SHA_256)
+        if hasher == NULL:
+            return BATCH_HASH_FAILED
+    for index in range(count):
+        job = &jobs[index]
+        IF USE_FAST_HASH:
+            for i in range(job.original_size + job.revised_size):
+                line = combined_line(job.original_strings, job.original_size, job.revised_strings, i)
+                job.keys[i].hash = fast_hash64(line.data, line.size)
+                job.keys[i].line = line[0]
+        ELIF not USE_HASHLIB:
+            if not hash_range(hasher, job.original_strings, job.original_size, job.revised_strings, 0, job.original_size + job.revised_size, <char[32]*> job.keys):
+                error = BATCH_HASH_FAILED
+                break
+        if linear:
+            needed = 2 * ((job.original_size + job.revised_size + 1) // 2 + 1)
+        else:
+            needed = diagonal_size(job.original_size, job.revised_size)
+        if needed > capacity:
+            if linear:
+                new_data = realloc(forward, needed * sizeof(int))
+                if new_data:
+                    forward = <int*> new_data
+                    new_data = realloc(backward, needed * sizeof(int))
+                    if new_data:
+                        backward = <int*> new_data
+            else:
+                new_data = realloc(diagonal, needed * sizeof(DiffNode*))
+                if new_data:
+                    diagonal = <DiffNode**> new_data
+            if not new_data:
+                error = BUILD_PATH_OUT_OF_MEMORY
+                break
+            capacity = needed
+        if linear:
+            whole.i_start, whole.i_end, whole.j_start, whole.j_end = 0, job.original_size, 0, job.revised_size
+            error = linear_diff(job.keys, job.keys + job.original_size, whole, &job.deltas, forward, backward, max_cost)
+        else:
+            memset(diagonal, 0, needed * sizeof(DiffNode*))
+            error = search_path(allocator, diagonal, job.keys, job.original_size, job.keys + job.original_size, job.revised_size, max_cost, &path)
+            if not error and not path_sections(path, &job.deltas):
+                error = BUILD_PATH_OUT_OF_MEMORY
+            allocator.reset()
+        if error:
+            break
+    IF not USE_HASHLIB and not USE_FAST_HASH:
+        destroy_hasher(hasher)
+    free(forward)
+    free(backward)
+    free(diagonal)
+    return error
 
-cdef build_revision(DiffNode *path, list original, list revised):
-    patch = Patch()
+cdef check_batch_error(int error, bint linear):
+    if error == BATCH_HASH_FAILED:
+        IF not USE_HASHLIB and not USE_FAST_HASH:
+            raise RuntimeError(hasher_error_msg(hasher_error_code))
+    elif linear:
+        check_linear_diff(error)
+    elif error == BUILD_PATH_OUT_OF_MEMORY:
+        raise MemoryError()
+    elif error == BUILD_PATH_NOT_FOUND:
+        # According to Myers, this cannot happen
+        raise RuntimeError("couldn't find a diff path")
+
+cdef int path_sections(DiffNode *path, SectionList *deltas) nogil:
+    """Add the deltas along the path in order, like build_revision. Returns zero if we're out of memory"""
+    cdef size_t first = deltas.size
+    cdef size_t last
+    cdef Section temp
+    cdef int i, j
     if path.snake:
         path = path.prev
-    cdef int i, j, ianchor, janchor
     while path != NULL and path.prev != NULL and path.prev.j >= 0:
-        if path.snake:
-            raise ValueError("Found snake when looking for diff")
         i = path.i
         j = path.j
-
         path = path.prev
-        ianchor = path.i
-        janchor = path.j
-
-        original_chunk = Chunk(ianchor, original[ianchor:i])
-        revised_chunk = Chunk(janchor, revised[janchor:j])
-        delta = Delta.create(original_chunk, revised_chunk)
-
-        patch.add_delta(delta)
+        if not push_section(deltas, path.i, i, path.j, j):
+            return 0
         if path.snake:
             path = path.prev
-    return patch
+    # The path runs from the end, so the deltas need to be reversed
+    if deltas.size > first:
+        last = deltas.size - 1
+        while first < last:
+            temp = deltas.data[first]
+            deltas.data[first] = deltas.data[last]
+            deltas.data[last] = temp
+            first += 1
+            last -= 1
+    return 1
+
+cdef int linear_diff_ids(int *original_ids, int *revised_ids, Section section, SectionList *deltas, int *forward, int *backward, int max_cost) nogil:
+    return linear_diff(original_ids, revised_ids, section, deltas, forward, backward, max_cost)
+
+cdef int linear_diff(LineKey *original_keys, LineKey *revised_keys, Section section, SectionList *deltas, int *forward, int *backward, int max_cost) nogil:
+    """
+    Add the deltas between the original and revised keys in the section, using the linear space variant of Myers.
+
+    The forward and backward arrays must have room for at least `2 * ((N + M + 1) // 2 + 1)` elements,
+    where N and M are the sizes of the section.
+    If max_cost isn't negative, each middle snake search gives up after that many differences.
+    """
+    cdef SectionList sections
+    sections.size, sections.capacity, sections.data = 0, 0, NULL
+    cdef Section current
+    cdef int i_split, j_split
+    cdef int error = 0
+    if not push_section(&sections, section.i_start, section.i_end, section.j_start, section.j_end):
+        error = LINEAR_DIFF_OUT_OF_MEMORY
+    while sections.size > 0 and not error:
+        # Pop the top section, which is always the leftmost remaining
+        sections.size -= 1
+        current = sections.data[sections.size]
+        # Skip the common prefix and suffix
+        while current.i_start < current.i_end and current.j_start < current.j_end and keys_equal(&original_keys[current.i_start], &revised_keys[current.j_start]):
+            current.i_start += 1
+            current.j_start += 1
+        while current.i_start < current.i_end and current.j_start < current.j_end and keys_equal(&original_keys[current.i_end - 1], &revised_keys[current.j_end - 1]):
+            current.i_end -= 1
+            current.j_end -= 1
+        if current.i_start == current.i_end or current.j_start == current.j_end:
+            if current.i_start == current.i_end and current.j_start == current.j_end:
+                continue
+            if not add_delta_section(deltas, current.i_start, current.i_end, current.j_start, current.j_end):
+                error = LINEAR_DIFF_OUT_OF_MEMORY
+            continue
+        if not find_middle_snake(original_keys, revised_keys, current, forward, backward, max_cost, &i_split, &j_split):
+            error = LINEAR_DIFF_NO_MIDDLE_SNAKE
+            break
+        if not push_section(&sections, i_split, current.i_end, j_split, current.j_end):
+            error = LINEAR_DIFF_OUT_OF_MEMORY
+        elif not push_section(&sections, current.i_start, i_split, current.j_start, j_split):
+            error = LINEAR_DIFF_OUT_OF_MEMORY
+    free(sections.data)
+    return error
+
+cdef int find_middle_snake(LineKey *original_keys, LineKey *revised_keys, Section section, int *forward, int *backward, int max_cost, int *i_split, int *j_split) nogil:
+    """
+    Find the point where the furthest reaching forward and reverse D-paths overlap,
+    which is guaranteed to be on a minimum diffpath.
+
+    The section must be non-empty, and must not have a common prefix or suffix.
+    If there are more than max_cost differences (and it isn't negative),
+    we split at the end of whichever path got the furthest instead.
+    Returns zero if no split point could be found.
+    """
+    cdef int original_size = section.i_end - section.i_start
+    cdef int revised_size = section.j_end - section.j_start
+    cdef int max_d = (original_size + revised_size + 1) // 2
+    cdef int offset = max_d + 1
+    cdef int size = 2 * offset
+    cdef int d, k, kmiddle, kother, i, j
+    # NOTE: Only the diagonals the paths can reach are reset, widening the window at each step,
+    # so a section with few differences doesn't pay for resetting the whole arrays
+    forward[offset - 1] = forward[offset] = -1
+    backward[offset - 1] = backward[offset] = -1
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    cdef int delta = original_size - revised_size
+    # If the total number of differences is odd, the forward path will be the first to overlap
+    cdef bint front = (delta % 2) != 0
+    # When a path runs off the edge of the graph, there is no need to consider those diagonals anymore
+    cdef int kforward_start = 0, kforward_end = 0, kbackward_start = 0, kbackward_end = 0
+    for d in range(max_d + 1):
+        if d:
+            forward[offset - d - 1] = backward[offset - d - 1] = -1
+            if d < max_d:
+                forward[offset + d + 1] = backward[offset + d + 1] = -1
+        # NOTE: After two steps at least one of the paths made progress, so the split is inside the section
+        if 0 <= max_cost < d and d > 1:
+            if heuristic_split(forward, backward, offset, d - 1, original_size, revised_size, i_split, j_split):
+                i_split[0] += section.i_start
+                j_split[0] += section.j_start
+                return 1
+        for k in range(-d + kforward_start, d + 1 - kforward_end, 2):
+            kmiddle = offset + k
+            if k == -d or (k != d and forward[kmiddle - 1] < forward[kmiddle + 1]):
+                i = forward[kmiddle + 1]
+            else:
+                i = forward[kmiddle - 1] + 1
+            j = i - k
+            while i < original_size and j < revised_size and keys_equal(&original_keys[section.i_start + i], &revised_keys[section.j_start + j]):
+                i += 1
+                j += 1
+            forward[kmiddle] = i
+            if i > original_size:
+                kforward_end += 2
+            elif j > revised_size:
+                kforward_start += 2
+            elif front:
+                kother = offset + delta - k
+                # NOTE: Diagonals outside the window weren't reset, so they may be left over from another section
+                if -d - 1 <= delta - k <= d + 1 and kother < size and backward[kother] != -1:
+                    if i >= original_size - backward[kother]:
+                        i_split[0] = section.i_start + i
+                        j_split[0] = section.j_start + j
+                        return 1
+        for k in range(-d + kbackward_start, d + 1 - kbackward_end, 2):
+            kmiddle = offset + k
+            if k == -d or (k != d and backward[kmiddle - 1] < backward[kmiddle + 1]):
+                i = backward[kmiddle + 1]
+            else:
+                i = backward[kmiddle - 1] + 1
+            j = i - k
+            while i < original_size and j < revised_size and keys_equal(&original_keys[section.i_end - i - 1], &revised_keys[section.j_end - j - 1]):
+                i += 1
+                j += 1
+            backward[kmiddle] = i
+            if i > original_size:
+                kbackward_end += 2
+            elif j > revised_size:
+                kbackward_start += 2
+            elif not front:
+                kother = offset + delta - k
+                if -d - 1 <= delta - k <= d + 1 and kother < size and forward[kother] != -1:
+                    if forward[kother] >= original_size - i:
+                        i_split[0] = section.i_start + forward[kother]
+                        j_split[0] = section.j_start + offset + forward[kother] - kother
+                        return 1
+    return 0
+
+cdef int heuristic_split(int *forward, int *backward, int offset, int d, int original_size, int revised_size, int *i_split, int *j_split) nogil:
+    """
+    Find the end of the furthest reaching forward or reverse D-path,
+    which is a valid (but not necessarily minimal) point to split the section at.
+
+    The split point is relative to the start of the section.
+    Returns zero if it would be at either end of the section.
+    """
+    cdef int best_progress = 0
+    cdef int k, i, j
+    for k in range(-d, d + 1, 2):
+        i = forward[offset + k]
+        j = i - k
+        if 0 <= i <= original_size and 0 <= j <= revised_size and best_progress < i + j < original_size + revised_size:
+            i_split[0], j_split[0] = i, j
+            best_progress = i + j
+        i = backward[offset + k]
+        j = i - k
+        if 0 <= i <= original_size and 0 <= j <= revised_size and best_progress < i + j < original_size + revised_size:
+            i_split[0], j_split[0] = original_size - i, revised_size - j
+            best_progress = i + j
+    return best_progress > 0
+
+cdef class BufferLines:
+    """
+    A read-only sequence of the lines in a buffer (like a memory-mapped file), without their line endings.
+
+    Lines are split on '\\n' (dropping a trailing '\\r') natively, and are only decoded into strings when accessed.
+    The native engine hashes them straight out of the buffer,
+    so diffing only materializes the lines that end up in the patch.
+
+    The buffer stays locked until the lines are released, which is done automatically when used as a context manager.
+
+    Buffers that were already split can pass the offsets of the lines instead,
+    where each line is the bytes between consecutive offsets (including any line endings).
+    If decode is false, the lines are bytes instead of strings.
+    """
+    def __cinit__(self, buffer, offsets=None, bint decode=True):
+        PyObject_GetBuffer(buffer, &self.view, PyBUF_SIMPLE)
+        self.has_view = True
+        self.decode = decode
+        self.has_offsets = offsets is not None
+        if offsets is None:
+            self.split_lines()
+        else:
+            self.use_offsets(offsets)
+
+    cdef split_lines(self):
+        cdef const char *data = <const char*> self.view.buf
+        cdef Py_ssize_t total = self.view.len
+        cdef Py_ssize_t position = 0, count = 0, end
+        cdef const char *newline
+        with nogil:
+            # Count the lines first, so we only have to allocate once
+            while position < total:
+                count += 1
+                newline = <const char*> memchr(data + position, ord('\n'), total - position)
+                if newline == NULL:
+                    break
+                position = newline - data + 1
+        self.lines = <NativeString*> malloc(max(count, 1) * sizeof(NativeString))
+        if not self.lines:
+            raise MemoryError()
+        self.size = count
+        position, count = 0, 0
+        with nogil:
+            while position < total:
+                newline = <const char*> memchr(data + position, ord('\n'), total - position)
+                end = total if newline == NULL else newline - data
+                if end > position and data[end - 1] == ord('\r'):
+                    self.lines[count].size = end - position - 1
+                else:
+                    self.lines[count].size = end - position
+                self.lines[count].data = <char*> data + position
+                self.lines[count].width = 1
+                count += 1
+                if newline == NULL:
+                    break
+                position = end + 1
+
+    cdef use_offsets(self, offsets):
+        cdef Py_ssize_t count = len(offsets) - 1
+        if count < 0:
+            raise ValueError("The offsets must include the end of the last line")
+        self.lines = <NativeString*> malloc(max(count, 1) * sizeof(NativeString))
+        if not self.lines:
+            raise MemoryError()
+        cdef Py_ssize_t index, start, end
+        end = offsets[0]
+        for index in range(count):
+            start, end = end, offsets[index + 1]
+            if not 0 <= start <= end <= self.view.len:
+                raise ValueError(f"Invalid offsets for line {index}: {start}, {end}")
+            self.lines[index].data = <char*> self.view.buf + start
+            self.lines[index].size = end - start
+            self.lines[index].width = 1
+        self.size = count
+
+    def __dealloc__(self):
+        self.release()
+        free(self.lines)
+
+    def release(self):
+        """Release the underlying buffer, after which the lines can no longer be accessed"""
+        if self.has_view:
+            self.has_view = False
+            PyBuffer_Release(&self.view)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    cdef NativeString *check_lines(self) except NULL:
+        if not self.has_view:
+            raise ValueError("The buffer has already been released")
+        return self.lines
+
+    cdef list line_bytes(self):
+        cdef NativeString *lines = self.check_lines()
+        cdef Py_ssize_t index
+        return [PyBytes_FromStringAndSize(lines[index].data, lines[index].size) for index in range(self.size)]
+
+    def update_digest(self, hasher):
+        """
+        Update the hasher (like hashlib.blake2b) with the lines, hashing the raw buffer instead of decoding them.
+
+        Split buffers are determined by their data, but the offsets of the lines are hashed along with
+        buffers that were already split, since the same data can be split in different ways.
+        """
+        cdef NativeString *lines = self.check_lines()
+        cdef array.array offsets
+        cdef Py_ssize_t index
+        hasher.update(f"{'s' if self.decode else 'b'}{'o' if self.has_offsets else 'n'}{self.size}:".encode())
+        if self.has_offsets:
+            offsets = array.clone(array.array('q'), 2 * self.size, zero=False)
+            for index in range(self.size):
+                offsets.data.as_longlongs[2 * index] = lines[index].data - <char*> self.view.buf
+                offsets.data.as_longlongs[2 * index + 1] = lines[index].size
+            hasher.update(offsets)
+        hasher.update(self.view.len.to_bytes(8, "little"))
+        hasher.update(<object> self.view.obj)
+
+    cdef line(self, Py_ssize_t index):
+        cdef NativeString *lines = self.check_lines()
+        if self.decode:
+            return PyUnicode_DecodeUTF8(lines[index].data, lines[index].size, NULL)
+        return PyBytes_FromStringAndSize(lines[index].data, lines[index].size)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        cdef Py_ssize_t start, stop, step, i
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.size)
+            return [self.line(i) for i in range(start, stop, step)]
+        i = index
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(index)
+        return self.line(i)
+
+    def __repr__(self):
+        return f"BufferLines({self.size} lines)"
 
 cdef struct MemoryChunk:
     size_t current_size
@@ -214,11 +1125,26 @@ cdef struct MemoryChunk:
 
 cdef class NodeAllocator:
     cdef MemoryChunk *current_chunk
+    # The chunks that were freed by reset, which are reused before allocating any more
+    cdef MemoryChunk *spare_chunks
     def __cinit__(self):
         self.current_chunk = NULL
+        self.spare_chunks = NULL
         self.allocate_chunk()
         assert self.current_chunk != NULL
 
+    cdef void reset(self) nogil:
+        """Free every node at once, keeping the memory to allocate the next path"""
+        cdef MemoryChunk *chunk = self.current_chunk
+        cdef MemoryChunk *prev
+        while chunk.prev != NULL:
+            prev = chunk.prev
+            chunk.prev = self.spare_chunks
+            self.spare_chunks = chunk
+            chunk = prev
+        chunk.current_size = 0
+        self.current_chunk = chunk
+
     cdef inline DiffNode *create_node(self, int i, int j, DiffNode *prev) nogil:
         cdef DiffNode *node = self.blank_node()
         if node == NULL:
@@ -230,6 +1156,10 @@ cdef class NodeAllocator:
         node.prev = prev
         if i < 0 or j < 0:
             node.lastSnake = NULL
+        elif prev == NULL:
+            # NOTE: The first node after the bootstrap snake has nothing before it,
+            # so it must anchor itself or we'd lose any delta at the start of the sequences
+            node.lastSnake = node
         else:
             node.lastSnake = prev.lastSnake
         return node
@@ -241,7 +1171,11 @@ cdef class NodeAllocator:
         snake.i = i
         snake.j = j
         snake.prev = prev
-        snake.lastSnake = snake
+        if i < 0 or j < 0:
+            # Bootstrap snakes aren't part of the path
+            snake.lastSnake = NULL
+        else:
+            snake.lastSnake = snake
         snake.snake = True
         return snake
 
@@ -262,13 +1196,22 @@ cdef class NodeAllocator:
         if self.current_chunk == NULL:
             abort()
         cdef MemoryChunk *new_chunk = self.allocate_chunk()
+        if new_chunk == NULL:
+            return NULL
         if new_chunk.current_size != 0:
             abort()
         new_chunk.current_size = 1
         return &new_chunk.data[0]
 
     cdef MemoryChunk *allocate_chunk(self) nogil:
-        cdef MemoryChunk *result = <MemoryChunk*> malloc(sizeof(MemoryChunk))
+        cdef MemoryChunk *result = self.spare_chunks
+        if result != NULL:
+            self.spare_chunks = result.prev
+            result.current_size = 0
+            result.prev = self.current_chunk
+            self.current_chunk = result
+            return result
+        result = <MemoryChunk*> malloc(sizeof(MemoryChunk))
         if not result:
             return NULL
         cdef DiffNode *data = <DiffNode*> malloc(sizeof(DiffNode) * CHUNK_SIZE)
@@ -281,16 +1224,20 @@ cdef class NodeAllocator:
         return result
 
     def __dealloc__(self):
-        cdef MemoryChunk *chunk = self.current_chunk
-        cdef MemoryChunk *prev
+        assert self.current_chunk != NULL
+        free_chunks(self.current_chunk)
+        free_chunks(self.spare_chunks)
         self.current_chunk = NULL
-        assert chunk != NULL
-        while chunk != NULL:
-            free(chunk.data)
-            prev = chunk.prev
-            chunk.data = NULL
-            free(chunk)
-            chunk = prev
+        self.spare_chunks = NULL
+
+cdef void free_chunks(MemoryChunk *chunk) nogil:
+    cdef MemoryChunk *prev
+    while chunk != NULL:
+        free(chunk.data)
+        prev = chunk.prev
+        chunk.data = NULL
+        free(chunk)
+        chunk = prev
 
 
 cdef struct DiffNode:
@@ -312,7 +1259,7 @@ cdef inline int hashlib_sha256sum(const char *data, size_t size, char* out) exce
         raise AssertionError()
 
 cdef inline int native_sha256sum(void *state, const char *data, size_t size, char* out) nogil:
-    IF not USE_HASHLIB:
+    IF not USE_HASHLIB and not USE_FAST_HASH:
         cdef ShaHasher *hasher = <ShaHasher*> state
         cdef int result = 1
         result &= update_hasher(hasher, data, size)
@@ -0,0 +1,209 @@
+from ..core import Patch
+
+from cpython cimport array
+from libc.stdlib cimport calloc, free, malloc
+
+from diffutils._native.myers cimport (
+    LINEAR_DIFF_OUT_OF_MEMORY,
+    BufferLines,
+    Section,
+    SectionList,
+    add_delta_section,
+    build_compact_patch,
+    build_section_patch,
+    check_linear_diff,
+    intern_lines,
+    interning_keys,
+    linear_diff_ids,
+    push_section,
+)
+
+
+cdef struct PatienceState:
+    int *original_ids
+    int *revised_ids
+    # The number of occurrences of each id in the current section
+    int *original_counts
+    int *revised_counts
+    # The last position of each id in the original section
+    int *original_positions
+    # The positions of the lines unique to both sides, in revised order
+    int *candidates_i
+    int *candidates_j
+    # The top candidate of each pile, and the candidate underneath it in the previous pile
+    int *piles
+    int *links
+    # The longest increasing sequence of candidates, which are used as anchors
+    int *anchors_i
+    int *anchors_j
+    int *forward
+    int *backward
+    # The cost limit for the Myers fallback, or negative for no limit
+    int max_cost
+
+cpdef native_patience_diff(original, revised, max_cost=None, bint compact=False, bint line_views=False):
+    if not (type(original) is BufferLines and type(revised) is BufferLines):
+        if type(original) is not list:
+            raise TypeError(f"Original must be a list, not a {type(original)}")
+        if type(revised) is not list:
+            raise TypeError(f"Revised must be a list, not a {type(revised)}")
+    if max_cost is not None and max_cost < 0:
+        raise ValueError(f"Invalid max_cost: {max_cost}")
+    # NOTE: The ids must be shared by both sides, so identical lines get identical ids
+    cdef dict ids = {}
+    cdef array.array original_ids = intern_lines(interning_keys(original), ids)
+    cdef array.array revised_ids = intern_lines(interning_keys(revised), ids)
+    cdef int original_size = len(original)
+    cdef int revised_size = len(revised)
+    cdef int num_ids = len(ids)
+    cdef int max_candidates = min(original_size, revised_size)
+    cdef int max_d = (original_size + revised_size + 1) // 2 + 1
+    cdef PatienceState state
+    state.original_ids = original_ids.data.as_ints
+    state.revised_ids = revised_ids.data.as_ints
+    state.max_cost = -1 if max_cost is None else max_cost
+    # NOTE: The counts must start out zeroed, and are reset after each section
+    state.original_counts = <int*> calloc(num_ids + 1, sizeof(int))
+    state.revised_counts = <int*> calloc(num_ids + 1, sizeof(int))
+    state.original_positions = <int*> malloc((num_ids + 1) * sizeof(int))
+    state.candidates_i = <int*> malloc((max_candidates + 1) * sizeof(int))
+    state.candidates_j = <int*> malloc((max_candidates + 1) * sizeof(int))
+    state.piles = <int*> malloc((max_candidates + 1) * sizeof(int))
+    state.links = <int*> malloc((max_candidates + 1) * sizeof(int))
+    state.anchors_i = <int*> malloc((max_candidates + 1) * sizeof(int))
+    state.anchors_j = <int*> malloc((max_candidates + 1) * sizeof(int))
+    state.forward = <int*> malloc(2 * max_d * sizeof(int))
+    state.backward = <int*> malloc(2 * max_d * sizeof(int))
+    cdef SectionList deltas
+    deltas.size, deltas.capacity, deltas.data = 0, 0, NULL
+    cdef Section whole
+    whole.i_start, whole.i_end, whole.j_start, whole.j_end = 0, original_size, 0, revised_size
+    cdef int error
+    try:
+        if (
+            not state.original_counts or not state.revised_counts or not state.original_positions
+            or not state.candidates_i or not state.candidates_j or not state.piles or not state.links
+            or not state.anchors_i or not state.anchors_j or not state.forward or not state.backward
+        ):
+            raise MemoryError()
+        with nogil:
+            error = patience_diff(&state, whole, &deltas)
+        check_linear_diff(error)
+        if compact and type(original) is not BufferLines:
+            return build_compact_patch(&deltas, original, revised)
+        return build_section_patch(&deltas, original, revised, line_views)
+    finally:
+        free(state.original_counts)
+        free(state.revised_counts)
+        free(state.original_positions)
+        free(state.candidates_i)
+        free(state.candidates_j)
+        free(state.piles)
+        free(state.links)
+        free(state.anchors_i)
+        free(state.anchors_j)
+        free(state.forward)
+        free(state.backward)
+        free(deltas.data)
+
+cdef int patience_diff(PatienceState *state, Section section, SectionList *deltas) nogil:
+    """
+    Add the deltas between the original and revised ids in the section.
+
+    We anchor on the lines that are unique to both sides, then diff the gaps between the anchors.
+    Any gaps without unique lines fall back to Myers algorithm.
+    """
+    cdef int *original_ids = state.original_ids
+    cdef int *revised_ids = state.revised_ids
+    cdef SectionList sections
+    sections.size, sections.capacity, sections.data = 0, 0, NULL
+    cdef Section current
+    cdef int num_anchors, anchor, i_end, j_end
+    cdef int error = 0
+    if not push_section(&sections, section.i_start, section.i_end, section.j_start, section.j_end):
+        error = LINEAR_DIFF_OUT_OF_MEMORY
+    while sections.size > 0 and not error:
+        # Pop the top section, which is always the leftmost remaining
+        sections.size -= 1
+        current = sections.data[sections.size]
+        # Skip the common prefix and suffix
+        while current.i_start < current.i_end and current.j_start < current.j_end and original_ids[current.i_start] == revised_ids[current.j_start]:
+            current.i_start += 1
+            current.j_start += 1
+        while current.i_start < current.i_end and current.j_start < current.j_end and original_ids[current.i_end - 1] == revised_ids[current.j_end - 1]:
+            current.i_end -= 1
+            current.j_end -= 1
+        if current.i_start == current.i_end or current.j_start == current.j_end:
+            if current.i_start == current.i_end and current.j_start == current.j_end:
+                continue
+            if not add_delta_section(deltas, current.i_start, current.i_end, current.j_start, current.j_end):
+                error = LINEAR_DIFF_OUT_OF_MEMORY
+            continue
+        num_anchors = find_anchors(state, current)
+        if num_anchors == 0:
+            error = linear_diff_ids(original_ids, revised_ids, current, deltas, state.forward, state.backward, state.max_cost)
+            continue
+        # Push the gaps between the anchors from right to left, so the leftmost is on top
+        i_end, j_end = current.i_end, current.j_end
+        for anchor in range(num_anchors - 1, -1, -1):
+            if state.anchors_i[anchor] + 1 < i_end or state.anchors_j[anchor] + 1 < j_end:
+                if not push_section(&sections, state.anchors_i[anchor] + 1, i_end, state.anchors_j[anchor] + 1, j_end):
+                    error = LINEAR_DIFF_OUT_OF_MEMORY
+                    break
+            i_end, j_end = state.anchors_i[anchor], state.anchors_j[anchor]
+        if current.i_start < i_end or current.j_start < j_end:
+            if not push_section(&sections, current.i_start, i_end, current.j_start, j_end):
+                error = LINEAR_DIFF_OUT_OF_MEMORY
+    free(sections.data)
+    return error
+
+cdef int find_anchors(PatienceState *state, Section section) nogil:
+    """
+    Find the longest increasing sequence of lines that are unique to both sides of the section,
+    putting them into the anchors and returning the number found.
+    """
+    cdef int *original_ids = state.original_ids
+    cdef int *revised_ids = state.revised_ids
+    cdef int i, j, line
+    for i in range(section.i_start, section.i_end):
+        line = original_ids[i]
+        state.original_counts[line] += 1
+        state.original_positions[line] = i
+    for j in range(section.j_start, section.j_end):
+        state.revised_counts[revised_ids[j]] += 1
+    cdef int num_candidates = 0
+    for j in range(section.j_start, section.j_end):
+        line = revised_ids[j]
+        if state.original_counts[line] == 1 and state.revised_counts[line] == 1:
+            state.candidates_i[num_candidates] = state.original_positions[line]
+            state.candidates_j[num_candidates] = j
+            num_candidates += 1
+    # Reset the counts for the next section
+    for i in range(section.i_start, section.i_end):
+        state.original_counts[original_ids[i]] = 0
+    for j in range(section.j_start, section.j_end):
+        state.revised_counts[revised_ids[j]] = 0
+    # Patience sorting, where each candidate goes on the leftmost pile with a greater top
+    cdef int num_piles = 0
+    cdef int candidate, low, high, middle
+    for candidate in range(num_candidates):
+        low, high = 0, num_piles
+        while low < high:
+            middle = (low + high) // 2
+            if state.candidates_i[state.piles[middle]] < state.candidates_i[candidate]:
+                low = middle + 1
+            else:
+                high = middle
+        state.links[candidate] = state.piles[low - 1] if low > 0 else -1
+        state.piles[low] = candidate
+        if low == num_piles:
+            num_piles += 1
+    if num_piles == 0:
+        return 0
+    candidate = state.piles[num_piles - 1]
+    cdef int anchor
+    for anchor in range(num_piles - 1, -1, -1):
+        state.anchors_i[anchor] = state.candidates_i[candidate]
+        state.anchors_j[anchor] = state.candidates_j[candidate]
+        candidate = state.links[candidate]
+    return num_piles
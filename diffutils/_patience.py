@@ -0,0 +1,227 @@
+# Copyright 2015 Techcable
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An implementation of Bram Cohen's patience differencing algorithm.
+
+Instead of searching for the minimum diff, we anchor on lines which are unique to both sides,
+and then recursively diff the gaps between them.
+Since the anchors are usually meaningful lines, this tends to produce more readable diffs for source code,
+and avoids wasting time matching up low-entropy lines like blank lines and braces.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from typing import List, Optional, Sequence, T, Tuple
+
+from ._myers import MyersEngine, build_path, build_revision, intern_lines
+from .core import Chunk, Delta, Patch
+from .engine import DiffEngine
+
+
+class PatienceEngine(DiffEngine):
+    def __init__(self, max_cost=None):
+        self.max_cost = max_cost
+
+    @property
+    def name(self):
+        return "plain_patience"
+
+    def compute_diff(self, original, revised):
+        if type(original) is not list:
+            raise TypeError("Original must be a list: {!r}".format(original))
+        if type(revised) is not list:
+            raise TypeError("Revised must be a list: {!r}".format(revised))
+        ids = intern_lines(original, revised)
+        if ids is None:
+            # We can't find unique lines without hashing them, so just fallback to myers
+            return MyersEngine(
+                hash_optimization=False, max_cost=self.max_cost
+            ).compute_diff(original, revised)
+        return build_patience_revision(
+            ids[0], ids[1], original, revised, max_cost=self.max_cost
+        )
+
+    def __repr__(self):
+        return "PlainPatienceEngine"
+
+
+def build_patience_revision(
+    original_ids: Sequence[int],
+    revised_ids: Sequence[int],
+    original: List[T],
+    revised: List[T],
+    max_cost: Optional[int] = None,
+) -> Patch:
+    """
+    Computes the patience diff between the original and revised sequences.
+
+    Any gaps between the anchors without unique lines fall back to Myers algorithm,
+    which gives up on finding the minimum after max_cost differences.
+
+    :param original_ids: The interned ids of the original sequence.
+    :param revised_ids: The interned ids of the revised sequence.
+    :param original: The original sequence.
+    :param revised: The revised sequence.
+    :param max_cost: The maximum number of differences Myers algorithm searches for, or None for no limit.
+    :return: A Patch describing the differences.
+    """
+    patch = Patch()
+    # Use an explicit stack instead of recursion, with the leftmost section on top
+    sections = [(0, len(original_ids), 0, len(revised_ids))]
+    while sections:
+        i_start, i_end, j_start, j_end = trim_section(
+            original_ids, revised_ids, *sections.pop()
+        )
+        if i_start == i_end or j_start == j_end:
+            add_section_delta(patch, original, revised, i_start, i_end, j_start, j_end)
+            continue
+        anchors = find_anchors(
+            original_ids, revised_ids, i_start, i_end, j_start, j_end
+        )
+        if not anchors:
+            add_myers_deltas(
+                patch,
+                original_ids,
+                revised_ids,
+                original,
+                revised,
+                i_start,
+                i_end,
+                j_start,
+                j_end,
+                max_cost=max_cost,
+            )
+            continue
+        # Push the gaps between the anchors from right to left, so the leftmost is on top
+        for i, j in reversed(anchors):
+            if i + 1 < i_end or j + 1 < j_end:
+                sections.append((i + 1, i_end, j + 1, j_end))
+            i_end, j_end = i, j
+        if i_start < i_end or j_start < j_end:
+            sections.append((i_start, i_end, j_start, j_end))
+    return patch
+
+
+def trim_section(
+    original_ids: Sequence[int],
+    revised_ids: Sequence[int],
+    i_start: int,
+    i_end: int,
+    j_start: int,
+    j_end: int,
+) -> Tuple[int, int, int, int]:
+    """Skip the common prefix and suffix of the section"""
+    while (
+        i_start < i_end
+        and j_start < j_end
+        and original_ids[i_start] == revised_ids[j_start]
+    ):
+        i_start += 1
+        j_start += 1
+    while (
+        i_start < i_end
+        and j_start < j_end
+        and original_ids[i_end - 1] == revised_ids[j_end - 1]
+    ):
+        i_end -= 1
+        j_end -= 1
+    return i_start, i_end, j_start, j_end
+
+
+def add_section_delta(
+    patch: Patch,
+    original: List[T],
+    revised: List[T],
+    i_start: int,
+    i_end: int,
+    j_start: int,
+    j_end: int,
+):
+    """Add a delta replacing the section of the original with the section of the revised, unless both are empty"""
+    if i_start != i_end or j_start != j_end:
+        original_chunk = Chunk(i_start, original[i_start:i_end])
+        revised_chunk = Chunk(j_start, revised[j_start:j_end])
+        patch.add_delta(Delta.create(original_chunk, revised_chunk))
+
+
+def add_myers_deltas(
+    patch: Patch,
+    original_ids: Sequence[int],
+    revised_ids: Sequence[int],
+    original: List[T],
+    revised: List[T],
+    i_start: int,
+    i_end: int,
+    j_start: int,
+    j_end: int,
+    max_cost: Optional[int] = None,
+):
+    """Fallback to adding the deltas Myers algorithm finds for the section"""
+    path = build_path(
+        original_ids[i_start:i_end], revised_ids[j_start:j_end], max_cost=max_cost
+    )
+    for delta in build_revision(
+        path, original[i_start:i_end], revised[j_start:j_end]
+    ).deltas:
+        delta.original.position += i_start
+        delta.revised.position += j_start
+        patch.add_delta(delta)
+
+
+def find_anchors(
+    original_ids: Sequence[int],
+    revised_ids: Sequence[int],
+    i_start: int,
+    i_end: int,
+    j_start: int,
+    j_end: int,
+) -> List[Tuple[int, int]]:
+    """
+    Find the longest increasing sequence of lines that are unique to both sides of the section.
+
+    :return: the positions of the anchors in the original and revised sequences
+    """
+    original_counts = Counter(original_ids[i_start:i_end])
+    revised_counts = Counter(revised_ids[j_start:j_end])
+    original_positions = {
+        line: i
+        for i, line in enumerate(original_ids[i_start:i_end], i_start)
+        if original_counts[line] == 1
+    }
+    candidates = [
+        (original_positions[line], j)
+        for j, line in enumerate(revised_ids[j_start:j_end], j_start)
+        if revised_counts[line] == 1 and line in original_positions
+    ]
+    # Patience sorting, where each candidate goes on the leftmost pile with a greater top
+    tops = []  # type: List[int]
+    piles = []  # type: List[int]
+    links = []  # type: List[int]
+    for index, (i, _) in enumerate(candidates):
+        pile = bisect_left(tops, i)
+        links.append(piles[pile - 1] if pile > 0 else -1)
+        if pile == len(tops):
+            tops.append(i)
+            piles.append(index)
+        else:
+            tops[pile] = i
+            piles[pile] = index
+    anchors = []
+    index = piles[-1] if piles else -1
+    while index >= 0:
+        anchors.append(candidates[index])
+        index = links[index]
+    anchors.reverse()
+    return anchors
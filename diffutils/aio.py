@@ -0,0 +1,173 @@
+"""
+Awaitable versions of the public API, which run on a managed thread pool instead of blocking the event loop.
+
+The native engine releases the GIL while it hashes and diffs, so several diffs really do run in parallel.
+Parsing and patching are pure python, so they're only offloaded to keep the event loop responsive.
+"""
+
+import asyncio
+import functools
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from . import api
+
+__all__ = (
+    "DiffExecutor",
+    "default_executor",
+    "diff",
+    "diff_many",
+    "diff_files",
+    "patch",
+    "undo_patch",
+    "parse_unified_diff",
+)
+
+
+class DiffExecutor:
+    """
+    Runs diff and patch operations on a pool of threads, with at most max_workers running at once.
+
+    Any operations past the limit wait in the event loop without being submitted,
+    so cancelling them means they never run at all.
+    Operations that already started can't be interrupted, so cancelling them only discards their result,
+    and they keep counting against the limit until they actually finish.
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        elif max_workers < 1:
+            raise ValueError("Invalid number of workers: {}".format(max_workers))
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="diffutils"
+        )
+        # NOTE: Semaphores belong to a single event loop, so each loop gets its own
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def run(self, func, *args, **kwargs):
+        """Run the function on the pool once there's a free worker, returning its result"""
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_workers)
+        await semaphore.acquire()
+        try:
+            future = self._executor.submit(functools.partial(func, *args, **kwargs))
+        except BaseException:
+            semaphore.release()
+            raise
+
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(semaphore.release)
+            except RuntimeError:
+                # The loop was closed, so nobody is waiting anymore
+                pass
+
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future, loop=loop)
+
+    async def diff(self, original, revised, max_cost=None):
+        """Awaitable version of diffutils.diff"""
+        return await self.run(api.diff, original, revised, max_cost=max_cost)
+
+    async def diff_many(self, pairs, workers=None, max_cost=None):
+        """
+        Awaitable version of diffutils.diff_many, which collects the pairs before offloading them.
+
+        Each batch of pairs runs on this executor's threads instead of a separate pool,
+        so they count against max_workers like everything else.
+        If workers is given, at most that many batches run at once.
+        """
+        if workers is not None and workers < 1:
+            raise ValueError("Invalid number of workers: {}".format(workers))
+        pairs = list(pairs)
+        limit = asyncio.Semaphore(workers or self.max_workers)
+
+        async def diff_batch(batch):
+            async with limit:
+                return await self.run(
+                    api.diff_many, batch, workers=1, max_cost=max_cost
+                )
+
+        size = api._DIFF_BATCH_SIZE
+        results = await asyncio.gather(
+            *(
+                diff_batch(pairs[start : start + size])
+                for start in range(0, len(pairs), size)
+            )
+        )
+        return [patch for batch in results for patch in batch]
+
+    async def diff_files(self, original_file, revised_file, engine=None):
+        """Awaitable version of diffutils.diff_files"""
+        return await self.run(api.diff_files, original_file, revised_file, engine)
+
+    async def patch(self, original, patch):
+        """Awaitable version of diffutils.patch"""
+        return await self.run(api.patch, original, patch)
+
+    async def undo_patch(self, revised, patch):
+        """Awaitable version of diffutils.undo_patch"""
+        return await self.run(api.undo_patch, revised, patch)
+
+    async def parse_unified_diff(self, text, lenient=False):
+        """Awaitable version of diffutils.parse_unified_diff, which can also read from a file"""
+        return await self.run(api.parse_unified_diff, text, lenient=lenient)
+
+    def shutdown(self, wait=True):
+        """Shut down the threads, after waiting for the operations that were already submitted if wait is true"""
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def __repr__(self):
+        return "DiffExecutor(max_workers={})".format(self.max_workers)
+
+
+_default_executor = None  # type: DiffExecutor
+
+
+def default_executor() -> DiffExecutor:
+    """The executor used by the module-level functions, which has a worker for each CPU"""
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = DiffExecutor()
+    return _default_executor
+
+
+async def diff(original, revised, max_cost=None):
+    """Awaitable version of diffutils.diff, using the default executor"""
+    return await default_executor().diff(original, revised, max_cost=max_cost)
+
+
+async def diff_many(pairs, workers=None, max_cost=None):
+    """Awaitable version of diffutils.diff_many, using the default executor"""
+    return await default_executor().diff_many(pairs, workers=workers, max_cost=max_cost)
+
+
+async def diff_files(original_file, revised_file, engine=None):
+    """Awaitable version of diffutils.diff_files, using the default executor"""
+    return await default_executor().diff_files(original_file, revised_file, engine)
+
+
+async def patch(original, patch):
+    """Awaitable version of diffutils.patch, using the default executor"""
+    return await default_executor().patch(original, patch)
+
+
+async def undo_patch(revised, patch):
+    """Awaitable version of diffutils.undo_patch, using the default executor"""
+    return await default_executor().undo_patch(revised, patch)
+
+
+async def parse_unified_diff(text, lenient=False):
+    """Awaitable version of diffutils.parse_unified_diff, using the default executor"""
+    return await default_executor().parse_unified_diff(text, lenient=lenient)
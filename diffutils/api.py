@@ -13,22 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import mmap
+import os
 import re
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from diffutils.core import Chunk, Patch, PatchFailedException
-from diffutils.engine import DiffEngine
+from diffutils.cache import CachedDiffEngine, DiffCache, default_cache
+from diffutils.core import Chunk, Delta, Patch, PatchFailedException
+from diffutils.engine import DiffEngine, NativeDiffEngine
 
 from . import output
 
 __all__ = (
     "diff",
+    "diff_many",
+    "rediff",
+    "diff_files",
+    "map_lines",
     "patch",
     "undo_patch",
     "PatchFailedException",
     "PatchFormatError",
     "PatchFormatWarning",
     "parse_unified_diff",
+    "iter_unified_diff",
     "generate_unified_diff",
 )
 
@@ -39,24 +50,199 @@ __unifiedDiffChunkRe = re.compile(
 )
 
 
-def diff(original, revised):
+def diff(original, revised, max_cost=None, cache=None):
     """
     Computes the difference between the original and revised list of elements with the default diff algorithm.
 
+    If max_cost is given, the diff gives up on finding the minimum patch after that many differences,
+    which bounds the time spent on pathological inputs.
+
     :param original: The original text. Can't be None.
     :param revised: The revised text. Can't be None.
+    :param max_cost: The maximum number of differences to search for, or None to always find the minimum.
+    :param cache: A DiffCache to reuse the patches of inputs that were already diffed, or True for a shared in-memory cache.
     :return: The patch describing the difference between the original and revised text.
     """
     if isinstance(original, str):
         original = original.splitlines()
     if isinstance(revised, str):
-        original = original.splitlines()
-    patch = DiffEngine.INSTANCE.diff(original, revised)
+        revised = revised.splitlines()
+    if max_cost is None:
+        engine = DiffEngine.INSTANCE
+    else:
+        engine = DiffEngine.create(max_cost=max_cost)
+    if cache is True:
+        cache = default_cache()
+    if isinstance(cache, DiffCache):
+        engine = CachedDiffEngine(engine, cache)
+    elif cache not in (None, False):
+        raise TypeError("Invalid cache: {!r}".format(cache))
+    patch = engine.diff(original, revised)
     if not patch.deltas:
         return None
     return patch
 
 
+def rediff(patch, revised, start, end, lines, max_cost=None):
+    """
+    Updates the patch after replacing revised[start:end] with the specified lines, with the default diff algorithm.
+
+    Only the deltas around the edit are diffed again, so this is much faster than diffing the whole text again
+    when making small edits to a large text, like in an editor. The result isn't always the smallest possible patch,
+    since unchanged lines outside the edit are never matched differently.
+
+    :param patch: The patch between the original text and the revised text before the edit, or None if they were identical.
+    :param revised: The revised text before the edit.
+    :param start: The index of the first replaced line.
+    :param end: The index after the last replaced line, which is start for a pure insertion.
+    :param lines: The lines that replace them.
+    :param max_cost: The maximum number of differences to search for, or None to always find the minimum.
+    :return: The patch between the original text and the revised text after the edit, or None if they're identical.
+    :exception PatchFailedException: if the patch doesn't match the revised text
+    """
+    if isinstance(revised, str):
+        revised = revised.splitlines()
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    if patch is None:
+        patch = Patch()
+    if max_cost is None:
+        engine = DiffEngine.INSTANCE
+    else:
+        engine = DiffEngine.create(max_cost=max_cost)
+    patch = engine.rediff(patch, revised, start, end, lines)
+    if not patch.deltas:
+        return None
+    return patch
+
+
+# The number of pairs each worker diffs at a time, which amortizes the cost of handing them out
+_DIFF_BATCH_SIZE = 256
+
+
+def diff_many(pairs, workers=None, max_cost=None):
+    """
+    Computes the difference between each (original, revised) pair with the default diff algorithm.
+
+    With the native engine, each batch of pairs is hashed and diffed in a single native call with the GIL released,
+    reusing the same buffers for the whole batch, so the batches run in parallel on a pool of threads.
+    Unlike diff, the common prefix and suffix aren't trimmed, which can give a different (but equally small) patch.
+
+    :param pairs: An iterable of (original, revised) pairs, where each side is a list of lines or a string.
+    :param workers: The number of threads to diff with, or None for one per CPU.
+    :param max_cost: The maximum number of differences to search for, or None to always find the minimum.
+    :return: The patch for each pair in the same order, which is None if the pair is identical.
+    """
+    if workers is not None and workers < 1:
+        raise ValueError("Invalid number of workers: {}".format(workers))
+    if max_cost is None:
+        engine = DiffEngine.INSTANCE
+    else:
+        engine = DiffEngine.create(max_cost=max_cost)
+    if (
+        isinstance(engine, NativeDiffEngine)
+        and engine.algorithm in ("myers", "linear-myers")
+        and not engine.intern_lines
+    ):
+        from ._native.myers import native_diff_batch
+
+        def diff_batch(batch):
+            return native_diff_batch(
+                batch, linear=engine.algorithm == "linear-myers", max_cost=max_cost
+            )
+
+    else:
+        # NOTE: Python engines hold the GIL, so threads wouldn't help
+        workers = 1
+
+        def diff_batch(batch):
+            return [engine.diff(original, revised) for original, revised in batch]
+
+    batches = _diff_batches(pairs)
+    if workers == 1:
+        results = list(map(diff_batch, batches))
+    else:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            results = list(executor.map(diff_batch, batches))
+    return [patch if patch.deltas else None for batch in results for patch in batch]
+
+
+def _diff_batches(pairs):
+    """Split the pairs into batches, converting both sides to lists of lines"""
+    batch = []
+    for original, revised in pairs:
+        batch.append((_as_line_list(original), _as_line_list(revised)))
+        if len(batch) >= _DIFF_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _as_line_list(lines):
+    if isinstance(lines, str):
+        return lines.splitlines()
+    elif type(lines) is not list:
+        return list(lines)
+    return lines
+
+
+def diff_files(original_file, revised_file, engine=None):
+    """
+    Computes the difference between the lines of the original and revised files.
+
+    With a native engine, both files are memory-mapped and their lines are hashed straight out of the mapping,
+    so only the lines that end up in the patch are ever decoded.
+    Lines are split on '\\n', without their line endings.
+
+    :param original_file: The path to the original file.
+    :param revised_file: The path to the revised file.
+    :param engine: The engine to diff with, or None for the default.
+    :return: The patch describing the difference between the files, which is empty if they're identical.
+    """
+    if engine is None:
+        engine = DiffEngine.INSTANCE
+    # NOTE: A cached engine is keyed by the lines, so it can diff the mapped lines just as well
+    wrapped = engine.engine if isinstance(engine, CachedDiffEngine) else engine
+    if isinstance(wrapped, NativeDiffEngine):
+        with map_lines(original_file) as original, map_lines(revised_file) as revised:
+            return engine.diff(original, revised)
+    return engine.diff(read_lines(original_file), read_lines(revised_file))
+
+
+@contextmanager
+def map_lines(path):
+    """
+    Memory-map the file, giving a read-only sequence of its lines which are only decoded when they're accessed.
+
+    The lines can't be accessed once the context exits.
+    If the native extension isn't available, this falls back to reading all the lines into a list.
+
+    :param path: The path to the file.
+    """
+    try:
+        from ._native.myers import BufferLines
+    except ImportError:
+        yield read_lines(path)
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # NOTE: Empty files can't be mapped
+            with BufferLines(b"") as lines:
+                yield lines
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # NOTE: The lines must be released before the mapping is closed
+            with BufferLines(mapped) as lines:
+                yield lines
+
+
+def read_lines(path):
+    """Read the lines of the file into a list, without their line endings"""
+    with open(path, "rt", encoding="utf-8") as f:
+        return [line.rstrip("\r\n") for line in f]
+
+
 def patch(original, patch):
     """
     Apply the patch to the given text.
@@ -82,7 +268,7 @@ def undo_patch(revised, patch):
     """
     if isinstance(revised, str):
         revised = revised.splitlines()
-    patch.restore(revised)
+    return patch.restore(revised)
 
 
 class PatchFormatError(Exception):
@@ -101,17 +287,35 @@ class PatchFormatWarning(Warning, PatchFormatError):
         assert hasattr(self, "message"), "Missing message: {}".format(dir(self))
 
 
-def parse_unified_diff(text, lenient=False):
+def parse_unified_diff(text, lenient=False, start_line=1):
     """
     Parse the given text in unified format into a patch.
 
-    :param text: the unified diff
+    :param text: the unified diff, as a string or any iterable of lines (including a file)
+    :param start_line: the line number of the first line, used when reporting errors
     :return: the parsed patch
     """
+    patch = Patch()
+    for delta in iter_unified_diff(text, lenient=lenient, start_line=start_line):
+        patch.add_delta(delta)
+    return patch
+
+
+def iter_unified_diff(text, lenient=False, start_line=1):
+    """
+    Incrementally parse the given text in unified format, yielding the deltas of each hunk once it's complete.
+
+    Only the current hunk is kept in memory, so huge patches can be parsed straight from a file.
+    Lines read from a file have their line endings stripped.
+
+    :param text: the unified diff, as a string or any iterable of lines (including a file)
+    :param start_line: the line number of the first line, used when reporting errors
+    :return: an iterator over the deltas in the patch
+    """
     if isinstance(text, str):
         text = text.splitlines()
-    elif not isinstance(text, list):
-        text = list(text)
+    elif isinstance(text, io.IOBase):
+        text = (line.rstrip("\r\n") for line in text)
 
     def report_error(message, line_number, line):
         if lenient:
@@ -121,36 +325,66 @@ def parse_unified_diff(text, lenient=False):
 
     in_prelude = True
     raw_chunk = []
-    patch = Patch()
-    chunk_offset = None
+    # The line number and text of the current chunk's header, which is used to report errors in it
+    chunk_header = None
+    previous_line = None
 
     old_ln = 0
     new_ln = 0
 
-    def process_chunk(chunk, offset, expected_original, expected_revised):
-        assert offset is not None
+    def process_chunk(chunk, header, expected_original, expected_revised):
+        assert header is not None
         assert (
             type(expected_original) is int
         ), "Invalid expected_original type: {}".format(type(expected_original))
         assert (
             type(expected_revised) is int
         ), "Invalid expected_revised type: {}".format(type(expected_revised))
-        original_lines, revised_lines = [], []
+        header_line_number, header_line = header
+        # The tags already describe the deltas exactly, so we don't need to diff the hunk again.
+        # Each run of removed and inserted lines between the context lines becomes a single delta.
+        chunks = []
+        # The runs of context lines around the deltas, which are kept so the deltas can be relocated
+        context = [[]]
+        original_position, revised_position = old_ln - 1, new_ln - 1
+        removed_lines, inserted_lines = [], []
+
+        def finish_delta():
+            original_chunk = Chunk(
+                original_position - len(removed_lines), removed_lines
+            )
+            revised_chunk = Chunk(
+                revised_position - len(inserted_lines), inserted_lines
+            )
+            chunks.append((original_chunk, revised_chunk))
+            context.append([])
 
         for line in chunk:
             tag = line[:1]
-            rest = line[1:]
             if tag == " ":
-                revised_lines.append(rest)
-                original_lines.append(rest)
+                if removed_lines or inserted_lines:
+                    finish_delta()
+                    removed_lines, inserted_lines = [], []
+                context[-1].append(line[1:])
+                original_position += 1
+                revised_position += 1
             elif tag == "+":
-                revised_lines.append(rest)
+                inserted_lines.append(line[1:])
+                revised_position += 1
             elif tag == "-":
-                original_lines.append(rest)
+                removed_lines.append(line[1:])
+                original_position += 1
             else:
                 # Shouldnt've gotten this far
                 raise AssertionError("Invalid tag got too far: {}".format(tag))
-        actual_original, actual_revised = len(original_lines), len(revised_lines)
+        if removed_lines or inserted_lines:
+            finish_delta()
+        deltas = [
+            Delta.create(original_chunk, revised_chunk, (context[i], context[i + 1]))
+            for i, (original_chunk, revised_chunk) in enumerate(chunks)
+        ]
+        actual_original = original_position - (old_ln - 1)
+        actual_revised = revised_position - (new_ln - 1)
         if expected_original != actual_original:
             # Sometimes str(expected_original) == str(actual_original) for different numbers!
             assert str(expected_original) != str(actual_original), "{}, {}".format(
@@ -160,8 +394,8 @@ def parse_unified_diff(text, lenient=False):
                 message="Expected {} original lines, but got {}".format(
                     expected_original, actual_original
                 ),
-                line_number=offset - 1,
-                line=text[offset - 2],
+                line_number=header_line_number,
+                line=header_line,
             )
         if expected_revised != actual_revised:
             # Sometimes str(expected_revised) == str(actual_revised) for different numbers!
@@ -172,18 +406,15 @@ def parse_unified_diff(text, lenient=False):
                 message="Expected {} revised lines, but got {}".format(
                     expected_revised, actual_revised
                 ),
-                line_number=offset - 1,
-                line=text[offset - 2],
+                line_number=header_line_number,
+                line=header_line,
             )
-        for delta in DiffEngine.INSTANCE.diff_chunks(
-            Chunk(old_ln - 1, original_lines), Chunk(new_ln - 1, revised_lines)
-        ):
-            patch.add_delta(delta)
         del chunk[:]
+        return deltas
 
     expected_original, expected_revised = None, None
     for index, line in enumerate(text):
-        line_number = index + 1  # Indexes start at zero, linenos start at 1
+        line_number = index + start_line
         if not lenient and "\n" in line:
             report_error(
                 message="Line contained newline", line_number=line_number, line=line
@@ -192,27 +423,29 @@ def parse_unified_diff(text, lenient=False):
             # Skip leading lines until after we've seen one starting with '+++'
             if line.startswith("+++"):
                 in_prelude = False
+            previous_line = line
             continue
 
         match = __unifiedDiffChunkRe.search(line)
         if match is not None:  # A match is found
-            if raw_chunk:
-                # Process the lines in the previous chunk
-                process_chunk(
-                    raw_chunk, chunk_offset, expected_original, expected_revised
+            if chunk_header is not None:
+                # Process the lines in the previous chunk, which reports an error if it didn't have any
+                yield from process_chunk(
+                    raw_chunk, chunk_header, expected_original, expected_revised
                 )
-                chunk_offset = None  # Clear the offset
+            chunk_header = (line_number, line)
             # Parse the @@ header
             if match.group(1) is None:
                 old_ln = 1
             else:
                 old_ln = int(match.group(1))
-            expected_original = int(match.group(2))
+            # NOTE: An omitted count means a single line
+            expected_original = int(match.group(2) or 1)
             if match.group(3) is None:
                 new_ln = 1
             else:
                 new_ln = int(match.group(3))
-            expected_revised = int(match.group(4))
+            expected_revised = int(match.group(4) or 1)
 
             # TODO: Consider error?
             if old_ln == 0:
@@ -220,9 +453,8 @@ def parse_unified_diff(text, lenient=False):
             if new_ln == 0:
                 new_ln += 1
         else:
-            if not raw_chunk:
-                assert chunk_offset is None
-                chunk_offset = line_number
+            if chunk_header is None:
+                chunk_header = (line_number - 1, previous_line)
             if line:
                 tag = line[:1]
                 rest = line[1:]
@@ -230,16 +462,18 @@ def parse_unified_diff(text, lenient=False):
                     raw_chunk.append(tag + rest)
                 else:
                     report_error(
-                        message="Invalid tag {}".format(actual_revised),
+                        message="Invalid tag {}".format(tag),
                         line_number=line_number,
                         line=line,
                     )
             else:
                 raw_chunk.append(" ")
-    # Process the lines in the final chunk
-    process_chunk(raw_chunk, chunk_offset, expected_original, expected_revised)
-
-    return patch
+        previous_line = line
+    if chunk_header is not None:
+        # Process the lines in the final chunk, even if the text ended right after its header
+        yield from process_chunk(
+            raw_chunk, chunk_header, expected_original, expected_revised
+        )
 
 
 def generate_unified_diff(
@@ -0,0 +1,390 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from .core import Chunk, Delta, Patch
+from .engine import DiffEngine
+
+__all__ = ("DiffCache", "CachedDiffEngine", "LineHashCache", "default_cache")
+
+# The deltas of a cached patch, as (original position, original lines, revised position, revised lines)
+CachedDeltas = Tuple[Tuple[int, Tuple, int, Tuple], ...]
+
+# The approximate memory used by each delta, besides the lines themselves
+_DELTA_OVERHEAD = 200
+# The approximate memory used by each cached line hash, besides the line and the hash themselves
+_LINE_HASH_OVERHEAD = 150
+
+
+class DiffCache:
+    """
+    A cache of patches, keyed by a digest of the engine and both inputs.
+
+    The least recently used patches are evicted once there are more than max_entries of them,
+    or if max_bytes is given, once their lines take up more than roughly that much memory.
+    If a directory is given, every patch is also stored there, so they survive restarts
+    and can be shared between processes.
+    Only sequences of str or bytes can be cached, and everything else is diffed as usual.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, directory=None):
+        if max_entries < 1:
+            raise ValueError("Invalid max_entries: {}".format(max_entries))
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError("Invalid max_bytes: {}".format(max_bytes))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = None if directory is None else str(directory)
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._entries = (
+            OrderedDict()
+        )  # type: OrderedDict[bytes, Tuple[CachedDeltas, int]]
+        self._size = 0
+        # NOTE: Engines can be shared between threads, like in diff_many or diffutils.aio
+        self._lock = threading.Lock()
+
+    def key(self, engine: DiffEngine, original, revised) -> Optional[bytes]:
+        """
+        Compute the key for diffing the lines with the engine, or None if they can't be cached.
+
+        The lines of each side are joined and hashed along with their count,
+        which is unambiguous unless some lines contain the separator, so then their lengths are hashed too.
+        BufferLines hash their buffer instead, so memory-mapped files are never decoded.
+        """
+        try:
+            from ._native.myers import BufferLines
+        except ImportError:
+            BufferLines = None
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(
+            "{!r}:{!r}".format(engine, getattr(engine, "max_cost", None)).encode()
+        )
+        for lines in (original, revised):
+            if BufferLines is not None and type(lines) is BufferLines:
+                lines.update_digest(hasher)
+                continue
+            try:
+                data = "\n".join(lines).encode("utf-8", "surrogatepass")
+                tag = b"s"
+            except TypeError:
+                try:
+                    data = b"\n".join(lines)
+                    tag = b"b"
+                except TypeError:
+                    return None
+            hasher.update(len(lines).to_bytes(8, "little"))
+            if data.count(b"\n") != max(len(lines) - 1, 0):
+                # NOTE: Some lines contain the separator, so include their lengths to tell where they're split
+                hasher.update(tag.upper())
+                hasher.update(array("q", map(len, lines)).tobytes())
+            else:
+                hasher.update(tag)
+            hasher.update(len(data).to_bytes(8, "little"))
+            hasher.update(data)
+        return hasher.digest()
+
+    def get(self, key: bytes) -> Optional[Patch]:
+        """Get a copy of the cached patch, counting it as a hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            return _build_patch(entry[0])
+        deltas = self._load(key)
+        with self._lock:
+            if deltas is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._insert(key, deltas)
+        return _build_patch(deltas)
+
+    def put(self, key: bytes, patch: Patch):
+        """Cache a copy of the patch, storing it on disk if there's a directory"""
+        deltas = tuple(
+            (
+                delta.original.position,
+                tuple(delta.original.lines),
+                delta.revised.position,
+                tuple(delta.revised.lines),
+            )
+            for delta in patch.deltas
+        )
+        with self._lock:
+            self._insert(key, deltas)
+        self._store(key, deltas)
+
+    def _insert(self, key: bytes, deltas: CachedDeltas):
+        size = sum(
+            _DELTA_OVERHEAD
+            + sum(map(len, original_lines))
+            + sum(map(len, revised_lines))
+            for _, original_lines, _, revised_lines in deltas
+        )
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._size -= old_entry[1]
+        self._entries[key] = deltas, size
+        self._size += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None
+            and self._size > self.max_bytes
+            and len(self._entries) > 1
+        ):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+
+    def _path(self, key: bytes) -> str:
+        return os.path.join(self.directory, key.hex() + ".json")
+
+    def _load(self, key: bytes) -> Optional[CachedDeltas]:
+        if self.directory is None:
+            return None
+        try:
+            with open(
+                self._path(key), "rt", encoding="utf-8", errors="surrogatepass"
+            ) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # A corrupted entry is just a miss, which gets overwritten
+            return None
+        if not _is_stored_deltas(stored):
+            # NOTE: Valid JSON with the wrong shape is just as corrupted
+            return None
+        return tuple(
+            (
+                original_position,
+                tuple(original_lines),
+                revised_position,
+                tuple(revised_lines),
+            )
+            for original_position, original_lines, revised_position, revised_lines in stored
+        )
+
+    def _store(self, key: bytes, deltas: CachedDeltas):
+        if self.directory is None:
+            return
+        if any(
+            type(line) is not str
+            for _, original_lines, _, revised_lines in deltas
+            for line in original_lines + revised_lines
+        ):
+            # NOTE: Entries are stored as JSON, so only text can go on disk
+            return
+        # NOTE: The entry on disk is only an optimization, so failing to write it never fails the diff
+        try:
+            # NOTE: Write to a temporary file first, so other processes never see a partial entry
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                # NOTE: Lines can contain lone surrogates (like from surrogateescape), which aren't valid UTF-8
+                with os.fdopen(fd, "wt", encoding="utf-8", errors="surrogatepass") as f:
+                    json.dump(deltas, f, ensure_ascii=False)
+                os.replace(temp_path, self._path(key))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except (OSError, ValueError):
+            pass
+
+    def clear(self):
+        """Clear the entries in memory and the counters, leaving any on disk"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def size(self) -> int:
+        """The approximate memory used by the cached lines"""
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __reduce__(self):
+        # NOTE: Worker processes get an empty cache with the same settings, sharing the entries on disk
+        return DiffCache, (self.max_entries, self.max_bytes, self.directory)
+
+    def __repr__(self):
+        return "DiffCache({} entries, {} hits, {} misses)".format(
+            len(self), self.hits, self.misses
+        )
+
+
+def _is_stored_deltas(stored) -> bool:
+    """Check that an entry loaded from disk is a list of [original position, original lines, revised position, revised lines]"""
+    return type(stored) is list and all(
+        type(delta) is list
+        and len(delta) == 4
+        and type(delta[0]) is int
+        and type(delta[1]) is list
+        and type(delta[2]) is int
+        and type(delta[3]) is list
+        and all(type(line) is str for line in delta[1])
+        and all(type(line) is str for line in delta[3])
+        for delta in stored
+    )
+
+
+def _build_patch(deltas: CachedDeltas) -> Patch:
+    patch = Patch()
+    for original_position, original_lines, revised_position, revised_lines in deltas:
+        patch.add_delta(
+            Delta.create(
+                Chunk(original_position, list(original_lines)),
+                Chunk(revised_position, list(revised_lines)),
+            )
+        )
+    return patch
+
+
+class CachedDiffEngine(DiffEngine):
+    """Wraps another engine, caching its patches"""
+
+    def __init__(self, engine: DiffEngine, cache: DiffCache):
+        self.engine = engine
+        self.cache = cache
+
+    def diff(self, original, revised) -> Patch:
+        key = self.cache.key(self.engine, original, revised)
+        if key is None:
+            return self.engine.diff(original, revised)
+        patch = self.cache.get(key)
+        if patch is None:
+            patch = self.engine.diff(original, revised)
+            self.cache.put(key, patch)
+        return patch
+
+    def compute_diff(self, original, revised) -> Patch:
+        return self.engine.compute_diff(original, revised)
+
+    @property
+    def name(self) -> str:
+        return self.engine.name
+
+    def __repr__(self):
+        return "Cached{!r}".format(self.engine)
+
+
+class LineHashCache:
+    """
+    A cache of the sha256sum of each line, so diffing successive revisions of a document only hashes the new lines.
+
+    Lines are keyed by their contents, which python compares by identity first,
+    so a line shared by two revisions is usually found without comparing the text at all.
+    The least recently used lines are evicted once there are more than max_entries of them,
+    or if max_bytes is given, once they take up more than roughly that much memory.
+
+    This only helps engines that take the sha256sum of the lines, which are the plain engines
+    and native engines built with a HASH_IMPL other than 'fast'.
+    The default native hash is cheaper than looking up the line, so those engines ignore the cache.
+    """
+
+    def __init__(self, max_entries=65536, max_bytes=None):
+        if max_entries < 1:
+            raise ValueError("Invalid max_entries: {}".format(max_entries))
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError("Invalid max_bytes: {}".format(max_bytes))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._hashes = OrderedDict()  # type: OrderedDict[str, bytes]
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def hash_lines(self, lines) -> Optional[List[bytes]]:
+        """Take the sha256sum of each line, or return None if any of the lines aren't strings"""
+        # NOTE: Check every line before looking any of them up, since unhashable lines can't be looked up
+        if any(type(line) is not str for line in lines):
+            return None
+        result = self.lookup(lines)
+        missing = [index for index, digest in enumerate(result) if digest is None]
+        if not missing:
+            return result
+        missing_lines = []
+        for index in missing:
+            line = lines[index]
+            result[index] = hashlib.sha256(line.encode("utf-8")).digest()
+            missing_lines.append(line)
+        self.add(missing_lines, [result[index] for index in missing])
+        return result
+
+    def lookup(self, lines) -> List[Optional[bytes]]:
+        """Get the cached hash of each line, which is None if it's missing (or isn't a str or bytes)"""
+        result = []
+        with self._lock:
+            get, move_to_end = self._hashes.get, self._hashes.move_to_end
+            for line in lines:
+                line_type = type(line)
+                if line_type is not str and line_type is not bytes:
+                    result.append(None)
+                    continue
+                digest = get(line)
+                if digest is not None:
+                    move_to_end(line)
+                result.append(digest)
+            missing = result.count(None)
+            self.hits += len(result) - missing
+            self.misses += missing
+        return result
+
+    def add(self, lines, digests):
+        """Cache the hashes of the lines, evicting the least recently used ones if we're over budget"""
+        with self._lock:
+            hashes = self._hashes
+            for line, digest in zip(lines, digests):
+                old_digest = hashes.pop(line, None)
+                if old_digest is None:
+                    self._size += _LINE_HASH_OVERHEAD + len(line) + len(digest)
+                hashes[line] = digest
+            while len(hashes) > self.max_entries or (
+                self.max_bytes is not None and self._size > self.max_bytes and hashes
+            ):
+                line, digest = hashes.popitem(last=False)
+                self._size -= _LINE_HASH_OVERHEAD + len(line) + len(digest)
+
+    def clear(self):
+        """Clear the cached hashes and the counters"""
+        with self._lock:
+            self._hashes.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def size(self) -> int:
+        """The approximate memory used by the cached lines and their hashes"""
+        return self._size
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __repr__(self):
+        return "LineHashCache({} lines, {} hits, {} misses)".format(
+            len(self), self.hits, self.misses
+        )
+
+
+_default_cache = None  # type: DiffCache
+
+
+def default_cache() -> DiffCache:
+    """The in-memory cache used by diffutils.diff(cache=True)"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DiffCache()
+    return _default_cache
@@ -12,20 +12,34 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bisect
+import itertools
 import operator
 from abc import ABCMeta, abstractmethod
+from array import array
+from collections.abc import MutableSequence, Sequence
 from enum import Enum
-from typing import List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 """Internal Code"""
 
-__all__ = ("Delta", "Chunk", "Patch", "PatchFailedException")
+__all__ = (
+    "Delta",
+    "Chunk",
+    "LineView",
+    "Patch",
+    "CompactPatch",
+    "PatchFailedException",
+)
+
+# Views need more bookkeeping than a small list, so fewer lines than this are copied instead
+LINE_VIEW_MIN_SIZE = 8
 
 
 class Delta(metaclass=ABCMeta):
     """Describes the delta between original and revised texts."""
 
-    __slots__ = "original", "revised"
+    __slots__ = "original", "revised", "context"
 
     class Type(Enum):
         CHANGE = 1
@@ -37,12 +51,13 @@ class Delta(metaclass=ABCMeta):
     def type(self) -> Type:
         pass
 
-    def __init__(self, original: "Chunk", revised: "Chunk"):
+    def __init__(self, original: "Chunk", revised: "Chunk", context=None):
         """
         Construct the delta for original and revised chunks
 
         :param original: Chunk describing the original text. Must not be None
         :param revised : Chunk describing the revised  text. Must not be None
+        :param context: the unchanged lines (before, after) the delta in the hunk it was parsed from, or None
         """
         if original is None:
             raise ValueError("original must not be null")
@@ -50,6 +65,7 @@ class Delta(metaclass=ABCMeta):
             raise ValueError("revised must not be null")
         self.original = original
         self.revised = revised
+        self.context = context
 
     def verify(self, target):
         """
@@ -96,7 +112,9 @@ class Delta(metaclass=ABCMeta):
         self.reverse().apply_to(target)
 
     def reverse(self) -> "Delta":
-        return Delta.create(original=self.revised, revised=self.original)
+        return Delta.create(
+            original=self.revised, revised=self.original, context=self.context
+        )
 
     def __hash__(self):
         return hash((self.original, self.revised))
@@ -108,7 +126,7 @@ class Delta(metaclass=ABCMeta):
             return NotImplemented
 
     @staticmethod
-    def create(original: "Chunk", revised: "Chunk") -> "Delta":
+    def create(original: "Chunk", revised: "Chunk", context=None) -> "Delta":
         """Create a delta of the apropriate type, based on the original and revised chunks"""
         assert type(original) is Chunk and type(revised) is Chunk
         if original:
@@ -120,7 +138,7 @@ class Delta(metaclass=ABCMeta):
             delta_type = InsertDelta
         else:
             raise ValueError("Empty deltas!")
-        return delta_type(original, revised)
+        return delta_type(original, revised, context)
 
 
 class ChangeDelta(Delta):
@@ -159,7 +177,7 @@ class Chunk:
     __slots__ = "position", "lines"
 
     def __init__(self, position, lines):
-        """Creates a chunk and saves a copy of affected lines"""
+        """Creates a chunk of the affected lines, which can be a list or a LineView of the diffed sequence"""
         self.position = position
         self.lines = lines
 
@@ -170,12 +188,19 @@ class Chunk:
         :param target: the sequence to verify against.
         :exception PatchFailedException: If doesn't match
         """
-        if self.last > len(target):
+        position = self.position
+        lines = self.lines
+        if position + len(lines) > len(target):
             raise PatchFailedException(
                 "Incorrect Chunk: the position of chunk > target size"
             )
-        position = self.position
-        for (offset, expected) in enumerate(self.lines):
+        actual = target[position : position + len(lines)]
+        if (actual if type(actual) is list else list(actual)) == (
+            lines if type(lines) is list else list(lines)
+        ):
+            # NOTE: Comparing the slices is done entirely in C, so we only compare line by line to find the mismatch
+            return
+        for (offset, expected) in enumerate(lines):
             index = position + offset
             actual = target[index]
             if actual != expected:
@@ -211,6 +236,84 @@ class Chunk:
         return self.lines == other.lines and self.position == other.position
 
 
+class LineView(MutableSequence):
+    """
+    A view of the lines sequence[start:stop], which are only copied if the view is changed.
+
+    Engines created with line_views=True put these in their chunks, so a large rewrite doesn't copy most of the input into the patch.
+    Since the view references the sequence, changing the sequence afterwards also changes the view.
+    """
+
+    __slots__ = "sequence", "start", "stop", "_lines"
+
+    def __init__(self, sequence, start: int, stop: int):
+        self.sequence = sequence
+        self.start = start
+        self.stop = stop
+        # The copy of the lines, once the view has been changed
+        self._lines = None  # type: Optional[list]
+
+    def _copy(self) -> list:
+        lines = self._lines
+        if lines is None:
+            self._lines = lines = list(self.sequence[self.start : self.stop])
+            self.sequence = None
+        return lines
+
+    def __len__(self):
+        if self._lines is not None:
+            return len(self._lines)
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if self._lines is not None:
+            return self._lines[index]
+        indices = range(self.start, self.stop)[index]
+        if isinstance(index, slice):
+            return [self.sequence[i] for i in indices]
+        return self.sequence[indices]
+
+    def __iter__(self):
+        if self._lines is not None:
+            return iter(self._lines)
+        return map(self.sequence.__getitem__, range(self.start, self.stop))
+
+    def __setitem__(self, index, value):
+        self._copy()[index] = value
+
+    def __delitem__(self, index):
+        del self._copy()[index]
+
+    def insert(self, index, value):
+        self._copy().insert(index, value)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LineView)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None  # type: ignore
+
+    def __reduce__(self):
+        # NOTE: Only the lines themselves are pickled, not the whole sequence
+        return list, (list(self),)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def chunk_lines(sequence, start: int, stop: int, line_views=False):
+    """
+    The lines sequence[start:stop] of a chunk.
+
+    These are copied unless line_views is true, since a view changes along with the sequence.
+    Even then, just a few lines are cheaper to copy.
+    """
+    if not line_views or stop - start < LINE_VIEW_MIN_SIZE:
+        return sequence[start:stop]
+    return LineView(sequence, start, stop)
+
+
 class Patch:
     """A patch holding all deltas between the original and revised texts."""
 
@@ -223,16 +326,18 @@ class Patch:
         """
         Apply this patch to the given target
 
+        The deltas are applied in a single pass, copying the untouched lines between them,
+        so this takes linear time no matter how many deltas there are.
+
         :param target: the target to apply the patch to
         :return: the patched text
         :exception PatchFailedException: if unable to apply
         """
         if isinstance(target, str):
             target = target.splitlines()
-        result = list(target)
-        for delta in reversed(self.deltas):
-            delta.apply_to(result)
-        return result
+        return _apply_chunks(
+            target, ((delta.original, delta.revised) for delta in self.deltas)
+        )
 
     def restore(self, target):
         """
@@ -241,11 +346,195 @@ class Patch:
 
         :param target: the changed text
         :return: the original text
+        :exception PatchFailedException: if unable to restore
+        """
+        if isinstance(target, str):
+            target = target.splitlines()
+        return _apply_chunks(
+            target, ((delta.revised, delta.original) for delta in self.deltas)
+        )
+
+    def relocate(self, target, max_offset=None) -> Tuple["Patch", List[int]]:
+        """
+        Move each delta to where its original lines actually are in the target, like GNU patch does with hunks that have drifted.
+
+        Deltas parsed from a unified diff are matched together with the context lines around them in their hunk,
+        so even pure insertions are placed (and verified) by their context.
+        Each delta is first checked where it would be with the same offset as the previous delta.
+        If it doesn't match there, the delta is anchored on its rarest line, whose positions are looked up in an index of the target.
+        The index is only built once, the first time it's needed, so patches with thousands of deltas stay fast.
+        The closest match to the expected position wins, but deltas stay in order, so they never move before the previous one.
+        Pure insertions without any context have no lines to look for, so they keep the offset of the previous delta,
+        or of the first delta with lines if they come before it.
+
+        :param target: the text the patch should be applied to
+        :param max_offset: the maximum number of lines a delta can move, or None for no limit
+        :return: the relocated patch, and the offset of each delta
+        :exception PatchFailedException: if the lines of a delta (or its context) can't be found
+        """
+        if isinstance(target, str):
+            target = target.splitlines()
+        elif type(target) is not list:
+            target = list(target)
+        if max_offset is not None and max_offset < 0:
+            raise ValueError("Invalid max_offset: {}".format(max_offset))
+        deltas = self.deltas
+        positions = []  # type: List[Optional[int]]
+        # The offset of the previous delta that has lines, which is None until there is one
+        offset = None  # type: Optional[int]
+        # The position after the previous delta, which every delta must come after
+        minimum = 0
+        # Maps each line to the sorted positions it occurs at, built the first time a delta doesn't match
+        index = None  # type: Optional[Dict[object, List[int]]]
+        for number, delta in enumerate(deltas, 1):
+            original = delta.original
+            lines = original.lines
+            if type(lines) is not list:
+                lines = list(lines)
+            size = len(lines)
+            # The lines to look for, which start with the leading context
+            leading = 0
+            if delta.context is not None:
+                before, after = delta.context
+                leading = len(before)
+                lines = list(before) + lines + list(after)
+            if not lines and offset is None:
+                # Leading insertions have nothing to go by, so they're placed once we know the first offset
+                positions.append(None)
+                continue
+            lowest, highest = minimum, len(target) - size
+            if max_offset is not None:
+                lowest = max(lowest, original.position - max_offset)
+                highest = min(highest, original.position + max_offset)
+            # The bounds of where the context can start
+            lowest, highest = (
+                max(lowest - leading, 0),
+                min(highest - leading, len(target) - len(lines)),
+            )
+            expected = min(
+                max(original.position + (offset or 0) - leading, lowest), highest
+            )
+            if lowest > highest:
+                position = None
+            elif target[expected : expected + len(lines)] == lines:
+                position = expected + leading
+            else:
+                if index is None:
+                    index = {}
+                    for line_number, line in enumerate(target):
+                        index.setdefault(line, []).append(line_number)
+                position = _find_chunk(target, lines, index, expected, lowest, highest)
+                if position is not None:
+                    position += leading
+            if position is None:
+                raise PatchFailedException(
+                    "Couldn't find delta #{} near line {}".format(
+                        number, original.position + 1
+                    )
+                )
+            if lines:
+                offset = position - original.position
+            positions.append(position)
+            minimum = position + size
+        # Place the leading insertions with the offset of the first delta that has lines
+        first = next(
+            (
+                number
+                for number, position in enumerate(positions)
+                if position is not None
+            ),
+            len(positions),
+        )
+        if first < len(positions):
+            leading_offset = positions[first] - deltas[first].original.position
+            limit = positions[first]
+        else:
+            leading_offset, limit = 0, len(target)
+        for number in range(first):
+            original_position = deltas[number].original.position
+            position = min(max(original_position + leading_offset, 0), limit)
+            if (
+                max_offset is not None
+                and abs(position - original_position) > max_offset
+            ):
+                raise PatchFailedException(
+                    "Couldn't find delta #{} near line {}".format(
+                        number + 1, original_position + 1
+                    )
+                )
+            positions[number] = position
+        result = Patch()
+        offsets = []
+        for delta, position in zip(deltas, positions):
+            offset = position - delta.original.position
+            offsets.append(offset)
+            result.add_delta(
+                Delta.create(
+                    Chunk(position, delta.original.lines),
+                    Chunk(delta.revised.position + offset, delta.revised.lines),
+                    delta.context,
+                )
+            )
+        return result, offsets
+
+    def apply_stream(self, src, dst) -> int:
         """
-        result = list(target)
-        for delta in reversed(self.deltas):
-            delta.restore(result)
-        return result
+        Apply this patch to the lines read from src, writing each resulting line to dst as soon as it's known.
+
+        Each chunk is verified as it passes, so only the lines of a single delta are held at once,
+        which lets huge files be patched in bounded memory.
+        If the patch fails, dst has already been given the lines before the failing delta.
+
+        :param src: an iterable of the lines to patch, like a text file, whose line endings are ignored
+        :param dst: a writable text file, which gets each line followed by a newline
+        :return: the number of lines written
+        :exception PatchFailedException: if unable to apply
+        """
+        lines = iter(src)
+        write = dst.write
+        position = 0
+        # The difference between the number of lines written and the number read
+        offset = 0
+        for delta in self.deltas:
+            original, revised = delta.original, delta.revised
+            if original.position < position:
+                raise PatchFailedException(
+                    "Incorrect patch: the delta at {} overlaps the previous one".format(
+                        original.position
+                    )
+                )
+            # Copy the untouched lines before the delta
+            for line in itertools.islice(lines, original.position - position):
+                write(line.rstrip("\r\n"))
+                write("\n")
+                position += 1
+            if position < original.position:
+                raise PatchFailedException(
+                    "Incorrect patch for delta: delta original position > target size"
+                )
+            for expected in original.lines:
+                line = next(lines, None)
+                if line is None:
+                    raise PatchFailedException(
+                        "Incorrect Chunk: the position of chunk > target size"
+                    )
+                actual = line.rstrip("\r\n")
+                if actual != expected:
+                    raise PatchFailedException(
+                        "Incorrect Chunk: the chunk content {} doesn't match the target {} at {}".format(
+                            repr(expected), repr(actual), position
+                        )
+                    )
+                position += 1
+            for line in revised.lines:
+                write(line)
+                write("\n")
+            offset += len(revised) - len(original)
+        for line in lines:
+            write(line.rstrip("\r\n"))
+            write("\n")
+            position += 1
+        return position + offset
 
     def add_delta(self, delta):
         """
@@ -275,7 +564,205 @@ class Patch:
     def __eq__(self, other):
         if not isinstance(other, Patch):
             return False
-        return other._deltas == self._deltas
+        # NOTE: Compare the sorted deltas, since either patch could still be an unsorted list
+        return tuple(other.deltas) == tuple(self.deltas)
+
+
+def _apply_chunks(target, chunks) -> list:
+    """
+    Replace each source chunk of the target with its replacement, in a single pass over the target.
+
+    :param chunks: the (source, replacement) chunks, sorted by position
+    :exception PatchFailedException: if a source chunk doesn't match the target, or overlaps the previous one
+    """
+    result = []
+    position = 0
+    for source, replacement in chunks:
+        if source.position < position:
+            raise PatchFailedException(
+                "Incorrect patch: the delta at {} overlaps the previous one".format(
+                    source.position
+                )
+            )
+        if source:
+            source.verify(target)
+        elif source.position > len(target):
+            raise PatchFailedException(
+                "Incorrect patch for delta: delta original position > target size"
+            )
+        result.extend(target[position : source.position])
+        result.extend(replacement.lines)
+        position = source.position + len(source)
+    result.extend(target[position:])
+    return result
+
+
+def _find_chunk(target, lines, index, expected, lowest, highest) -> Optional[int]:
+    """Find the position of the lines in the target that's closest to the expected position, between lowest and highest"""
+    if lowest > highest:
+        return None
+    # Only the occurrences of the rarest line need to be checked
+    anchor, positions = min(
+        enumerate(index.get(line, ()) for line in lines),
+        key=lambda item: len(item[1]),
+    )
+    # Walk outwards from the expected position, checking the closest candidates first
+    left = bisect.bisect_left(positions, lowest + anchor)
+    right = bisect.bisect_right(positions, highest + anchor)
+    after = bisect.bisect_left(positions, expected + anchor, left, right)
+    before = after - 1
+    size = len(lines)
+    while before >= left or after < right:
+        if after >= right or (
+            before >= left
+            and expected - (positions[before] - anchor)
+            <= positions[after] - anchor - expected
+        ):
+            position = positions[before] - anchor
+            before -= 1
+        else:
+            position = positions[after] - anchor
+            after += 1
+        if target[position : position + size] == lines:
+            return position
+    return None
+
+
+class CompactPatch(Patch):
+    """
+    A patch stored as parallel arrays of the positions and lengths of each delta,
+    which references the original and revised sequences instead of copying their lines.
+
+    Delta objects are only built when they're accessed, so patches with lots of deltas
+    take a fraction of the memory and give the garbage collector nothing to walk.
+    Since the deltas are built on every access, changing them doesn't change the patch.
+    Adding a delta converts it into a regular patch.
+    """
+
+    __slots__ = (
+        "original",
+        "revised",
+        "original_positions",
+        "original_lengths",
+        "revised_positions",
+        "revised_lengths",
+    )
+
+    def __init__(
+        self,
+        original,
+        revised,
+        original_positions,
+        original_lengths,
+        revised_positions,
+        revised_lengths,
+    ):
+        """
+        Create a patch from the arrays, which must be sorted by position and have the same length
+
+        :param original: the original sequence the positions refer to
+        :param revised: the revised sequence the positions refer to
+        """
+        size = len(original_positions)
+        if not (
+            len(original_lengths)
+            == len(revised_positions)
+            == len(revised_lengths)
+            == size
+        ):
+            raise ValueError("The arrays must have the same length")
+        self._deltas = None
+        self.original = original
+        self.revised = revised
+        self.original_positions = original_positions
+        self.original_lengths = original_lengths
+        self.revised_positions = revised_positions
+        self.revised_lengths = revised_lengths
+
+    def delta(self, index: int) -> "Delta":
+        """Build the delta at the specified index"""
+        original_position = self.original_positions[index]
+        revised_position = self.revised_positions[index]
+        return Delta.create(
+            Chunk(
+                original_position,
+                self.original[
+                    original_position : original_position + self.original_lengths[index]
+                ],
+            ),
+            Chunk(
+                revised_position,
+                self.revised[
+                    revised_position : revised_position + self.revised_lengths[index]
+                ],
+            ),
+        )
+
+    def offset(
+        self, original, revised, original_offset: int, revised_offset: int
+    ) -> "CompactPatch":
+        """
+        Move every delta by the offsets, referencing the specified sequences instead.
+
+        This is used to turn a patch between two slices into a patch between the sequences they were sliced from,
+        without building any deltas.
+        """
+        if self._deltas is not None:
+            raise ValueError("Can't offset a patch after adding deltas")
+        return CompactPatch(
+            original,
+            revised,
+            array(
+                "i",
+                [position + original_offset for position in self.original_positions],
+            ),
+            self.original_lengths,
+            array(
+                "i", [position + revised_offset for position in self.revised_positions]
+            ),
+            self.revised_lengths,
+        )
+
+    def add_delta(self, delta):
+        if self._deltas is None:
+            self._deltas = list(self.deltas)
+        super().add_delta(delta)
+
+    @property
+    def deltas(self) -> Sequence:
+        if self._deltas is not None:
+            return super().deltas
+        return CompactDeltas(self, range(len(self.original_positions)))
+
+
+class CompactDeltas(Sequence):
+    """A read-only sequence of the deltas in a CompactPatch, which are built as they're accessed"""
+
+    __slots__ = "patch", "indices"
+
+    def __init__(self, patch: CompactPatch, indices: range):
+        self.patch = patch
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CompactDeltas(self.patch, self.indices[index])
+        return self.patch.delta(self.indices[index])
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, list, CompactDeltas)):
+            return len(self) == len(other) and all(
+                delta == other_delta for delta, other_delta in zip(self, other)
+            )
+        return NotImplemented
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return "CompactDeltas({} deltas)".format(len(self))
 
 
 class PatchFailedException(Exception):
@@ -1,7 +1,7 @@
 from abc import ABCMeta, abstractmethod
-from typing import List, Sequence, TypeVar
+from typing import List, Sequence, Tuple, TypeVar
 
-from .core import Chunk, Patch
+from .core import Chunk, CompactPatch, Delta, LineView, Patch
 
 __all__ = "DiffEngine"
 
@@ -9,11 +9,40 @@ T = TypeVar("T")
 
 
 class DiffEngine(metaclass=ABCMeta):
-    @abstractmethod
     def diff(self, original: List[T], revised: List[T]) -> Patch:
         """
         Computes the difference between the original sequence and the revised sequence.
 
+        Any identical lines at the start and end of the sequences are trimmed before the engine runs,
+        so small edits in large sequences only need to diff the changed region.
+
+        :param original: The original text. Must not be None
+        :param revised: The revised text. Must not be None
+        :return: a patch object representing the difference
+        """
+        prefix, suffix = common_prefix_suffix(original, revised)
+        if not prefix and not suffix:
+            return self.compute_diff(original, revised)
+        patch = self.compute_diff(
+            original[prefix : len(original) - suffix],
+            revised[prefix : len(revised) - suffix],
+        )
+        if isinstance(patch, CompactPatch):
+            # Reference the whole sequences instead of the slices, without building any deltas
+            return patch.offset(original, revised, prefix, prefix)
+        result = Patch()
+        for delta in patch.deltas:
+            _offset_chunk(delta.original, original, prefix)
+            _offset_chunk(delta.revised, revised, prefix)
+            result.add_delta(delta)
+        return result
+
+    @abstractmethod
+    def compute_diff(self, original: List[T], revised: List[T]) -> Patch:
+        """
+        Computes the difference between the original sequence and the revised sequence,
+        without trimming the common prefix and suffix.
+
         :param original: The original text. Must not be None
         :param revised: The revised text. Must not be None
         :return: a patch object representing the difference
@@ -38,6 +67,20 @@ class DiffEngine(metaclass=ABCMeta):
             revised_chunk.position,
         )
         patch = self.diff(original_chunk.lines, revised_chunk.lines)
+        if isinstance(patch, CompactPatch):
+            # The deltas are rebuilt on every access, so build the shifted chunks directly
+            return [
+                Delta.create(
+                    Chunk(
+                        delta.original.position + original_position,
+                        delta.original.lines,
+                    ),
+                    Chunk(
+                        delta.revised.position + revised_position, delta.revised.lines
+                    ),
+                )
+                for delta in patch.deltas
+            ]
         # Correct the offsets in the deltas
         deltas = patch.deltas
         for delta in deltas:
@@ -45,6 +88,79 @@ class DiffEngine(metaclass=ABCMeta):
             delta.revised.position += revised_position
         return deltas
 
+    def rediff(
+        self, patch: Patch, revised: List[T], start: int, end: int, lines: List[T]
+    ) -> Patch:
+        """
+        Update the patch after replacing revised[start:end] with the specified lines.
+
+        Only the window between the unchanged lines around the edit is diffed again,
+        which extends over any deltas that overlap or touch the edit,
+        so the cost depends on the size of the edit instead of the size of the text.
+        The original lines in the window are recovered from the patch, so the original text isn't needed.
+
+        :param patch: the patch between the original text and the revised text before the edit
+        :param revised: the revised text before the edit
+        :param start: the index of the first replaced line
+        :param end: the index after the last replaced line, which is start for a pure insertion
+        :param lines: the lines that replace them
+        :return: the patch between the original text and the revised text after the edit
+        :exception PatchFailedException: if the patch doesn't match the revised text
+        """
+        if not 0 <= start <= end <= len(revised):
+            raise ValueError(
+                "Invalid edit {}:{} of {} lines".format(start, end, len(revised))
+            )
+        deltas = sorted(patch.deltas, key=lambda delta: delta.revised.position)
+        # The deltas before the window, and the offset from revised to original positions after them
+        first = 0
+        offset = 0
+        while first < len(deltas) and (
+            deltas[first].revised.position + len(deltas[first].revised) < start
+        ):
+            offset += len(deltas[first].original) - len(deltas[first].revised)
+            first += 1
+        # The deltas that overlap or touch the edit, which are diffed again with it
+        last = first
+        while last < len(deltas) and deltas[last].revised.position <= end:
+            last += 1
+        window_start, window_end = start, end
+        if first < last:
+            window_start = min(start, deltas[first].revised.position)
+            window_end = max(
+                end, deltas[last - 1].revised.position + len(deltas[last - 1].revised)
+            )
+        # Rebuild the original lines in the window from the unchanged lines and the deltas
+        original_start = window_start + offset
+        original_lines = []
+        position = window_start
+        for delta in deltas[first:last]:
+            delta.revised.verify(revised)
+            original_lines.extend(revised[position : delta.revised.position])
+            original_lines.extend(delta.original.lines)
+            position = delta.revised.position + len(delta.revised)
+        original_lines.extend(revised[position:window_end])
+        revised_lines = list(revised[window_start:start])
+        revised_lines.extend(lines)
+        revised_lines.extend(revised[end:window_end])
+        result = Patch()
+        for delta in deltas[:first]:
+            result.add_delta(delta)
+        for delta in self.diff_chunks(
+            Chunk(original_start, original_lines), Chunk(window_start, revised_lines)
+        ):
+            result.add_delta(delta)
+        # The deltas after the window moved by the change in the number of lines
+        shift = len(lines) - (end - start)
+        for delta in deltas[last:]:
+            if shift:
+                delta = Delta.create(
+                    delta.original,
+                    Chunk(delta.revised.position + shift, delta.revised.lines),
+                )
+            result.add_delta(delta)
+        return result
+
     def __repr__(self) -> str:
         import re
 
@@ -64,53 +180,251 @@ class DiffEngine(metaclass=ABCMeta):
         except AttributeError:
             result = []
             try:
+                result.append(DiffEngine.create(name="native-patience"))
+                result.append(DiffEngine.create(name="native", intern_lines=True))
                 result.append(DiffEngine.create(name="native"))
+                result.append(DiffEngine.create(name="native-linear-myers"))
             except ImportError:
                 pass
+            result.append(DiffEngine.create(name="plain-patience"))
+            result.append(DiffEngine.create(name="plain-histogram"))
+            result.append(DiffEngine.create(name="plain", intern_lines=True))
             result.append(DiffEngine.create(name="plain", hash_optimization=True))
+            result.append(
+                DiffEngine.create(name="plain-linear-myers", hash_optimization=True)
+            )
             result.append(DiffEngine.create(name="plain", hash_optimization=False))
             result = tuple(result)
             setattr(DiffEngine, "_available_engines", result)
             return result
 
     @staticmethod
-    def create(name=None, hash_optimization=True):
-        if name is not None and name not in (
-            "native",
-            "plain",
-            "native-myers",
-            "plain-myers",
-        ):
-            raise ValueError("Unknown engine: {}".format(name))
-        if name is None or name in ("native", "native-myers"):
+    def create(
+        name=None,
+        hash_optimization=True,
+        intern_lines=False,
+        max_cost=None,
+        hash_threads=None,
+        hash_cache=None,
+        compact=False,
+        line_views=False,
+    ):
+        """
+        Create the diff engine with the specified name.
+
+        Names are an optional implementation ('native' or 'plain') followed by the algorithm,
+        for example 'native-myers' or 'plain-patience'.
+        If the implementation is omitted, the native one is preferred when available.
+
+        The patience and histogram algorithms always intern the lines, so they ignore the hashing options.
+
+        Pathological inputs can make finding the minimum diff very expensive,
+        so if max_cost is given the engine gives up after that many differences.
+        The resulting patch is still valid, but may replace more lines than it needed to.
+
+        :param name: the name of the engine, or None for the default
+        :param hash_optimization: compare the hashes of the lines, instead of the lines themselves
+        :param intern_lines: compare integer ids of the lines, instead of their hashes
+        :param max_cost: the maximum number of differences to search for, or None to always find the minimum
+        :param hash_threads: the number of threads the native engines hash large inputs with (if built with OpenMP), or None for one per CPU
+        :param hash_cache: a LineHashCache to reuse the hashes of lines that were already diffed
+        :param compact: return a CompactPatch from the native engines, which references the lines instead of copying them
+        :param line_views: put LineViews of the lines in the chunks of the myers and native engines, instead of copying them.
+               Changing the lines afterwards also changes the patch.
+        """
+        if max_cost is not None and max_cost < 0:
+            raise ValueError("Invalid max_cost: {}".format(max_cost))
+        if hash_threads is not None and hash_threads < 1:
+            raise ValueError("Invalid hash_threads: {}".format(hash_threads))
+        implementation, algorithm = _parse_engine_name(name)
+        if implementation in (None, "native"):
             try:
+                if algorithm == "patience":
+                    from ._native.patience import native_patience_diff
+
+                    return NativeDiffEngine(
+                        algorithm=algorithm,
+                        max_cost=max_cost,
+                        compact=compact,
+                        line_views=line_views,
+                    )
                 from ._native.myers import native_diff
 
-                if not hash_optimization:
+                if not hash_optimization and not intern_lines:
                     raise ValueError(
                         "Hash optimization is always enabled with native_acceleration!"
                     )
-                return NativeDiffEngine()
+                return NativeDiffEngine(
+                    algorithm=algorithm,
+                    intern_lines=intern_lines,
+                    max_cost=max_cost,
+                    hash_threads=hash_threads,
+                    hash_cache=hash_cache,
+                    compact=compact,
+                    line_views=line_views,
+                )
             except ImportError as e:
-                if name is None:
+                if implementation is None:
                     pass
                 else:
                     raise ImportError("Unable to import native implementation!") from e
-        assert name is None or name in ("plain-myers", "plain")
-        from ._myers import MyersEngine
+        assert implementation in (None, "plain")
+        if algorithm == "patience":
+            from ._patience import PatienceEngine
+
+            return PatienceEngine(max_cost=max_cost)
+        elif algorithm == "histogram":
+            from ._histogram import HistogramEngine
+
+            return HistogramEngine(max_cost=max_cost)
+        from ._myers import LinearMyersEngine, MyersEngine
+
+        if algorithm == "linear-myers":
+            engine_type = LinearMyersEngine
+        else:
+            engine_type = MyersEngine
+        return engine_type(
+            hash_optimization=hash_optimization,
+            intern_lines=intern_lines,
+            max_cost=max_cost,
+            hash_cache=hash_cache,
+            line_views=line_views,
+        )
+
 
-        return MyersEngine(hash_optimization=hash_optimization)
+def _offset_chunk(chunk: Chunk, sequence, offset: int):
+    """Move the chunk of a slice by the offset, so any view references the sequence instead of the slice"""
+    chunk.position += offset
+    if type(chunk.lines) is LineView:
+        chunk.lines = LineView(
+            sequence, chunk.position, chunk.position + len(chunk.lines)
+        )
+
+
+ALGORITHMS = ("myers", "linear-myers", "patience", "histogram")
+# The algorithms that have a native implementation
+NATIVE_ALGORITHMS = ("myers", "linear-myers", "patience")
+
+
+def _parse_engine_name(name):
+    """Split the name of an engine into its implementation and algorithm"""
+    if name is None:
+        return None, "myers"
+    elif name in ("native", "plain"):
+        return name, "myers"
+    implementation, _, algorithm = name.partition("-")
+    if implementation not in ("native", "plain"):
+        implementation, algorithm = None, name
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unknown engine: {}".format(name))
+    elif algorithm not in NATIVE_ALGORITHMS:
+        if implementation == "native":
+            raise ValueError("Unknown engine: {}".format(name))
+        # There's only a plain implementation
+        implementation = "plain"
+    return implementation, algorithm
 
 
 class NativeDiffEngine(DiffEngine):
+    def __init__(
+        self,
+        algorithm="myers",
+        intern_lines=False,
+        max_cost=None,
+        hash_threads=None,
+        hash_cache=None,
+        compact=False,
+        line_views=False,
+    ):
+        assert algorithm in NATIVE_ALGORITHMS, algorithm
+        self.algorithm = algorithm
+        self.intern_lines = intern_lines
+        self.max_cost = max_cost
+        self.hash_threads = hash_threads
+        self.hash_cache = hash_cache
+        self.compact = compact
+        self.line_views = line_views
+
     def diff(self, original, revised) -> Patch:
+        from ._native.myers import BufferLines
+
+        if type(original) is BufferLines and type(revised) is BufferLines:
+            # NOTE: Trimming would decode every line, but the native engines skip them just as fast
+            return self.compute_diff(original, revised)
+        return super().diff(original, revised)
+
+    def compute_diff(self, original, revised) -> Patch:
+        if self.algorithm == "patience":
+            from ._native.patience import native_patience_diff
+
+            return native_patience_diff(
+                original,
+                revised,
+                max_cost=self.max_cost,
+                compact=self.compact,
+                line_views=self.line_views,
+            )
         from ._native.myers import native_diff
 
-        return native_diff(original, revised)
+        return native_diff(
+            original,
+            revised,
+            linear=self.algorithm == "linear-myers",
+            intern_lines=self.intern_lines,
+            max_cost=self.max_cost,
+            hash_threads=self.hash_threads,
+            hash_cache=self.hash_cache,
+            compact=self.compact,
+            line_views=self.line_views,
+        )
 
     @property
     def name(self):
-        return "native-myers"
+        return "native-" + self.algorithm
+
+    def __repr__(self):
+        if self.intern_lines:
+            return super().__repr__() + "(intern_lines=True)"
+        return super().__repr__()
+
+
+# NOTE: Comparing slices is done entirely in C, so it's much faster than comparing each line in python
+_TRIM_BLOCK_SIZE = 64
+
+
+def common_prefix_suffix(
+    original: Sequence[T], revised: Sequence[T]
+) -> Tuple[int, int]:
+    """
+    Return the number of identical lines at the start and end of the sequences.
+
+    The prefix and suffix never overlap, so they can both be trimmed at once.
+    """
+    max_size = min(len(original), len(revised))
+    prefix = 0
+    while prefix < max_size:
+        end = min(prefix + _TRIM_BLOCK_SIZE, max_size)
+        if original[prefix:end] == revised[prefix:end]:
+            prefix = end
+            continue
+        while original[prefix] == revised[prefix]:
+            prefix += 1
+        break
+    max_size -= prefix
+    original_end, revised_end = len(original), len(revised)
+    suffix = 0
+    while suffix < max_size:
+        size = min(suffix + _TRIM_BLOCK_SIZE, max_size)
+        if (
+            original[original_end - size : original_end - suffix]
+            == revised[revised_end - size : revised_end - suffix]
+        ):
+            suffix = size
+            continue
+        while original[original_end - suffix - 1] == revised[revised_end - suffix - 1]:
+            suffix += 1
+        break
+    return prefix, suffix
 
 
 DiffEngine.INSTANCE = DiffEngine.create()
@@ -0,0 +1,280 @@
+# Copyright 2015 Techcable
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+from pathlib import PurePosixPath
+from typing import Iterator, List, Optional, Tuple
+
+from .api import PatchFormatError, parse_unified_diff
+from .core import Patch
+
+__all__ = ("PatchSet", "PatchSetEntry", "DEV_NULL")
+
+# The file name used for the missing side of a created or deleted file
+DEV_NULL = "/dev/null"
+
+_HUNK_HEADER_RE = re.compile(rb"^@@\s+-\d+(?:,(\d+))?\s+\+\d+(?:,(\d+))?\s+@@")
+
+# The escapes git uses in quoted file names, besides octal escapes of each byte
+_QUOTED_ESCAPES = {
+    b"a": b"\a",
+    b"b": b"\b",
+    b"t": b"\t",
+    b"n": b"\n",
+    b"v": b"\v",
+    b"f": b"\f",
+    b"r": b"\r",
+    b'"': b'"',
+    b"\\": b"\\",
+}
+_QUOTED_NAME_RE = re.compile(rb'^"((?:[^"\\]|\\.)*)"')
+_QUOTED_ESCAPE_RE = re.compile(rb"\\([0-7]{3}|.)")
+
+
+class PatchSetEntry:
+    """
+    The location of a single file's patch inside a multi-file unified diff.
+
+    Entries only remember where the patch is, so they're cheap to send to other processes,
+    and each one can be parsed independently by seeking straight to its offset.
+    """
+
+    __slots__ = (
+        "path",
+        "original_file",
+        "revised_file",
+        "offset",
+        "size",
+        "line_number",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        original_file: str,
+        revised_file: str,
+        offset: int,
+        size: int,
+        line_number: int,
+    ):
+        self.path = path
+        self.original_file = original_file
+        self.revised_file = revised_file
+        self.offset = offset
+        self.size = size
+        self.line_number = line_number
+
+    @property
+    def is_created(self) -> bool:
+        return self.original_file == DEV_NULL
+
+    @property
+    def is_deleted(self) -> bool:
+        return self.revised_file == DEV_NULL
+
+    @property
+    def name(self) -> str:
+        """The name of the patched file, which is the original name if the file was deleted"""
+        return self.original_file if self.is_deleted else self.revised_file
+
+    def relative_path(self, strip=0) -> PurePosixPath:
+        """
+        The name of the patched file, without its first strip components.
+
+        Git prefixes the names with 'a/' and 'b/', which can be removed by stripping a single component.
+
+        :exception PatchFormatError: if the path is absolute or has '..' components, which could escape the directory being patched
+        """
+        parts = PurePosixPath(self.name).parts
+        if len(parts) <= strip:
+            raise ValueError(
+                "Can't strip {} components from {}".format(strip, self.name)
+            )
+        result = PurePosixPath(*parts[strip:])
+        if result.is_absolute() or ".." in result.parts:
+            raise PatchFormatError(
+                "Unsafe file name {!r}".format(self.name), self.line_number, self.name
+            )
+        return result
+
+    def lines(self) -> Iterator[str]:
+        """Read the lines of this file's patch, without reading the rest of the patch set"""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            remaining = self.size
+            while remaining > 0:
+                line = f.readline(remaining)
+                if not line:
+                    break
+                remaining -= len(line)
+                yield line.decode("utf-8").rstrip("\r\n")
+
+    def parse(self, lenient=False) -> Patch:
+        """
+        Parse this file's patch.
+
+        :exception PatchFormatError: if the patch is malformed, with the line number in the entire patch set
+        """
+        return parse_unified_diff(
+            self.lines(), lenient=lenient, start_line=self.line_number
+        )
+
+    def __eq__(self, other):
+        if isinstance(other, PatchSetEntry):
+            return all(
+                getattr(self, name) == getattr(other, name) for name in self.__slots__
+            )
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        return "PatchSetEntry({!r}, offset={}, size={})".format(
+            self.name, self.offset, self.size
+        )
+
+
+class PatchSet:
+    """
+    A multi-file unified diff, like the output of `git diff`.
+
+    Building the patch set only indexes the offsets of each file,
+    so callers only pay to parse the files they actually need.
+    """
+
+    __slots__ = "path", "entries"
+
+    def __init__(self, path: str, entries: List[PatchSetEntry]):
+        self.path = path
+        self.entries = entries
+
+    @staticmethod
+    def index(path) -> "PatchSet":
+        """
+        Index the patch of each file in the unified diff at the specified path.
+
+        Each file starts at a 'diff' line or a '---' line outside a hunk,
+        and the hunk headers are used to skip over the hunk contents, so removed lines starting with '--' are never mistaken for headers.
+        Sections without any hunks (like git's binary or rename-only changes) are skipped.
+        """
+        path = str(path)
+        entries = []
+        # The section of the current file: start offset, start line, end offset, and the file names
+        start, start_line, end = None, None, None
+        original_file, revised_file = None, None  # type: Optional[str], Optional[str]
+        has_hunks = False
+        # Whether the current file started with a 'diff' line, which comes before its '---' line
+        has_diff_line = False
+        remaining_original, remaining_revised = 0, 0
+
+        def finish():
+            if start is not None and has_hunks and revised_file is not None:
+                entries.append(
+                    PatchSetEntry(
+                        path,
+                        original_file,
+                        revised_file,
+                        start,
+                        end - start,
+                        start_line,
+                    )
+                )
+
+        offset = 0
+        with open(path, "rb") as f:
+            for line_number, line in enumerate(f, 1):
+                next_offset = offset + len(line)
+                if remaining_original > 0 or remaining_revised > 0:
+                    tag = line[:1]
+                    if tag == b"-":
+                        remaining_original -= 1
+                    elif tag == b"+":
+                        remaining_revised -= 1
+                    elif tag != b"\\":
+                        # Context lines (including empty ones) are in both sides
+                        remaining_original -= 1
+                        remaining_revised -= 1
+                    end = next_offset
+                elif line.startswith(b"diff ") or (
+                    line.startswith(b"--- ")
+                    and not (has_diff_line and original_file is None)
+                ):
+                    finish()
+                    start, start_line, end = offset, line_number, next_offset
+                    original_file, revised_file = None, None
+                    has_hunks = False
+                    has_diff_line = line.startswith(b"diff ")
+                    if not has_diff_line:
+                        original_file = _parse_file_name(line)
+                elif start is not None and line.startswith(b"--- "):
+                    original_file = _parse_file_name(line)
+                    end = next_offset
+                elif start is not None and line.startswith(b"+++ "):
+                    revised_file = _parse_file_name(line)
+                    end = next_offset
+                elif revised_file is not None:
+                    match = _HUNK_HEADER_RE.match(line)
+                    if match is not None:
+                        has_hunks = True
+                        # NOTE: An omitted count means a single line
+                        remaining_original = int(match.group(1) or 1)
+                        remaining_revised = int(match.group(2) or 1)
+                        end = next_offset
+                offset = next_offset
+        finish()
+        return PatchSet(path, entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[PatchSetEntry]:
+        return iter(self.entries)
+
+    def __getitem__(self, name: str) -> PatchSetEntry:
+        """Find the entry for the file with the specified (original or revised) name"""
+        for entry in self.entries:
+            if name in (entry.original_file, entry.revised_file):
+                return entry
+        raise KeyError(name)
+
+    def patches(self, lenient=False) -> Iterator[Tuple[PatchSetEntry, Patch]]:
+        """Parse the patch of each file in order"""
+        for entry in self.entries:
+            yield entry, entry.parse(lenient=lenient)
+
+    def __repr__(self):
+        return "PatchSet({!r}, {} files)".format(self.path, len(self.entries))
+
+
+def _parse_file_name(line: bytes) -> str:
+    """
+    Parse the file name from a '---' or '+++' line, ignoring any trailing timestamp.
+
+    The timestamp is separated by a tab, so names can contain spaces.
+    Git quotes names with unusual characters like a C string, escaping the bytes that aren't printable.
+    """
+    text = line[4:].rstrip(b"\r\n")
+    match = _QUOTED_NAME_RE.match(text)
+    if match is not None:
+        name = _QUOTED_ESCAPE_RE.sub(_unescape_quoted, match.group(1))
+    else:
+        name = text.split(b"\t", 1)[0]
+    return name.decode("utf-8")
+
+
+def _unescape_quoted(match) -> bytes:
+    escape = match.group(1)
+    if len(escape) == 3:
+        return bytes((int(escape, 8),))
+    return _QUOTED_ESCAPES.get(escape, escape)
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
 import os
-import sys
 
 from Cython.Build import cythonize
 from setuptools import find_packages, setup
+from setuptools.command.build_ext import build_ext
 from setuptools.extension import Extension
 
 debug_str = os.getenv("DEBUG")
@@ -25,18 +25,53 @@ else:
         opt_level = "3"
     compile_args.append("-O{}".format(opt_level))
 
+
+def compiler_supports_openmp(compiler):
+    """Check if the C compiler can build and link a program with -fopenmp"""
+    import tempfile
+
+    from setuptools.errors import CompileError, LinkError
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = os.path.join(temp_dir, "check_openmp.c")
+        with open(source, "w") as f:
+            f.write(
+                "#include <omp.h>\nint main(void) { return omp_get_max_threads() < 1; }\n"
+            )
+        try:
+            objects = compiler.compile(
+                [source], output_dir=temp_dir, extra_postargs=["-fopenmp"]
+            )
+            compiler.link_executable(
+                objects,
+                os.path.join(temp_dir, "check_openmp"),
+                extra_postargs=["-fopenmp"],
+            )
+        except (CompileError, LinkError):
+            return False
+    return True
+
+
+openmp_str = os.getenv("OPENMP")
+if openmp_str is None:
+    # NOTE: Decided by probing the compiler, but only once we're actually building the extensions
+    openmp = None
+else:
+    openmp = openmp_str.lower() not in ("false", "no", "n", "0")
+
 hash_impl = os.getenv("HASH_IMPL")
 if hash_impl is None:
-    if sys.platform == "linux" or "bsd" in sys.platform:
-        # Default to openssl on linux and bsd, where it's included by default
-        # and kept up to date and secure.
-        hash_impl = "openssl"
-    else:
-        # Fallback to hashlib on all other systems, since openssl either isn't included (windows),
-        # or it uses an outdated and insecure version (mac).
-        hash_impl = "hashlib"
+    # Default to a fast non-cryptographic hash, which has no dependencies.
+    # Since the lines are verified whenever their hashes match, collisions can't cause incorrect diffs.
+    hash_impl = "fast"
 extra_sources, libraries, compile_time_env = [], [], {}
-if hash_impl in ("openssl",):
+compile_time_env["USE_FAST_HASH"] = 0
+if hash_impl == "fast":
+    print("Using fast 64-bit hashing")
+    compile_time_env["USE_HASHLIB"] = 0
+    compile_time_env["USE_FAST_HASH"] = 1
+    extra_sources.append("diffutils/_native/hashing/fast_hasher.c")
+elif hash_impl in ("openssl",):
     compile_time_env["USE_HASHLIB"] = 0
     extra_sources.append("diffutils/_native/hashing/shared_hasher.c")
     if hash_impl == "openssl":
@@ -51,6 +86,44 @@ elif hash_impl == "hashlib":
 else:
     raise AssertionError("Unknown hash impl: {}".format(hash_impl))
 
+# The extensions that hash lines on multiple threads when OpenMP is available
+openmp_extensions = {"diffutils._native.myers"}
+
+
+class BuildExt(build_ext):
+    """Cythonize the extensions right before they're built, once we know if the compiler supports OpenMP"""
+
+    def build_extensions(self):
+        use_openmp = openmp
+        # NOTE: Without OpenMP the lines are still hashed correctly, just on a single thread.
+        # By default we only use it if the compiler supports -fopenmp (MSVC wants /openmp, and Apple's clang has no OpenMP at all)
+        if use_openmp is None:
+            use_openmp = compiler_supports_openmp(self.compiler)
+            if not use_openmp:
+                print(
+                    "The compiler doesn't support -fopenmp, so lines will be hashed on a single thread"
+                )
+        if use_openmp:
+            print("Using OpenMP threads for hashing")
+            for extension in self.extensions:
+                if extension.name in openmp_extensions:
+                    extension.extra_compile_args = [
+                        *extension.extra_compile_args,
+                        "-fopenmp",
+                    ]
+                    extension.extra_link_args = [*extension.extra_link_args, "-fopenmp"]
+        cythonized = cythonize(
+            self.extensions,
+            compile_time_env=dict(compile_time_env, USE_OPENMP=int(use_openmp)),
+            gdb_debug=debug,
+            force=self.force,
+        )
+        # NOTE: Keep setuptools' own extensions, just building the generated C sources instead
+        for extension, cythonized_extension in zip(self.extensions, cythonized):
+            extension.sources = cythonized_extension.sources
+        super().build_extensions()
+
+
 setup(
     name="diffutils",
     version="1.0.7",
@@ -59,16 +132,20 @@ setup(
     author_email="Techcable@outlook.com",
     packages=find_packages(include="diffutils*"),
     requires=["argh"],
-    ext_modules=cythonize(
+    ext_modules=[
         Extension(
             "diffutils._native.myers",
             sources=["diffutils/_native/myers.pyx", *extra_sources],
             extra_compile_args=compile_args,
             libraries=libraries,
         ),
-        compile_time_env=compile_time_env,
-        gdb_debug=debug,
-    ),
+        Extension(
+            "diffutils._native.patience",
+            sources=["diffutils/_native/patience.pyx"],
+            extra_compile_args=compile_args,
+        ),
+    ],
+    cmdclass={"build_ext": BuildExt},
     keywords="diff patch myers",
     license="MIT",
     classifiers=[
@@ -1,7 +1,11 @@
+import io
+import random
+import warnings
+
 import pytest
 
 import diffutils
-from diffutils.engine import DiffEngine
+from diffutils.engine import DiffEngine, common_prefix_suffix
 
 original_text = [
     "Once upon a time there was a snail named Bob",
@@ -63,3 +67,977 @@ def test_native():
 
 def test_plain():
     do_test_engine(DiffEngine.create(name="plain"))
+
+
+def test_native_linear():
+    do_test_engine(DiffEngine.create(name="native-linear-myers"))
+
+
+def test_plain_linear():
+    do_test_engine(DiffEngine.create(name="plain-linear-myers"))
+
+
+def test_native_interned():
+    do_test_engine(DiffEngine.create(name="native", intern_lines=True))
+
+
+def test_plain_interned():
+    do_test_engine(DiffEngine.create(name="plain", intern_lines=True))
+
+
+@pytest.mark.parametrize("name", ["plain", "native"])
+def test_interned_elements(name):
+    engine = DiffEngine.create(name=name, intern_lines=True)
+    original = [1, (2, 3), "four", 5, None]
+    revised = [1, "four", 6, None, (2, 3)]
+    assert engine.diff(original, revised).apply_to(original) == revised
+
+
+def test_native_patience():
+    do_test_engine(DiffEngine.create(name="native-patience"))
+
+
+def test_plain_patience():
+    do_test_engine(DiffEngine.create(name="plain-patience"))
+
+
+def test_patience_anchors():
+    from diffutils._patience import find_anchors
+
+    original = ["}", "a", "}", "b", "}", "c", "d"]
+    revised = ["}", "c", "}", "a", "}", "b", "d", "}"]
+    # The braces are never anchors, and c can't be part of the increasing sequence
+    assert find_anchors(original, revised, 0, 7, 0, 8) == [(1, 3), (3, 5), (6, 6)]
+
+
+@pytest.mark.parametrize("name", ["plain-patience", "native-patience"])
+def test_patience_fuzz(name):
+    engine = DiffEngine.create(name=name)
+    rng = random.Random(7)
+    for _ in range(500):
+        original = [rng.choice("abcdefgh") for _ in range(rng.randint(0, 30))]
+        revised = [rng.choice("abcdefgh") for _ in range(rng.randint(0, 30))]
+        assert engine.diff(original, revised).apply_to(original) == revised
+
+
+def test_plain_histogram():
+    do_test_engine(DiffEngine.create(name="histogram"))
+
+
+def test_histogram_split():
+    from diffutils._histogram import find_split
+
+    original = ["}", "a", "}", "b", "c", "}"]
+    revised = ["x", "}", "b", "c", "}", "a"]
+    # The region containing the rarest lines is preferred, even though braces are common
+    assert find_split(original, revised, 0, 6, 0, 6) == (True, (2, 6, 1, 5))
+    assert find_split(["a", "b"], ["c", "d"], 0, 2, 0, 2) == (False, None)
+    assert find_split(["a", "a"], ["b", "a"], 0, 2, 0, 2, max_chain_length=1) == (
+        True,
+        None,
+    )
+
+
+def test_histogram_fuzz():
+    engine = DiffEngine.create(name="histogram")
+    rng = random.Random(11)
+    for _ in range(500):
+        original = [rng.choice("abcdefgh") for _ in range(rng.randint(0, 30))]
+        revised = [rng.choice("abcdefgh") for _ in range(rng.randint(0, 30))]
+        assert engine.diff(original, revised).apply_to(original) == revised
+
+
+def diff_cost(patch):
+    return sum(len(delta.original) + len(delta.revised) for delta in patch.deltas)
+
+
+@pytest.mark.parametrize("name", ["plain-linear-myers", "native-linear-myers"])
+def test_linear_is_minimal(name):
+    engine = DiffEngine.create(name=name)
+    reference = DiffEngine.create(name="plain")
+    rng = random.Random(42)
+    for _ in range(500):
+        original = [rng.choice("abcd") for _ in range(rng.randint(0, 20))]
+        revised = [rng.choice("abcd") for _ in range(rng.randint(0, 20))]
+        patch = engine.diff(original, revised)
+        assert patch.apply_to(original) == revised
+        assert diff_cost(patch) == diff_cost(reference.diff(original, revised))
+
+
+@pytest.mark.parametrize(
+    "name", ["plain", "native", "plain-linear-myers", "native-linear-myers"]
+)
+def test_max_cost(name):
+    engine = DiffEngine.create(name=name, max_cost=3)
+    reference = DiffEngine.create(name="plain")
+    rng = random.Random(42)
+    for _ in range(500):
+        original = [rng.choice("abcd") for _ in range(rng.randint(0, 20))]
+        revised = [rng.choice("abcd") for _ in range(rng.randint(0, 20))]
+        patch = engine.diff(original, revised)
+        assert patch.apply_to(original) == revised
+        minimum = diff_cost(reference.diff(original, revised))
+        # Cheap diffs are still minimal, but expensive ones are only valid
+        if minimum <= 3:
+            assert diff_cost(patch) == minimum
+        else:
+            assert diff_cost(patch) >= minimum
+
+
+def test_max_cost_api():
+    original = ["a", "b", "c", "d", "e", "f"]
+    revised = ["1", "b", "2", "d", "3", "f"]
+    assert diffutils.diff(original, revised).apply_to(original) == revised
+    patch = diffutils.diff(original, revised, max_cost=1)
+    assert patch.apply_to(original) == revised
+    with pytest.raises(ValueError):
+        DiffEngine.create(max_cost=-1)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_diff_many(workers):
+    rng = random.Random(4)
+    pairs = []
+    for _ in range(600):
+        original = [rng.choice("abcde") for _ in range(rng.randint(0, 12))]
+        revised = [
+            line if rng.random() < 0.7 else rng.choice("abcde") for line in original
+        ]
+        pairs.append((original, revised))
+    pairs.append(("first\nsecond", "first\nthird"))
+    patches = diffutils.diff_many(iter(pairs), workers=workers)
+    assert len(patches) == len(pairs)
+    for (original, revised), patch in zip(pairs[:-1], patches):
+        if original == revised:
+            assert patch is None
+        else:
+            assert patch.apply_to(original) == revised
+    assert patches[-1].apply_to(["first", "second"]) == ["first", "third"]
+
+
+@pytest.mark.parametrize("engine", DiffEngine.available_engines(), ids=repr)
+def test_leading_delta(engine):
+    patch = engine.diff(["a", "b", "c"], ["x", "b", "c"])
+    assert len(patch.deltas) == 1
+    delta = patch.deltas[0]
+    assert delta.original.position == 0 and delta.original.lines == ["a"]
+    assert delta.revised.position == 0 and delta.revised.lines == ["x"]
+
+
+def test_common_prefix_suffix():
+    original = ["line {}".format(index) for index in range(500)]
+    revised = list(original)
+    revised[200:202] = ["changed"]
+    assert common_prefix_suffix(original, revised) == (200, 298)
+    assert common_prefix_suffix(original, original) == (500, 0)
+    assert common_prefix_suffix(["a", "b"], ["b"]) == (0, 1)
+
+
+@pytest.mark.parametrize("engine", DiffEngine.available_engines(), ids=repr)
+def test_trimmed_positions(engine):
+    original = ["line {}".format(index) for index in range(500)]
+    revised = list(original)
+    revised[200:202] = ["changed"]
+    revised.insert(400, "inserted")
+    deltas = engine.diff(original, revised).deltas
+    assert [(d.original.position, d.revised.position) for d in deltas] == [
+        (200, 200),
+        (401, 400),
+    ]
+    assert engine.diff(original, revised).apply_to(original) == revised
+
+
+def test_parse_stream():
+    patch = diffutils.diff(original_text, changed_text)
+    unified_diff = diffutils.generate_unified_diff("a", "b", original_text, patch, 1)
+    stream = io.StringIO("".join(line + "\n" for line in unified_diff))
+    deltas = diffutils.iter_unified_diff(stream)
+    assert next(deltas) == patch.deltas[0]
+    assert list(deltas) == list(patch.deltas[1:])
+
+
+def test_parse_error_line():
+    unified_diff = ["--- a", "+++ b", "@@ -1,2 +1,2 @@", "-a", "+b"]
+    with pytest.raises(diffutils.api.PatchFormatError) as e:
+        diffutils.parse_unified_diff(iter(unified_diff))
+    assert e.value.line_number == 3
+    assert e.value.line == "@@ -1,2 +1,2 @@"
+
+
+def test_parse_truncated():
+    header = ["--- a", "+++ b", "@@ -1 +1 @@"]
+    stream = io.StringIO("".join(line + "\n" for line in header))
+    with pytest.raises(diffutils.api.PatchFormatError) as e:
+        list(diffutils.iter_unified_diff(stream))
+    assert e.value.line_number == 3
+    assert "Expected 1 original lines, but got 0" in str(e.value)
+    # A header directly followed by the next one is just as empty
+    unified_diff = header + ["@@ -3 +3 @@", "-a", "+b"]
+    with pytest.raises(diffutils.api.PatchFormatError) as e:
+        diffutils.parse_unified_diff(unified_diff)
+    assert e.value.line_number == 3
+
+
+def test_patch_set(tmp_path):
+    patch_file = tmp_path / "changes.patch"
+    patch_file.write_text(
+        "\n".join(
+            [
+                "Some commit message",
+                "diff --git a/first b/first",
+                "index 1234567..89abcde 100644",
+                "--- a/first",
+                "+++ b/first",
+                "@@ -1,3 +1,2 @@",
+                " a",
+                "--- removed line that looks like a header",
+                " b",
+                "diff --git a/image.png b/image.png",
+                "Binary files a/image.png and b/image.png differ",
+                "diff --git a/second b/second",
+                "new file mode 100644",
+                "--- /dev/null",
+                "+++ b/second",
+                "@@ -0,0 +1,2 @@",
+                "+c",
+                "+d",
+                "",
+            ]
+        )
+    )
+    patch_set = diffutils.PatchSet.index(patch_file)
+    assert [entry.name for entry in patch_set] == ["b/first", "b/second"]
+    first, second = patch_set.entries
+    assert str(first.relative_path(strip=1)) == "first"
+    assert first.parse().apply_to(
+        ["a", "-- removed line that looks like a header", "b"]
+    ) == ["a", "b"]
+    assert second.is_created and not second.is_deleted
+    assert patch_set["b/second"].parse().apply_to([]) == ["c", "d"]
+    with patch_file.open("rb") as f:
+        f.seek(second.offset)
+        assert f.read(second.size).splitlines()[0] == b"diff --git a/second b/second"
+
+
+def test_patch_set_error_line(tmp_path):
+    patch_file = tmp_path / "changes.patch"
+    patch_file.write_text(
+        "--- a/first\n+++ b/first\n@@ -1 +1 @@\n-a\n+b\n"
+        "--- a/second\n+++ b/second\n@@ -1,2 +1,1 @@\n-a\n+b\n"
+    )
+    first, second = diffutils.PatchSet.index(patch_file).entries
+    assert first.parse().apply_to(["a"]) == ["b"]
+    with pytest.raises(diffutils.api.PatchFormatError) as e:
+        second.parse()
+    assert e.value.line_number == 8
+
+
+def test_patch_set_file_names(tmp_path):
+    patch_file = tmp_path / "changes.patch"
+    patch_file.write_bytes(
+        b"--- a/my file.txt\t2020-01-01 00:00:00.000000000 +0000\n"
+        b"+++ b/my file.txt\t2020-01-02 00:00:00.000000000 +0000\n"
+        b"@@ -1 +1 @@\n-a\n+b\n"
+        b'diff --git "a/t\\303\\251st\\t\\"1\\"" "b/t\\303\\251st\\t\\"1\\""\n'
+        b'--- "a/t\\303\\251st\\t\\"1\\""\n'
+        b'+++ "b/t\\303\\251st\\t\\"1\\""\n'
+        b"@@ -1 +1 @@\n-a\n+b\n"
+    )
+    first, second = diffutils.PatchSet.index(patch_file).entries
+    assert first.original_file == "a/my file.txt"
+    assert str(first.relative_path(strip=1)) == "my file.txt"
+    assert second.name == 'b/t\u00e9st\t"1"'
+
+
+@pytest.mark.parametrize("context_size", [0, 1, 3])
+def test_parse_preserves_deltas(context_size):
+    rng = random.Random(42)
+    for _ in range(200):
+        original = [rng.choice("abcd") for _ in range(rng.randint(0, 30))]
+        revised = [rng.choice("abcd") for _ in range(rng.randint(0, 30))]
+        patch = diffutils.diff(original, revised)
+        if patch is None:
+            continue
+        unified_diff = diffutils.generate_unified_diff(
+            "a", "b", original, patch, context_size
+        )
+        assert diffutils.parse_unified_diff(unified_diff).deltas == patch.deltas
+
+
+@pytest.mark.parametrize(
+    "name", ["plain", "native", "native-linear-myers", "native-patience"]
+)
+def test_diff_files(name, tmp_path):
+    original_file, revised_file = tmp_path / "original", tmp_path / "revised"
+    original_file.write_bytes("\n".join(original_text).encode("utf-8") + b"\n")
+    revised_file.write_bytes("\r\n".join(changed_text).encode("utf-8"))
+    patch = diffutils.diff_files(
+        original_file, revised_file, engine=DiffEngine.create(name=name)
+    )
+    assert patch.apply_to(original_text) == changed_text
+
+
+def test_map_lines(tmp_path):
+    path = tmp_path / "lines"
+    path.write_bytes(b"first\r\n\nthird \xe2\x9c\x93\nlast")
+    with diffutils.api.map_lines(path) as lines:
+        assert len(lines) == 4
+        assert lines[:] == ["first", "", "third ✓", "last"]
+        assert lines[-1] == "last"
+    path.write_bytes(b"")
+    with diffutils.api.map_lines(path) as lines:
+        assert len(lines) == 0
+
+
+def test_native_bytes():
+    from diffutils._native.myers import BufferLines, native_diff
+
+    original = [line.encode("utf-8") for line in original_text]
+    revised = [line.encode("utf-8") for line in changed_text]
+    patch = native_diff(original, revised)
+    assert patch.apply_to(original) == revised
+    # Pass each side as a single buffer, with the offsets of the lines
+    buffers, offsets = [], []
+    for lines in (original, revised):
+        buffers.append(b"".join(lines))
+        offsets.append([0])
+        for line in lines:
+            offsets[-1].append(offsets[-1][-1] + len(line))
+    patch = native_diff(
+        BufferLines(buffers[0], offsets[0], decode=False),
+        BufferLines(buffers[1], offsets[1], decode=False),
+    )
+    assert patch.apply_to(original) == revised
+    patch = native_diff(
+        BufferLines(buffers[0], offsets[0]), BufferLines(buffers[1], offsets[1])
+    )
+    assert patch.apply_to(original_text) == changed_text
+    # Strings and bytes with the same data still aren't equal lines
+    with pytest.raises(TypeError):
+        native_diff(["x", "a"], ["x", b"a"])
+
+
+def test_native_similar_lines():
+    from diffutils._native.myers import native_diff
+
+    # Lines that only differ in a single byte (at every offset the hash handles differently)
+    original = ["x" * size for size in range(40)]
+    original += ["x" * 31 + chr(ord("a") + index) for index in range(8)]
+    revised = [line[:-1] + "y" if len(line) % 3 == 0 else line for line in original]
+    patch = native_diff(original, revised)
+    assert patch.apply_to(original) == revised
+    assert not native_diff(original, list(original)).deltas
+
+
+def fast_hash_collision(line: bytes, prefix: bytes) -> bytes:
+    """
+    Craft a 16 byte line that starts with the 8 byte prefix, and has the same fast_hash64 as the 16 byte line.
+
+    Each 8 byte block is mixed into the state with invertible steps,
+    so we can pick the second block to reach the same state as the line.
+    """
+    import sys
+
+    mask = (1 << 64) - 1
+    prime1, prime2 = 0x9E3779B185EBCA87, 0xC2B2AE3D27D4EB4F
+    prime4, prime5 = 0x85EBCA77C2B2AE63, 0x27D4EB2F165667C5
+
+    def rotl(value, amount):
+        return ((value << amount) | (value >> (64 - amount))) & mask
+
+    def mix(value):
+        return rotl(value * prime2 & mask, 31) * prime1 & mask
+
+    def unmix(value):
+        value = rotl(value * pow(prime1, -1, 1 << 64) & mask, 33)
+        return value * pow(prime2, -1, 1 << 64) & mask
+
+    def block(state, value):
+        return (rotl(state ^ mix(value), 27) * prime1 + prime4) & mask
+
+    first, second = (
+        int.from_bytes(line[index : index + 8], sys.byteorder) for index in (0, 8)
+    )
+    state = prime5 + 16
+    target = block(state, first) ^ mix(second)
+    rest = unmix(block(state, int.from_bytes(prefix, sys.byteorder)) ^ target)
+    return prefix + rest.to_bytes(8, sys.byteorder)
+
+
+def test_native_hash_collisions():
+    from diffutils._native.myers import native_diff
+
+    first = b"collide!" * 2
+    second = fast_hash_collision(first, b"another ")
+    assert first != second
+    # Colliding lines are compared byte by byte, so they're still different lines
+    for lines in (
+        [first, second],
+        [line.decode("latin-1") for line in (first, second)],
+    ):
+        original, revised = [lines[0], lines[0]], [lines[1], lines[0]]
+        patch = native_diff(original, revised)
+        assert patch.apply_to(original) == revised
+        assert diff_cost(patch) == 2
+        assert diff_cost(native_diff([lines[0]], [lines[1]])) == 2
+
+
+def test_native_wide_strings():
+    import sys
+
+    from diffutils._native.myers import FAST_HASH, native_diff
+
+    original = ["caf\xe9", "€ 1", "\U0001f600", "\x00\x01", "end"]
+    revised = ["caf\xe9", "€ 2", "\U0001f600", "Ā", "end"]
+    sizes = [sys.getsizeof(line) for line in original + revised]
+    patch = native_diff(original, revised)
+    assert patch.apply_to(original) == revised
+    # The fast hash uses the lines in place, without caching a UTF-8 copy in each of them.
+    # The sha256 builds hash UTF-8, so their hashes match the plain engines in a LineHashCache.
+    if FAST_HASH:
+        assert [sys.getsizeof(line) for line in original + revised] == sizes
+    # '\x00\x01' and 'Ā' have the same bytes, but not the same width
+    assert [delta.original.position for delta in patch.deltas] == [1, 3]
+
+
+def test_native_hash_threads():
+    # Large enough to be split between the threads
+    original = ["line {}".format(index) for index in range(50000)]
+    revised = list(original)
+    revised[10], revised[40000] = "first", "second"
+    patches = [
+        DiffEngine.create(name="native", hash_threads=threads).diff(original, revised)
+        for threads in (1, 4)
+    ]
+    assert patches[0] == patches[1]
+    assert patches[1].apply_to(original) == revised
+    with pytest.raises(ValueError):
+        DiffEngine.create(name="native", hash_threads=0)
+    # Without OpenMP, asking for more threads warns instead of silently using one
+    from diffutils._native.myers import OPENMP, native_diff
+
+    if OPENMP:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            native_diff(original, revised, hash_threads=4)
+    else:
+        with pytest.warns(RuntimeWarning):
+            native_diff(original, revised, hash_threads=4)
+
+
+def test_aio():
+    import asyncio
+    import threading
+
+    from diffutils import aio
+
+    original, revised = ["a", "b", "c"], ["a", "x", "c"]
+
+    async def run():
+        patches = await asyncio.gather(*(aio.diff(original, revised) for _ in range(4)))
+        assert all(patch.apply_to(original) == revised for patch in patches)
+        assert await aio.patch(original, patches[0]) == revised
+        parsed = await aio.parse_unified_diff(
+            ["--- a", "+++ b", "@@ -2,1 +2,1 @@", "-b", "+x"]
+        )
+        assert parsed.apply_to(original) == revised
+        with aio.DiffExecutor(max_workers=1) as executor:
+            release, ran = threading.Event(), []
+            blocking = asyncio.ensure_future(executor.run(release.wait))
+            queued = asyncio.ensure_future(executor.run(ran.append, "queued"))
+            await asyncio.sleep(0)
+            # The second call is waiting for the only worker, so cancelling it means it never runs
+            queued.cancel()
+            release.set()
+            await blocking
+            with pytest.raises(asyncio.CancelledError):
+                await queued
+            assert await executor.diff(original, revised) is not None
+            assert ran == []
+            # The batches of diff_many run on the executor itself, in order
+            pairs = [(original, [str(index)]) for index in range(600)]
+            patches = await executor.diff_many(pairs, workers=2)
+            assert [patch.apply_to(original) for patch in patches] == [
+                revised for _, revised in pairs
+            ]
+
+    asyncio.run(run())
+
+
+def test_diff_cache(tmp_path):
+    from diffutils.cache import CachedDiffEngine, DiffCache
+
+    original, revised = ["a", "b", "c"], ["a", "x", "c", "d"]
+    cache = DiffCache(max_entries=2, directory=tmp_path)
+    first = diffutils.diff(original, revised, cache=cache)
+    second = diffutils.diff(original, revised, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert first.deltas == second.deltas and first is not second
+    assert second.apply_to(original) == revised
+    # The least recently used entry is evicted from memory, but is still on disk
+    for index in range(2):
+        diffutils.diff(original, revised + [str(index)], cache=cache)
+    assert len(cache) == 2
+    restarted = DiffCache(directory=tmp_path)
+    assert (
+        diffutils.diff(original, revised, cache=restarted).apply_to(original) == revised
+    )
+    assert (restarted.hits, restarted.misses) == (1, 0)
+    # Lines that differ only in where they're split must have different keys
+    engine = CachedDiffEngine(DiffEngine.INSTANCE, DiffCache())
+    assert engine.cache.key(engine.engine, ["a\nb"], []) != engine.cache.key(
+        engine.engine, ["a", "b"], []
+    )
+
+
+def test_diff_cache_surrogates(tmp_path):
+    from diffutils.cache import CachedDiffEngine, DiffCache
+
+    # Lines decoded with surrogateescape aren't valid UTF-8, but can still be cached on disk
+    original, revised = ["a", "\udc80"], ["a", "b\udcff"]
+    engine = CachedDiffEngine(
+        DiffEngine.create(name="plain", intern_lines=True),
+        DiffCache(directory=tmp_path),
+    )
+    assert engine.diff(original, revised).apply_to(original) == revised
+    restarted = CachedDiffEngine(engine.engine, DiffCache(directory=tmp_path))
+    assert restarted.diff(original, revised).apply_to(original) == revised
+    assert restarted.cache.hits == 1
+
+
+def test_diff_cache_wrong_shape(tmp_path):
+    from diffutils.cache import CachedDiffEngine, DiffCache
+
+    original, revised = ["a", "b"], ["a", "c"]
+    engine = CachedDiffEngine(DiffEngine.INSTANCE, DiffCache(directory=tmp_path))
+    key = engine.cache.key(engine.engine, original, revised)
+    # Entries that are valid JSON but not a list of deltas are just misses
+    for stored in ['{"a": 1}', "[1, 2]", '[[0, "b", 0, ["c"]]]']:
+        (tmp_path / (key.hex() + ".json")).write_text(stored)
+        engine.cache.clear()
+        assert engine.diff(original, revised).apply_to(original) == revised
+        assert (engine.cache.hits, engine.cache.misses) == (0, 1)
+
+
+def test_diff_files_cached(tmp_path, monkeypatch):
+    from diffutils.cache import CachedDiffEngine, DiffCache
+
+    original_file, revised_file = tmp_path / "original", tmp_path / "revised"
+    original_file.write_text("\n".join(original_text))
+    revised_file.write_text("\n".join(changed_text))
+    mapped = []
+    map_lines = diffutils.api.map_lines
+    monkeypatch.setattr(
+        diffutils.api, "map_lines", lambda path: mapped.append(path) or map_lines(path)
+    )
+    engine = CachedDiffEngine(DiffEngine.create(name="native"), DiffCache())
+    for _ in range(2):
+        patch = diffutils.diff_files(original_file, revised_file, engine=engine)
+        assert patch.apply_to(original_text) == changed_text
+    # The cached native engine still diffs the memory-mapped files
+    assert mapped == [original_file, revised_file] * 2
+    assert (engine.cache.hits, engine.cache.misses) == (1, 1)
+    # Buffers are keyed by their data, along with how it's split and decoded
+    from diffutils._native.myers import BufferLines
+
+    keys = [
+        engine.cache.key(engine.engine, lines, [])
+        for lines in (
+            BufferLines(b"a\nb"),
+            BufferLines(bytearray(b"a\nb")),
+            BufferLines(b"a\nb", [0, 2, 3]),
+            BufferLines(b"a\nb", [0, 1, 3]),
+            BufferLines(b"a\nb", decode=False),
+        )
+    ]
+    assert keys[0] == keys[1] and len(set(keys[1:])) == 4
+
+
+@pytest.mark.parametrize("name", ["plain", "native"])
+def test_line_hash_cache(name):
+    from diffutils.cache import LineHashCache
+
+    if name == "native":
+        pytest.importorskip("diffutils._native.myers")
+    cache = LineHashCache(max_entries=8)
+    engine = DiffEngine.create(name=name, hash_cache=cache)
+    # NOTE: Change both ends, so the common lines aren't trimmed before hashing
+    original = ["a", "b", "c", "d"]
+    first, second = ["x", "b", "c", "y"], ["z", "b", "c", "w"]
+    assert engine.diff(original, first).apply_to(original) == first
+    assert engine.diff(first, second).apply_to(first) == second
+    # Native engines using the fast hash never look at the cache
+    assert cache.hits > 0 or (name == "native" and len(cache) == 0)
+    engine.diff([str(index) for index in range(20)], original)
+    assert len(cache) <= 8
+    # Unhashable lines are never looked up, so they fall back to hashing without the cache
+    assert cache.hash_lines(["a", ["b"]]) is None and cache.lookup([["b"]]) == [None]
+    if name == "plain":
+        lines = [["a"], ["b"], ["c"]]
+        assert engine.diff(lines, lines[::-1]).apply_to(lines) == lines[::-1]
+
+
+@pytest.mark.parametrize("engine", DiffEngine.available_engines(), ids=repr)
+def test_rediff(engine):
+    original = ["a", "b", "c", "d", "e", "f"]
+    revised = ["a", "x", "c", "d", "e", "y", "f"]
+    patch = engine.diff(original, revised)
+    # Edits that touch a delta, fall between deltas, and undo a delta
+    for start, end, lines in [(1, 2, ["x", "z"]), (4, 4, ["w"]), (1, 3, ["b"])]:
+        patch = engine.rediff(patch, revised, start, end, lines)
+        revised = revised[:start] + lines + revised[end:]
+        assert patch.apply_to(original) == revised
+    assert diffutils.rediff(None, "a\nb", 1, 2, "b") is None
+
+
+@pytest.mark.parametrize("name", ["native", "native-linear-myers", "native-patience"])
+def test_rediff_compact(name):
+    from diffutils.core import Chunk
+
+    pytest.importorskip("diffutils._native.myers")
+    engine = DiffEngine.create(name=name, compact=True)
+    deltas = engine.diff_chunks(Chunk(10, ["a", "b"]), Chunk(20, ["c", "d"]))
+    assert [(delta.original.position, delta.revised.position) for delta in deltas] == [
+        (10, 20)
+    ]
+    original, revised = ["b"], []
+    patch = engine.diff(original, revised)
+    for start, end, lines in [(0, 0, ["x"]), (1, 1, ["b", "b"]), (3, 3, ["y"])]:
+        patch = engine.rediff(patch, revised, start, end, lines)
+        revised = revised[:start] + lines + revised[end:]
+        assert patch.apply_to(original) == revised
+
+
+@pytest.mark.parametrize("name", ["native", "native-linear-myers", "native-patience"])
+def test_compact_patch(name):
+    from diffutils.core import Chunk, CompactPatch, Delta
+
+    pytest.importorskip("diffutils._native.myers")
+    original = ["a", "b", "c", "d", "e", "f"]
+    revised = ["a", "x", "c", "d", "f", "g"]
+    patch = DiffEngine.create(name=name, compact=True).diff(original, revised)
+    expected = DiffEngine.create(name=name).diff(original, revised)
+    assert isinstance(patch, CompactPatch) and patch == expected
+    assert patch.apply_to(original) == revised and patch.restore(revised) == original
+    assert list(
+        diffutils.generate_unified_diff("a", "b", original, patch, context_size=1)
+    ) == list(
+        diffutils.generate_unified_diff("a", "b", original, expected, context_size=1)
+    )
+    # Adding a delta turns it into a regular patch
+    patch.add_delta(Delta.create(Chunk(6, []), Chunk(6, ["h"])))
+    assert patch.apply_to(original) == revised + ["h"]
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "plain",
+        "plain-linear-myers",
+        "native",
+        "native-linear-myers",
+        "native-patience",
+    ],
+)
+def test_line_view(name):
+    import pickle
+
+    from diffutils.core import LineView
+
+    engine = DiffEngine.create(name=name, line_views=True)
+    original = ["a"] + [str(index) for index in range(20)] + ["b"]
+    revised = ["a"] + [str(index) for index in range(20, 40)] + ["b"]
+    patch = engine.diff(original, revised)
+    assert patch.apply_to(original) == revised
+    # Large deltas reference the diffed lines instead of copying them
+    (delta,) = patch.deltas
+    lines = delta.revised.lines
+    assert isinstance(lines, LineView)
+    assert lines.sequence is revised and pickle.loads(pickle.dumps(lines)) == lines
+    assert lines == revised[1:-1] and lines[-1] == "39" and lines[1:3] == ["21", "22"]
+    # Changing the lines copies them, leaving the sequence alone
+    lines.append("x")
+    assert lines[-1] == "x" and revised[-1] == "b"
+
+
+@pytest.mark.parametrize("engine", DiffEngine.available_engines(), ids=repr)
+def test_diff_copies_lines(engine):
+    original = ["a"] + [str(index) for index in range(20)] + ["b"]
+    revised = ["a"] + [str(index) for index in range(20, 40)] + ["b"]
+    document = list(revised)
+    patch = engine.diff(original, document)
+    # By default the patch doesn't change along with its input
+    document[:] = ["unrelated"] * len(document)
+    assert patch.apply_to(original) == revised
+    assert patch.restore(revised) == original
+
+
+def test_apply_single_pass():
+    from diffutils.core import Chunk, Delta, Patch, PatchFailedException
+
+    original = [str(index) for index in range(100)]
+    revised = [line if int(line) % 3 else "x" for line in original]
+    patch = diffutils.diff(original, revised)
+    assert diffutils.patch(original, patch) == revised
+    assert diffutils.undo_patch(revised, patch) == original
+    with pytest.raises(PatchFailedException):
+        diffutils.patch(revised, patch)
+    overlapping = Patch()
+    overlapping.add_delta(Delta.create(Chunk(0, ["0", "1"]), Chunk(0, ["a"])))
+    overlapping.add_delta(Delta.create(Chunk(1, ["1"]), Chunk(0, ["b"])))
+    with pytest.raises(PatchFailedException):
+        overlapping.apply_to(original)
+    # A chunk running past the end of the target fails, instead of indexing out of range
+    truncated = Patch()
+    truncated.add_delta(Delta.create(Chunk(1, ["b", "c"]), Chunk(1, ["d"])))
+    with pytest.raises(PatchFailedException):
+        truncated.apply_to(["a", "b"])
+    with pytest.raises(PatchFailedException):
+        truncated.restore(["a"])
+    with pytest.raises(PatchFailedException):
+        Chunk(1, ["b", "c"]).verify(["a", "b"])
+
+
+def test_apply_stream():
+    from diffutils.core import PatchFailedException
+
+    original = [str(index) for index in range(50)]
+    revised = ["x"] + [line for line in original if int(line) % 7] + ["y"]
+    patch = diffutils.diff(original, revised)
+    output = io.StringIO()
+    src = io.StringIO("".join(line + "\r\n" for line in original))
+    assert patch.apply_stream(src, output) == len(revised)
+    assert output.getvalue().splitlines() == revised
+    with pytest.raises(PatchFailedException):
+        patch.apply_stream(original[:20], io.StringIO())
+
+
+def test_relocate():
+    from diffutils.core import PatchFailedException
+
+    original = ["a", "b", "c", "d", "e", "f"]
+    revised = ["new", "a", "x", "c", "d", "f"]
+    patch = diffutils.diff(original, revised)
+    # The target gained lines at the start and in the middle, so the deltas drifted apart
+    target = ["0", "1", "a", "b", "c", "2", "d", "e", "f"]
+    relocated, offsets = patch.relocate(target)
+    assert offsets == [2, 2, 3]
+    assert relocated.apply_to(target) == ["0", "1", "new", "a", "x", "c", "2", "d", "f"]
+    assert patch.relocate(original)[1] == [0, 0, 0]
+    with pytest.raises(PatchFailedException):
+        patch.relocate(target, max_offset=2)
+
+
+def test_relocate_context():
+    from diffutils.core import PatchFailedException
+
+    patch = diffutils.parse_unified_diff(
+        ["--- a", "+++ b", "@@ -1,3 +1,4 @@", " a", " b", "+new", " c"]
+    )
+    # Insertions are placed by the context of their hunk
+    target = ["x", "y", "a", "b", "c"]
+    relocated, offsets = patch.relocate(target, max_offset=5)
+    assert offsets == [2]
+    assert relocated.apply_to(target) == ["x", "y", "a", "b", "new", "c"]
+    # Relocating never places a delta where its context doesn't match
+    with pytest.raises(PatchFailedException):
+        patch.relocate(["a", "b", "x", "c"])
+
+
+def write_tree(root, files):
+    for name, lines in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("".join(line + "\n" for line in lines))
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_cli_diff_jobs(tmp_path, monkeypatch, capsys, jobs):
+    from pathlib import Path
+
+    from diffutils import __main__ as cli
+
+    monkeypatch.chdir(tmp_path)
+    names = ["b/second", "a", "b/first", "c/d/third", "unchanged"]
+    write_tree(tmp_path / "original", {name: ["x", "y", "z"] for name in names})
+    write_tree(
+        tmp_path / "revised",
+        {
+            name: ["x", name, "z"] if name != "unchanged" else ["x", "y", "z"]
+            for name in names
+        },
+    )
+    cli.diff(Path("original"), Path("revised"), Path("patches"), jobs=jobs)
+    # The diffs are reported in the same order no matter how many jobs there are
+    assert capsys.readouterr().out.splitlines() == [
+        "Computed diff: a",
+        "Computed diff: b/first",
+        "Computed diff: b/second",
+        "Computed diff: c/d/third",
+    ]
+    cli.patch(Path("patches"), Path("original"), Path("output"), jobs=jobs)
+    for name in names[:-1]:
+        assert (tmp_path / "output" / name).read_text() == "x\n{}\nz\n".format(name)
+
+
+def test_cli_patch_failures(tmp_path):
+    from argh import CommandError
+
+    from diffutils import __main__ as cli
+
+    write_tree(tmp_path / "original", {"good": ["a", "b"], "bad": ["a", "c"]})
+    patch_lines = ["--- a", "+++ b", "@@ -1,2 +1,2 @@", " a", "-b", "+x"]
+    write_tree(
+        tmp_path / "patches",
+        {
+            "good.patch": patch_lines,
+            "bad.patch": patch_lines,
+            "missing.patch": patch_lines,
+        },
+    )
+    # Every patch is attempted, and all the failures are reported together
+    with pytest.raises(CommandError) as e:
+        cli.patch(tmp_path / "patches", tmp_path / "original", tmp_path / "output")
+    message = str(e.value)
+    assert message.startswith("Failed to apply 2 of 3 patches")
+    assert "bad.patch" in message and "missing.patch" in message
+    assert "good.patch" not in message
+    assert (tmp_path / "output" / "good").read_text() == "a\nx\n"
+    # The output of a failed patch is removed, instead of being left half-written
+    assert not (tmp_path / "output" / "bad").exists()
+
+
+def test_cli_patch_unreadable(tmp_path):
+    from argh import CommandError
+
+    from diffutils import __main__ as cli
+
+    write_tree(tmp_path / "original", {"good": ["a", "b"], "binary": ["a", "b"]})
+    (tmp_path / "original" / "binary").write_bytes(b"a\n\xff\n")
+    (tmp_path / "original" / "directory").mkdir()
+    patch_lines = ["--- a", "+++ b", "@@ -1,2 +1,2 @@", " a", "-b", "+x"]
+    write_tree(
+        tmp_path / "patches",
+        {name + ".patch": patch_lines for name in ["good", "binary", "directory"]},
+    )
+    (tmp_path / "patches" / "invalid.patch").write_bytes(b"--- a\n+++ b\n\xff\n")
+    # Files that can't be read or decoded are failures, which don't stop the other patches
+    with pytest.raises(CommandError) as e:
+        cli.patch(tmp_path / "patches", tmp_path / "original", tmp_path / "output")
+    message = str(e.value)
+    assert message.startswith("Failed to apply 3 of 4 patches")
+    assert all(
+        name + ".patch" in message for name in ["binary", "directory", "invalid"]
+    )
+    assert (tmp_path / "output" / "good").read_text() == "a\nx\n"
+    # The same goes for the files in a patch set
+    patch_file = tmp_path / "changes.patch"
+    patch_file.write_bytes(
+        b"--- a/good\n+++ b/good\n@@ -1,2 +1,2 @@\n a\n-b\n+x\n"
+        b"--- a/invalid\n+++ b/invalid\n@@ -1 +1 @@\n-a\n+\xff\n"
+        b"--- a/binary\n+++ b/binary\n@@ -1 +1 @@\n-a\n+b\n"
+    )
+    with pytest.raises(CommandError) as e:
+        cli.patch(patch_file, tmp_path / "original", tmp_path / "patched")
+    message = str(e.value)
+    assert message.startswith("Failed to apply 2 of 3 patches")
+    assert "b/invalid" in message and "b/binary" in message
+    assert (tmp_path / "patched" / "good").read_text() == "a\nx\n"
+
+
+def test_cli_patch_set_traversal(tmp_path):
+    from argh import CommandError
+
+    from diffutils import __main__ as cli
+
+    root = tmp_path / "root"
+    write_tree(root / "original", {"good": ["a"], "escape": ["a"]})
+    (root / "original" / "link").symlink_to(tmp_path)
+    hunk = "@@ -1 +1 @@\n-a\n+b\n"
+    patch_file = root / "changes.patch"
+    patch_file.write_text(
+        "".join(
+            "--- a/{0}\n+++ b/{0}\n{1}".format(name, hunk)
+            for name in ["good", "../../escape", "link/escape"]
+        )
+    )
+    entries = diffutils.PatchSet.index(patch_file).entries
+    with pytest.raises(diffutils.api.PatchFormatError) as e:
+        entries[1].relative_path(strip=1)
+    assert e.value.line_number == 6
+    absolute = diffutils.PatchSetEntry(str(patch_file), "/etc/x", "/etc/x", 0, 0, 1)
+    with pytest.raises(diffutils.api.PatchFormatError):
+        absolute.relative_path()
+    (tmp_path / "escape").write_text("a\n")
+    # Names that would escape the original or output directories are failures, instead of being patched
+    with pytest.raises(CommandError) as e:
+        cli.patch(patch_file, root / "original", root / "output")
+    message = str(e.value)
+    assert message.startswith("Failed to apply 2 of 3 patches")
+    assert "Unsafe file name" in message and "is outside" in message
+    assert (root / "output" / "good").read_text() == "b\n"
+    assert (tmp_path / "escape").read_text() == "a\n"
+    assert not (tmp_path / "output").exists()
+
+
+def test_cli_patch_output(tmp_path):
+    import os
+    import stat
+
+    from argh import CommandError
+
+    from diffutils import __main__ as cli
+
+    original, output = tmp_path / "original", tmp_path / "output"
+    patch_file = tmp_path / "changes.patch"
+    write_tree(tmp_path, {"original": ["a", "b", "c"], "output": ["old"]})
+    patch_file.write_text("--- a\n+++ b\n@@ -1,3 +1,3 @@\n a\n-b\n+x\n c\n")
+    os.chmod(str(output), 0o751)
+    with pytest.raises(CommandError):
+        cli.patch(patch_file, original, output)
+    # Replacing an existing output keeps its mode
+    cli.patch(patch_file, original, output, force=True)
+    assert output.read_text() == "a\nx\nc\n"
+    assert stat.S_IMODE(output.stat().st_mode) == 0o751
+    # A failed patch leaves an existing output alone, and removes a new one
+    original.write_text("a\ny\nc\n")
+    with pytest.raises(CommandError):
+        cli.patch(patch_file, original, output, force=True)
+    assert output.read_text() == "a\nx\nc\n"
+    with pytest.raises(CommandError):
+        cli.patch(patch_file, original, tmp_path / "new")
+    assert not (tmp_path / "new").exists()
+
+
+def test_cli_patch_max_offset(tmp_path, capsys):
+    from argh import CommandError
+
+    from diffutils import __main__ as cli
+
+    original, patch_file = tmp_path / "original", tmp_path / "changes.patch"
+    write_tree(tmp_path, {"original": ["0", "1", "a", "b", "c"]})
+    patch_file.write_text("--- a\n+++ b\n@@ -1,3 +1,3 @@\n a\n-b\n+x\n c\n")
+    with pytest.raises(CommandError):
+        cli.patch(patch_file, original, tmp_path / "strict")
+    with pytest.raises(CommandError):
+        cli.patch(patch_file, original, tmp_path / "near", max_offset=1)
+    cli.patch(patch_file, original, tmp_path / "output", max_offset=2)
+    assert (tmp_path / "output").read_text() == "0\n1\na\nx\nc\n"
+    assert "delta #1 applied at line 4 (offset 2 lines)" in capsys.readouterr().out
+    # The workers return the deltas that moved, so they're printed in the order of the patches
+    names = ["f{}".format(index) for index in range(20)]
+    write_tree(tmp_path / "tree", {name: ["0", "a", "b", "c"] for name in names})
+    write_tree(
+        tmp_path / "patches",
+        {name + ".patch": patch_file.read_text().splitlines() for name in names},
+    )
+    cli.patch(
+        tmp_path / "patches", tmp_path / "tree", tmp_path / "out", jobs=2, max_offset=1
+    )
+    moved = capsys.readouterr().out.splitlines()
+    assert moved == [
+        "{}: delta #1 applied at line 3 (offset 1 lines)".format(
+            tmp_path / "tree" / name
+        )
+        for name in sorted(names)
+    ]